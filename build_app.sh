@@ -16,6 +16,9 @@ else
     pip install -U -r ./requirements.txt
 fi
 
+# Precompute the parts of compliance.xsd used at runtime
+python ./core/precompile_xsd.py ./userfiles/compliance.xsd
+
 # First build the individual cron scripts
 pyinstaller ./specs/xr.spec
 pyinstaller ./specs/admin.spec
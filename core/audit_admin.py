@@ -24,12 +24,36 @@ class IosxrAuditMain(AuditHelpers):
 
 
 
+def run_audit(audit_obj, output_xml_dir):
+
+    xml_file = audit_obj.create_xml_dump(output_xml_dir)
+    
+    if audit_obj.validate_xml_dump(xml_file):
+        audit_obj.syslogger.info('Valid XML! :)')
+        audit_obj.syslogger.info('Successfully created output XML: '+str(xml_file))
+        if not audit_obj.transfer_admin_to_host(
+                         src=xml_file,
+                         dest="/misc/app_host/ADMIN-LXC.xml"):
+            audit_obj.syslogger.info("Successfully transferred output XML"
+                                "file to host /misc/app_host ")
+            return 0
+        else:
+            audit_obj.syslogger.info("Failed to transfer output XML to host")
+            return 1
+    else:
+        audit_obj.syslogger.info('Output XML Not valid! :(')
+        return 1
+
+
+
 if __name__ == "__main__":
 
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--debug', action='store_true',
                     help='Enable verbose logging')
+    parser.add_argument('--daemon', action='store_true',
+                    help='Stay resident and run the audit periodically')
 
 
     results = parser.parse_args()
@@ -73,21 +97,8 @@ if __name__ == "__main__":
     #    output_xml_dir_xr = "/misc/app_host"
 
 
-
-    xml_file = audit_obj.create_xml_dump(output_xml_dir)
-    
-    if audit_obj.validate_xml_dump(xml_file):
-        audit_obj.syslogger.info('Valid XML! :)')
-        audit_obj.syslogger.info('Successfully created output XML: '+str(xml_file))
-        if not audit_obj.transfer_admin_to_host(
-                         src=xml_file,
-                         dest="/misc/app_host/ADMIN-LXC.xml"):
-            audit_obj.syslogger.info("Successfully transferred output XML"
-                                "file to host /misc/app_host ")
-            sys.exit(0)
-        else:
-            audit_obj.syslogger.info("Failed to transfer output XML to host")
-            sys.exit(1)
+    if results.daemon:
+        sys.exit(audit_obj.run_as_daemon(lambda: run_audit(audit_obj, output_xml_dir)))
     else:
-        audit_obj.syslogger.info('Output XML Not valid! :(')
-        sys.exit(1)
+        audit_obj.start_run_budget()
+        sys.exit(run_audit(audit_obj, output_xml_dir))
@@ -12,13 +12,31 @@ import time
 import itertools
 import argparse
 import tarfile
+import tempfile
+import atexit
+import io
+import threading
+import re
 
 from lib.audit_helper import XML_PREFIX_DOMAINS
 from lib.audit_helper import COMPLIANCE_PREFIX
+from lib.audit_helper import DAEMON_PIDFILE_SUFFIX
+from lib.audit_helper import imap_ordered
+from lib.audit_helper import file_digest
 
 OPEN_FILE_WAIT_COUNT = 10
 OPEN_FILE_WAIT_INTERVAL = 5
 
+# Audit log of every node collected by auditor -o, as (name in the tarfile, node)
+AUDIT_LOG_FILE = "/tmp/ztp_python.log"
+LOG_SOURCES = [("ACTIVE-XR-LXC.audit.log", "ACTIVE-XR-LXC"),
+               ("ACTIVE-ADMIN-LXC.audit.log", "ACTIVE-ADMIN-LXC"),
+               ("ACTIVE-HOST.audit.log", "ACTIVE-HOST"),
+               ("STANDBY-XR-LXC.audit.log", "STANDBY-XR-LXC"),
+               ("STANDBY-ADMIN-LXC.audit.log", "STANDBY-ADMIN-LXC"),
+               ("STANDBY-HOST.audit.log", "STANDBY-HOST")]
+COLLECTION_ERRORS_FILE = "COLLECTION-ERRORS.txt"
+
 
 class IosxrAuditMain(AuditHelpers):
 
@@ -28,6 +46,9 @@ class IosxrAuditMain(AuditHelpers):
 
         super(IosxrAuditMain, self).__init__(*args, **kwargs)
 
+        self.artifact_digests = {}
+        self.artifact_digests_lock = threading.Lock()
+
         if self.request_version:
             return None
 
@@ -111,6 +132,51 @@ class IosxrAuditMain(AuditHelpers):
 
 
                
+    def artifact_in_sync(self, runcmd, src, dest):
+        """Check if the artifact installed at dest on a target is identical
+           to the bundled artifact src by comparing their md5 digests.
+           :param runcmd: Method running a linux cmd on the target, e.g.
+                          self.run_bash or self.standby_hostcmd
+           :return: True if both digests match, False if they differ or
+                    could not be determined (the artifact is then copied)
+           :rtype: bool
+        """
+
+        if not self.install_cfg_dict.get("ARTIFACT_SYNC", True):
+            return False
+
+        try:
+            src_stat = os.stat(src)
+            key = (src, src_stat.st_size, src_stat.st_mtime)
+            with self.artifact_digests_lock:
+                src_digest = self.artifact_digests.get(key)
+            if src_digest is None:
+                src_digest = file_digest(src, "md5")
+                with self.artifact_digests_lock:
+                    self.artifact_digests[key] = src_digest
+        except Exception as e:
+            self.syslogger.info("Failed to compute digest of "+src+", error: "+str(e))
+            return False
+
+        result = runcmd(cmd="md5sum "+dest)
+        if result["status"] not in [0, "success"]:
+            return False
+
+        if isinstance(result["output"], list):
+            output = "\n".join(result["output"])
+        else:
+            output = result["output"]
+
+        match = re.search(r"\b([0-9a-f]{32})\s+\*?"+re.escape(dest), output)
+        if match is None:
+            return False
+
+        if self.debug:
+            self.logger.debug("Digest of "+src+": "+src_digest+", of installed "+dest+": "+match.group(1))
+
+        return match.group(1) == src_digest
+
+
     def setup_xr_audit(self, srcfolder=None, dstfolder=None,appName=None, cronName=None, cronPrefix=None, outputXMLDir=None, uninstall=False, cleanxml=False):
                 
         if srcfolder is None:
@@ -165,7 +231,7 @@ class IosxrAuditMain(AuditHelpers):
         if cleanxml:
             # Remove any accumulated xml files
             for xml_prefix in XML_PREFIX_DOMAINS+[COMPLIANCE_PREFIX]:
-                result = self.run_bash("rm -f "+outputXMLDir+"/"+xml_prefix+"*.xml")
+                result = self.run_bash("rm -f "+outputXMLDir+"/"+xml_prefix+"*.xml*")
                 if not result["status"]:
                     check_removal = self.run_bash(cmd="ls "+outputXMLDir+"/")
                     if not check_removal["status"]: 
@@ -206,7 +272,11 @@ class IosxrAuditMain(AuditHelpers):
             self.syslogger.info("Failed to check if app exists already")
             app_exists = False
      
-        if app_exists:
+        if (app_exists and not uninstall and
+            self.artifact_in_sync(self.run_bash, srcfolder+"/"+appName, dstfolder+"/"+appName)):
+            self.logger.info("XR LXC audit app already up to date, skipping copy")
+            self.syslogger.info("XR LXC audit app already up to date, skipping copy")
+        elif app_exists:
             while(wait_count < OPEN_FILE_WAIT_COUNT):
                 clean_up_filename = self.run_bash(cmd="lsof "+dstfolder+"/"+appName)
                 self.syslogger.info(clean_up_filename)
@@ -215,6 +285,8 @@ class IosxrAuditMain(AuditHelpers):
                 if clean_up_filename["output"] is not "" :
                     # Process currently running, Sleep OPEN_FILE_WAIT_INTERVAL seconds before attempting again
                     self.syslogger.info("Process currently running, wait "+str(OPEN_FILE_WAIT_INTERVAL)+" seconds before attempting again")
+                    # Ask a resident (--daemon) instance of the app to exit
+                    self.run_bash(cmd="rm -f "+dstfolder+"/"+appName+DAEMON_PIDFILE_SUFFIX)
                     time.sleep(OPEN_FILE_WAIT_INTERVAL)
                 else:
                     if uninstall:
@@ -383,12 +455,18 @@ class IosxrAuditMain(AuditHelpers):
         wait_count = 0
         action_success = False
 
-        if app_exists:
+        if (app_exists and not uninstall and
+            self.artifact_in_sync(self.active_adminruncmd, srcfolder+"/"+appName, dstfolder+"/"+appName)):
+            self.logger.info("Admin LXC audit app already up to date, skipping copy")
+            self.syslogger.info("Admin LXC audit app already up to date, skipping copy")
+        elif app_exists:
             while(wait_count < OPEN_FILE_WAIT_COUNT):
                 clean_up_filename = self.active_adminruncmd(cmd="lsof "+dstfolder+"/"+appName)
                 cmd_out = clean_up_filename["output"][3:-1]
                 if cmd_out:
                     self.syslogger.info("Process currently running, wait "+str(OPEN_FILE_WAIT_INTERVAL)+" seconds before attempting again")
+                    # Ask a resident (--daemon) instance of the app to exit
+                    self.active_adminruncmd(cmd="rm -f "+dstfolder+"/"+appName+DAEMON_PIDFILE_SUFFIX)
                     time.sleep(OPEN_FILE_WAIT_INTERVAL)
                 else:
                     if uninstall:
@@ -455,7 +533,7 @@ class IosxrAuditMain(AuditHelpers):
         cron_fname = cronPrefix+timestamp
 
 
-        cron_cleanup = self.cron_job(folder="/misc/app_host", action="delete")
+        cron_cleanup = self.cron_job(folder="/misc/app_host", croncmd_fname=cronPrefix+"*", action="delete")
 
         if cron_cleanup["status"] == "success":
             self.syslogger.info("Successfully cleaned up temp admin audit cron jobs")
@@ -505,7 +583,7 @@ class IosxrAuditMain(AuditHelpers):
                 self.logger.debug(transfer_to_admin["output"])
 
             # Remove the temp cron file in /misc/app_host
-            post_activation_cleanup = self.cron_job(folder="/misc/app_host", action="delete")
+            post_activation_cleanup = self.cron_job(folder="/misc/app_host", croncmd_fname=cron_fname, action="delete")
 
             if post_activation_cleanup["status"] == "success":
                 self.syslogger.info("Successfully cleaned up temp admin audit cron jobs post activation")
@@ -577,12 +655,18 @@ class IosxrAuditMain(AuditHelpers):
         wait_count = 0
         action_success = False
 
-        if app_exists:
+        if (app_exists and not uninstall and
+            self.artifact_in_sync(self.active_hostcmd, srcfolder+"/"+appName, dstfolder+"/"+appName)):
+            self.logger.info("Host audit app already up to date, skipping copy")
+            self.syslogger.info("Host audit app already up to date, skipping copy")
+        elif app_exists:
             while(wait_count < OPEN_FILE_WAIT_COUNT):
                 clean_up_filename = self.active_hostcmd(cmd="lsof "+dstfolder+"/"+appName)
                 cmd_out = clean_up_filename["output"][3:-1]
                 if cmd_out:
                     self.syslogger.info("Process currently running, wait "+str(OPEN_FILE_WAIT_INTERVAL)+" seconds before attempting again")
+                    # Ask a resident (--daemon) instance of the app to exit
+                    self.active_hostcmd(cmd="rm -f "+dstfolder+"/"+appName+DAEMON_PIDFILE_SUFFIX)
                     time.sleep(OPEN_FILE_WAIT_INTERVAL)
                 else:
                     if uninstall:
@@ -649,7 +733,7 @@ class IosxrAuditMain(AuditHelpers):
         cron_fname = cronPrefix+timestamp
 
 
-        cron_cleanup = self.cron_job(folder="/misc/app_host", action="delete")
+        cron_cleanup = self.cron_job(folder="/misc/app_host", croncmd_fname=cronPrefix+"*", action="delete")
 
         if cron_cleanup["status"] == "success":
             self.syslogger.info("Successfully cleaned up temp host audit cron jobs")
@@ -697,7 +781,7 @@ class IosxrAuditMain(AuditHelpers):
                 self.logger.debug(transfer_to_host["output"])
 
             # Remove the temp cron file in /misc/app_host
-            post_activation_cleanup = self.cron_job(folder="/misc/app_host", action="delete")
+            post_activation_cleanup = self.cron_job(folder="/misc/app_host", croncmd_fname=cron_fname, action="delete")
 
             if post_activation_cleanup["status"] == "success":
                 self.syslogger.info("Successfully cleaned up temp admin audit cron jobs post activation")
@@ -766,6 +850,10 @@ class IosxrAuditMain(AuditHelpers):
                 self.syslogger.info("Failed to initiate removal of auditor app from Standby XR LXC: "+appName)
                 self.logger.info("Failed to initiate removal of auditor app from Standby XR LXC: "+appName)
                 return False
+        elif self.artifact_in_sync(self.standby_xrruncmd, srcfolder+"/"+appName, dstfolder+"/"+appName):
+            self.logger.info("Standby XR LXC auditor app already up to date, skipping copy")
+            self.syslogger.info("Standby XR LXC auditor app already up to date, skipping copy")
+            return True
         else:
             transfer_to_standby_xr = self.standby_xrscp(src=srcfolder+"/"+appName, dest=dstfolder+"/"+appName)
             if transfer_to_standby_xr["status"] == "success":
@@ -879,12 +967,18 @@ class IosxrAuditMain(AuditHelpers):
         wait_count = 0
         action_success = False
 
-        if app_exists:
+        if (app_exists and not uninstall and
+            self.artifact_in_sync(self.standby_xrruncmd, srcfolder+"/"+appName, dstfolder+"/"+appName)):
+            self.logger.info("Standby XR LXC audit app already up to date, skipping copy")
+            self.syslogger.info("Standby XR LXC audit app already up to date, skipping copy")
+        elif app_exists:
             while(wait_count < OPEN_FILE_WAIT_COUNT):
                 clean_up_filename = self.standby_xrruncmd(cmd="lsof "+dstfolder+"/"+appName)
                 cmd_out = clean_up_filename["output"]
                 if cmd_out:
                     self.syslogger.info("Process currently running, wait "+str(OPEN_FILE_WAIT_INTERVAL)+" seconds before attempting again")
+                    # Ask a resident (--daemon) instance of the app to exit
+                    self.standby_xrruncmd(cmd="rm -f "+dstfolder+"/"+appName+DAEMON_PIDFILE_SUFFIX)
                     time.sleep(OPEN_FILE_WAIT_INTERVAL)
                 else:
                     if uninstall:
@@ -950,7 +1044,7 @@ class IosxrAuditMain(AuditHelpers):
         cron_fname = cronPrefix+timestamp
 
 
-        cron_cleanup = self.cron_job(folder="/misc/app_host", action="delete")
+        cron_cleanup = self.cron_job(folder="/misc/app_host", croncmd_fname=cronPrefix+"*", action="delete")
 
         if cron_cleanup["status"] == "success":
             self.syslogger.info("Successfully cleaned up temp standby XR LXC audit cron jobs")
@@ -1000,7 +1094,7 @@ class IosxrAuditMain(AuditHelpers):
                 self.logger.debug(transfer_to_standby_xr["output"])
 
             # Remove the temp cron file in /misc/app_host
-            post_activation_cleanup = self.cron_job(folder="/misc/app_host", action="delete")
+            post_activation_cleanup = self.cron_job(folder="/misc/app_host", croncmd_fname=cron_fname, action="delete")
 
             if post_activation_cleanup["status"] == "success":
                 self.syslogger.info("Successfully cleaned up temp XR LXC audit cron jobs post activation")
@@ -1115,12 +1209,18 @@ class IosxrAuditMain(AuditHelpers):
         wait_count = 0
         action_success = False
 
-        if app_exists:
+        if (app_exists and not uninstall and
+            self.artifact_in_sync(self.standby_adminruncmd, srcfolder+"/"+appName, dstfolder+"/"+appName)):
+            self.logger.info("Standby Admin LXC audit app already up to date, skipping copy")
+            self.syslogger.info("Standby Admin LXC audit app already up to date, skipping copy")
+        elif app_exists:
             while(wait_count < OPEN_FILE_WAIT_COUNT):
                 clean_up_filename = self.standby_adminruncmd(cmd="lsof "+dstfolder+"/"+appName)
                 cmd_out = clean_up_filename["output"][3:-1]
                 if cmd_out:
                     self.syslogger.info("Process currently running, wait "+str(OPEN_FILE_WAIT_INTERVAL)+" seconds before attempting again")
+                    # Ask a resident (--daemon) instance of the app to exit
+                    self.standby_adminruncmd(cmd="rm -f "+dstfolder+"/"+appName+DAEMON_PIDFILE_SUFFIX)
                     time.sleep(OPEN_FILE_WAIT_INTERVAL)
                 else:
                     if uninstall:
@@ -1186,7 +1286,7 @@ class IosxrAuditMain(AuditHelpers):
         cron_fname = cronPrefix+timestamp
 
 
-        cron_cleanup = self.cron_job(folder="/misc/app_host", action="delete")
+        cron_cleanup = self.cron_job(folder="/misc/app_host", croncmd_fname=cronPrefix+"*", action="delete")
 
         if cron_cleanup["status"] == "success":
             self.syslogger.info("Successfully cleaned up temp admin audit cron jobs")
@@ -1235,7 +1335,7 @@ class IosxrAuditMain(AuditHelpers):
                 self.logger.debug(transfer_to_standby_admin["output"])
 
             # Remove the temp cron file in /misc/app_host
-            post_activation_cleanup = self.cron_job(folder="/misc/app_host", action="delete")
+            post_activation_cleanup = self.cron_job(folder="/misc/app_host", croncmd_fname=cron_fname, action="delete")
 
             if post_activation_cleanup["status"] == "success":
                 self.syslogger.info("Successfully cleaned up temp admin audit cron jobs post activation")
@@ -1313,12 +1413,18 @@ class IosxrAuditMain(AuditHelpers):
         wait_count = 0
         action_success = False
 
-        if app_exists:
+        if (app_exists and not uninstall and
+            self.artifact_in_sync(self.standby_hostcmd, srcfolder+"/"+appName, dstfolder+"/"+appName)):
+            self.logger.info("Standby Host audit app already up to date, skipping copy")
+            self.syslogger.info("Standby Host audit app already up to date, skipping copy")
+        elif app_exists:
             while(wait_count < OPEN_FILE_WAIT_COUNT):
                 clean_up_filename = self.standby_hostcmd(cmd="lsof "+dstfolder+"/"+appName)
                 cmd_out = clean_up_filename["output"][3:-1]
                 if cmd_out:
                     self.syslogger.info("Process currently running, wait "+str(OPEN_FILE_WAIT_INTERVAL)+" seconds before attempting again")
+                    # Ask a resident (--daemon) instance of the app to exit
+                    self.standby_hostcmd(cmd="rm -f "+dstfolder+"/"+appName+DAEMON_PIDFILE_SUFFIX)
                     time.sleep(OPEN_FILE_WAIT_INTERVAL)
                 else:
                     if uninstall:
@@ -1384,7 +1490,7 @@ class IosxrAuditMain(AuditHelpers):
         cron_fname = cronPrefix+timestamp
 
 
-        cron_cleanup = self.cron_job(folder="/misc/app_host", action="delete")
+        cron_cleanup = self.cron_job(folder="/misc/app_host", croncmd_fname=cronPrefix+"*", action="delete")
 
         if cron_cleanup["status"] == "success":
             self.syslogger.info("Successfully cleaned up temp host audit cron jobs")
@@ -1433,7 +1539,7 @@ class IosxrAuditMain(AuditHelpers):
                 self.logger.debug(transfer_to_standby_host["output"])
 
             # Remove the temp cron file in /misc/app_host
-            post_activation_cleanup = self.cron_job(folder="/misc/app_host", action="delete")
+            post_activation_cleanup = self.cron_job(folder="/misc/app_host", croncmd_fname=cron_fname, action="delete")
 
             if post_activation_cleanup["status"] == "success":
                 self.syslogger.info("Successfully cleaned up temp standby host  audit cron jobs post activation")
@@ -1505,7 +1611,11 @@ class IosxrAuditMain(AuditHelpers):
             self.syslogger.info("Failed to check if app exists already")
             app_exists = False
 
-        if app_exists:
+        if (app_exists and not uninstall and
+            self.artifact_in_sync(self.run_bash, srcfolder+"/"+appName, dstfolder+"/"+appName)):
+            self.logger.info("Collector app already up to date, skipping copy")
+            self.syslogger.info("Collector app already up to date, skipping copy")
+        elif app_exists:
             while(wait_count < OPEN_FILE_WAIT_COUNT):
                 clean_up_filename = self.run_bash(cmd="lsof "+dstfolder+"/"+appName)
                 self.syslogger.info(clean_up_filename)
@@ -1515,6 +1625,8 @@ class IosxrAuditMain(AuditHelpers):
                 if clean_up_filename["output"] is not "" :
                     # Process currently running, Sleep OPEN_FILE_WAIT_INTERVAL seconds before attempting again
                     self.syslogger.info("Process currently running, wait "+str(OPEN_FILE_WAIT_INTERVAL)+" seconds before attempting again")
+                    # Ask a resident (--daemon) instance of the app to exit
+                    self.run_bash(cmd="rm -f "+dstfolder+"/"+appName+DAEMON_PIDFILE_SUFFIX)
                     time.sleep(OPEN_FILE_WAIT_INTERVAL)
                 else:
                     if uninstall:
@@ -1651,12 +1763,18 @@ class IosxrAuditMain(AuditHelpers):
         wait_count = 0
         action_success = False
 
-        if app_exists:
+        if (app_exists and not uninstall and
+            self.artifact_in_sync(self.standby_xrruncmd, srcfolder+"/"+appName, dstfolder+"/"+appName)):
+            self.logger.info("Standby XR LXC collector app already up to date, skipping copy")
+            self.syslogger.info("Standby XR LXC collector app already up to date, skipping copy")
+        elif app_exists:
             while(wait_count < OPEN_FILE_WAIT_COUNT):
                 clean_up_filename = self.standby_xrruncmd(cmd="lsof "+dstfolder+"/"+appName)
                 cmd_out = clean_up_filename["output"]
                 if cmd_out:
                     self.syslogger.info("Process currently running, wait "+str(OPEN_FILE_WAIT_INTERVAL)+" seconds before attempting again")
+                    # Ask a resident (--daemon) instance of the app to exit
+                    self.standby_xrruncmd(cmd="rm -f "+dstfolder+"/"+appName+DAEMON_PIDFILE_SUFFIX)
                     time.sleep(OPEN_FILE_WAIT_INTERVAL)
                 else:
                     if uninstall:
@@ -1723,7 +1841,7 @@ class IosxrAuditMain(AuditHelpers):
         cron_fname = cronPrefix+timestamp
 
 
-        cron_cleanup = self.cron_job(folder="/misc/app_host", action="delete")
+        cron_cleanup = self.cron_job(folder="/misc/app_host", croncmd_fname=cronPrefix+"*", action="delete")
 
         if cron_cleanup["status"] == "success":
             self.syslogger.info("Successfully cleaned up temp standby XR LXC collector cron jobs")
@@ -1773,7 +1891,7 @@ class IosxrAuditMain(AuditHelpers):
                 self.logger.debug(transfer_to_standby_xr["output"])
  
             # Remove the temp cron file in /misc/app_host
-            post_activation_cleanup = self.cron_job(folder="/misc/app_host", action="delete")
+            post_activation_cleanup = self.cron_job(folder="/misc/app_host", croncmd_fname=cron_fname, action="delete")
 
             if post_activation_cleanup["status"] == "success":
                 self.syslogger.info("Successfully cleaned up temp Standby XR LXC collector cron jobs post activation")
@@ -1788,9 +1906,92 @@ class IosxrAuditMain(AuditHelpers):
 
 
 
+    def run_setup_steps(self, steps, uninstall=False):
+        """Run install/uninstall steps concurrently. A step starts as soon as
+           all the steps it depends on have succeeded. Once a step has
+           failed no other step is started, the steps that have not started
+           yet are skipped.
+           :param steps: List of (name, setup method, [names of the steps it
+                         depends on]). Each method is called as
+                         method(uninstall=uninstall) and returns True/False
+           :type steps: list
+           :return: Dictionary with the outcome and duration of every step
+                    { '<name>': { 'status': 'success/error/skipped',
+                                  'duration': seconds } }
+           :rtype: dict
+        """
+
+        step_results = {}
+        step_done = dict((name, threading.Event()) for name, method, depends_on in steps)
+        step_failed = threading.Event()
+
+        def run_step(name, method, depends_on):
+            start_time = time.time()
+
+            # The event of the step is always set, the steps that depend on
+            # it would otherwise wait forever
+            try:
+                for dependency in depends_on:
+                    step_done[dependency].wait()
+
+                failed_dependencies = [dependency for dependency in depends_on
+                                       if step_results.get(dependency, {}).get("status") != "success"]
+
+                if failed_dependencies:
+                    self.syslogger.info("Skipping step "+name+", failed dependencies: "+", ".join(failed_dependencies))
+                    step_results[name] = {"status" : "skipped", "duration" : 0}
+                elif step_failed.is_set():
+                    self.syslogger.info("Skipping step "+name+", an earlier step failed")
+                    step_results[name] = {"status" : "skipped", "duration" : 0}
+                else:
+                    start_time = time.time()
+                    try:
+                        success = method(uninstall=uninstall)
+                    except Exception as e:
+                        self.syslogger.info("Step "+name+" failed, error: "+str(e))
+                        success = False
+
+                    step_results[name] = {"status" : "success" if success else "error",
+                                          "duration" : time.time() - start_time}
+                    if not success:
+                        step_failed.set()
+
+                self.syslogger.info("Step %s: %s in %.1f seconds" % (name,
+                                                                     step_results[name]["status"],
+                                                                     step_results[name]["duration"]))
+            except Exception as e:
+                step_results[name] = {"status" : "error",
+                                      "duration" : time.time() - start_time}
+                step_failed.set()
+                try:
+                    self.syslogger.info("Step "+name+" failed, error: "+str(e))
+                except Exception as e:
+                    pass
+            finally:
+                step_done[name].set()
+
+        threads = []
+        for step in steps:
+            thread = threading.Thread(target=run_step, args=step)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        for name, method, depends_on in steps:
+            self.logger.info("%-20s %-8s %6.1fs" % (name,
+                                                    step_results[name]["status"],
+                                                    step_results[name]["duration"]))
+
+        return step_results
+
+
     def list_current_files(self):
 
         key_list = [ "XR", "COLLECTOR", "ADMIN", "HOST"]
+        key_dirs = {}
 
         for key in key_list:
             try:
@@ -1814,224 +2015,155 @@ class IosxrAuditMain(AuditHelpers):
                elif key == "HOST":
                    xml_dir = "/misc/app_host"
 
-            #Now run the "ls -lrt" command on each relevant directory:
-
-            self.logger.info("\n\n####################################################\n"
-                             "                       ACTIVE-RP "+key+"                \n"
-                             "#####################################################\n\n")
+            key_dirs[key] = [("App Directory", app_dir),
+                             ("Cron directory", "/etc/cron.d"),
+                             ("XML Output Directory", xml_dir)]
 
-            if key == "XR" or key == "COLLECTOR":
-                self.logger.info("\n\n###### App Directory ######\n")
 
-                cmd_out = self.run_bash(cmd="ls -lrt "+app_dir)
-                if not cmd_out["status"]:
-                    self.logger.info("\n "+app_dir+":\n\n"
-                                     ""+cmd_out["output"]) 
+        # Every directory of a target is listed in one go (one admin/ssh hop)
+        # and all the targets are queried in parallel. XR and COLLECTOR
+        # share the XR LXC target.
 
-                self.logger.info("\n\n###### Cron directory ######\n")
-               
-                cmd_out = self.run_bash(cmd="ls -lrt /etc/cron.d")
-                if not cmd_out["status"]:
-                    self.logger.info("\n /etc/cron.d:\n\n"
-                                     ""+cmd_out["output"])
+        target_keys = {"XR" : ["XR", "COLLECTOR"],
+                       "ADMIN" : ["ADMIN"],
+                       "HOST" : ["HOST"]}
 
-                self.logger.info("\n\n###### XML Output Directory ######\n")
-
-                cmd_out = self.run_bash(cmd="ls -lrt "+xml_dir)
-                if not cmd_out["status"]:
-                    self.logger.info("\n "+xml_dir+":\n\n"
-                                     ""+cmd_out["output"])
-                    
-            
-            if key == "ADMIN":
-                self.logger.info("\n\n###### App Directory ######\n")
-
-                cmd_out = self.active_adminruncmd(cmd="ls -lrt "+app_dir)
-                if cmd_out["status"] == "success":
-                    self.logger.info("\n "+app_dir+":\n\n"
-                                     ""+'\n'.join(cmd_out["output"][3:-1])) 
-
-                self.logger.info("\n\n###### Cron directory ######\n")
-               
-                cmd_out = self.active_adminruncmd(cmd="ls -lrt /etc/cron.d")
-                if cmd_out["status"] == "success":
-                    self.logger.info("\n /etc/cron.d:\n\n"
-                                     ""+'\n'.join(cmd_out["output"][3:-1]))
-
-                self.logger.info("\n\n###### XML Output Directory ######\n")
-
-                cmd_out = self.active_adminruncmd(cmd="ls -lrt "+xml_dir)
-                if cmd_out["status"] == "success":
-                    self.logger.info("\n "+xml_dir+":\n\n"
-                                     ""+'\n'.join(cmd_out["output"][3:-1]))
-
-
-            if key == "HOST":
-                self.logger.info("\n\n###### App Directory ######\n")
-                cmd_out = self.active_hostcmd(cmd="ls -lrt "+app_dir)
-                if cmd_out["status"] == "success":
-                    self.logger.info("\n "+app_dir+":\n\n"
-                                     ""+'\n'.join(cmd_out["output"][3:-1])) 
-
-                self.logger.info("\n\n###### Cron directory ######\n")
-               
-                cmd_out = self.active_hostcmd(cmd="ls -lrt /etc/cron.d")
-                if cmd_out["status"] == "success":
-                    self.logger.info("\n /etc/cron.d:\n\n"
-                                     ""+'\n'.join(cmd_out["output"][3:-1]))
-
-                self.logger.info("\n\n###### XML Output Directory ######\n")
-
-                cmd_out = self.active_hostcmd(cmd="ls -lrt "+xml_dir)
-                if cmd_out["status"] == "success":
-                    self.logger.info("\n "+xml_dir+":\n\n"
-                                     ""+'\n'.join(cmd_out["output"][3:-1]))
+        targets = [("ACTIVE-RP", "XR", self.run_bash),
+                   ("ACTIVE-RP", "ADMIN", self.active_adminruncmd),
+                   ("ACTIVE-RP", "HOST", self.active_hostcmd),
+                   ("STANDBY-RP", "XR", self.standby_xrruncmd),
+                   ("STANDBY-RP", "ADMIN", self.standby_adminruncmd),
+                   ("STANDBY-RP", "HOST", self.standby_hostcmd)]
 
+        def list_target(target):
+            rp, target_key, runcmd = target
+            dirs = [directory for key in target_keys[target_key]
+                              for title, directory in key_dirs[key]]
+            try:
+                return self.list_directories(runcmd, dirs)
+            except Exception as e:
+                self.syslogger.info("Failed to list files on "+rp+" "+target_key+", error: "+str(e))
+                return {}
 
-            self.logger.info("\n\n####################################################\n"
-                             "                       STANDBY-RP "+key+"               \n"
-                             "#####################################################\n\n")
+        results = list(imap_ordered(list_target, targets, concurrency=len(targets)))
+        listings = dict(((rp, target_key), listing)
+                        for (rp, target_key, runcmd), listing in zip(targets, results))
 
-            if key == "XR" or key == "COLLECTOR":
-                self.logger.info("\n\n###### App Directory ######\n")
 
-                cmd_out = self.standby_xrruncmd(cmd="ls -lrt "+app_dir)
-                if cmd_out["status"] =="success":
-                    self.logger.info("\n "+app_dir+":\n\n"
-                                     ""+cmd_out["output"])
+        for key in key_list:
+            if key == "COLLECTOR":
+                target_key = "XR"
+            else:
+                target_key = key
 
-                self.logger.info("\n\n###### Cron directory ######\n")
+            for rp in ["ACTIVE-RP", "STANDBY-RP"]:
+                self.logger.info("\n\n####################################################\n"
+                                 "                       "+rp+" "+key+"                \n"
+                                 "#####################################################\n\n")
 
-                cmd_out = self.standby_xrruncmd(cmd="ls -lrt /etc/cron.d")
-                if cmd_out["status"] == "success":
-                    self.logger.info("\n /etc/cron.d:\n\n"
-                                     ""+cmd_out["output"])
+                listing = listings[(rp, target_key)]
 
-                self.logger.info("\n\n###### XML Output Directory ######\n")
+                for title, directory in key_dirs[key]:
+                    self.logger.info("\n\n###### "+title+" ######\n")
 
-                cmd_out = self.standby_xrruncmd(cmd="ls -lrt "+xml_dir)
-                if cmd_out["status"] == "success":
-                    self.logger.info("\n "+xml_dir+":\n\n"
-                                     ""+cmd_out["output"])
+                    if directory in listing:
+                        self.logger.info("\n "+directory+":\n\n"
+                                         ""+listing[directory])
 
 
-            if key == "ADMIN":
-                self.logger.info("\n\n###### App Directory ######\n")
-                cmd_out = self.standby_adminruncmd(cmd="ls -lrt "+app_dir)
-                if cmd_out["status"] == "success":
-                    self.logger.info("\n "+app_dir+":\n\n"
-                                     ""+'\n'.join(cmd_out["output"][3:-1]))
 
-                self.logger.info("\n\n###### Cron directory ######\n")
+    def fetch_log(self, source, staging_dir):
+        """Copy the audit log of one of the LOG_SOURCES to a file of its own
+           in staging_dir. The logs behind the admin LXC and host hops are
+           copied over with the existing scp helpers, so the bytes of every
+           log are transferred unchanged.
+           :return: Return a dictionary with status and the staged file
+                    { 'status': 'error/success', 'output': '' }
+           :rtype: dict
+        """
 
-                cmd_out = self.standby_adminruncmd(cmd="ls -lrt /etc/cron.d")
-                if cmd_out["status"] == "success":
-                    self.logger.info("\n /etc/cron.d:\n\n"
-                                     ""+'\n'.join(cmd_out["output"][3:-1]))
+        name, origin = source
+        staged_file = os.path.join(staging_dir, name)
 
-                self.logger.info("\n\n###### XML Output Directory ######\n")
+        if origin == "ACTIVE-XR-LXC":
+            if self._copy_file(src=AUDIT_LOG_FILE, dest=staged_file):
+                return {"status" : "success", "output" : staged_file}
+            else:
+                return {"status" : "error", "output" : "Failed to copy "+AUDIT_LOG_FILE}
 
-                cmd_out = self.standby_adminruncmd(cmd="ls -lrt "+xml_dir)
-                if cmd_out["status"] == "success":
-                    self.logger.info("\n "+xml_dir+":\n\n"
-                                     ""+'\n'.join(cmd_out["output"][3:-1]))
+        scp_to_xr = {"STANDBY-XR-LXC" : self.standby_to_active_xr_scp,
+                     "ACTIVE-ADMIN-LXC" : self.active_admin_to_xr_scp,
+                     "ACTIVE-HOST" : self.active_host_to_xr_scp,
+                     "STANDBY-ADMIN-LXC" : self.standby_admin_to_xr_scp,
+                     "STANDBY-HOST" : self.standby_host_to_xr_scp}[origin]
 
+        try:
+            result = scp_to_xr(src=AUDIT_LOG_FILE, dest=staged_file)
+        except Exception as e:
+            return {"status" : "error", "output" : str(e)}
 
-            if key == "HOST":
-                self.logger.info("\n\n###### App Directory ######\n")
-                cmd_out = self.standby_hostcmd(cmd="ls -lrt "+app_dir)
-                if cmd_out["status"] == "success":
-                    self.logger.info("\n "+app_dir+":\n\n"
-                                     ""+'\n'.join(cmd_out["output"][3:-1]))
+        if result["status"] != "success" or not os.path.isfile(staged_file):
+            return {"status" : "error", "output" : result["output"]}
 
-                self.logger.info("\n\n###### Cron directory ######\n")
+        return {"status" : "success", "output" : staged_file}
 
-                cmd_out = self.standby_hostcmd(cmd="ls -lrt /etc/cron.d")
-                if cmd_out["status"] == "success":
-                    self.logger.info("\n /etc/cron.d:\n\n"
-                                     ""+'\n'.join(cmd_out["output"][3:-1]))
 
-                self.logger.info("\n\n###### XML Output Directory ######\n")
+    def collect_logs(self, tarfile_output_dir = "/misc/scratch"):
 
-                cmd_out = self.standby_hostcmd(cmd="ls -lrt "+xml_dir)
-                if cmd_out["status"] == "success":
-                    self.logger.info("\n "+xml_dir+":\n\n"
-                                     ""+'\n'.join(cmd_out["output"][3:-1]))
-   
+        # Every log is copied to a private staging directory next to the
+        # tarfile and streamed into the tarfile from there, the directory
+        # is removed once the tarfile is written
 
+        try:
+            staging_dir = tempfile.mkdtemp(prefix="auditor_collected_logs_",
+                                           dir=tarfile_output_dir)
+        except OSError as e:
+            self.logger.info("Failed to create log staging directory in "+tarfile_output_dir+", Error: "+str(e))
+            return False
 
-    def collect_logs(self, 
-                     temp_collection_dir="/misc/scratch/auditor_collected_logs",
-                     tarfile_output_dir = "/misc/scratch"):
+        # Fetch the logs from all the nodes in parallel and stream them into
+        # the tarfile in order. An unreachable node does not prevent the
+        # tarfile from being created, failures are listed in COLLECTION_ERRORS_FILE
 
-        # Create a directory to store collected logs
+        failed_sources = []
 
-        result =  self.run_bash(cmd="mkdir -p "+temp_collection_dir)
-        if result["status"]:
-            self.logger.info("Failed to create "+temp_collection_dir+" directory, bailing out")
-            return False
-             
-        # Active XR-LXC logs
-        if self._copy_file(src="/tmp/ztp_python.log", dest=temp_collection_dir+"/ACTIVE-XR-LXC.audit.log"):
-            self.logger.info("Successfully saved audit logs for Active XR LXC to "+temp_collection_dir+"/ACTIVE-XR-LXC.audit.log")
-        else:
-            self.logger.info("Failed to save audit logs for Active XR LXC to"+temp_collection_dir+"/ACTIVE-XR-LXC.audit.log" )
-            return False
+        try:
+            with tarfile.open(tarfile_output_dir+"/auditor_collated_logs.tar.gz", "w|gz") as tar:
+                results = imap_ordered(lambda source: self.fetch_log(source, staging_dir),
+                                       LOG_SOURCES,
+                                       concurrency=len(LOG_SOURCES))
+
+                for index, result in enumerate(results):
+                    name, origin = LOG_SOURCES[index]
+                    if result["status"] == "success":
+                        tar.add(result["output"], arcname=name)
+                        os.remove(result["output"])
+                        self.logger.info("Successfully collected audit logs from "+origin+" as "+name)
+                    else:
+                        self.logger.info("Failed to collect audit logs from "+origin)
+                        failed_sources.append(origin+": "+str(result["output"]).strip())
 
-        # Active Admin LXC logs
-        result = self.active_admin_to_xr_scp(src="/tmp/ztp_python.log", dest=temp_collection_dir+"/ACTIVE-ADMIN-LXC.audit.log")
-        if result["status"] == "success":
-            self.logger.info("Successfully copied audit logs from Active Admin LXC to Active XR LXC at "+temp_collection_dir+"/ACTIVE-ADMIN-LXC.audit.log")
-        else:
-            self.logger.info("Failed to copy audit logs from Active Admin LXC to Active XR LXC at "+temp_collection_dir+"/ACTIVE-ADMIN-LXC.audit.log")
-            return False
+                if failed_sources:
+                    self.add_to_tar(tar, COLLECTION_ERRORS_FILE,
+                                    "Failed to collect audit logs from:\n"+"\n".join(failed_sources)+"\n")
+        finally:
+            shutil.rmtree(staging_dir, ignore_errors=True)
 
-        # Active Host logs
-        result = self.active_host_to_xr_scp(src="/tmp/ztp_python.log", dest=temp_collection_dir+"/ACTIVE-HOST.audit.log")
-        if result["status"] == "success":
-            self.logger.info("Successfully copied audit logs from Active HOST to Active XR LXC at "+temp_collection_dir+"/ACTIVE-HOST.audit.log")
-        else:
-            self.logger.info("Failed to copy audit logs from Active HOST to Active XR LXC at "+temp_collection_dir+"/ACTIVE-HOST.audit.log")
+        if len(failed_sources) == len(LOG_SOURCES):
+            self.logger.info("Failed to collect audit logs from any of the nodes")
             return False
-
-        # Standby XR-LXC logs
-        result = self.standby_to_active_xr_scp(src="/tmp/ztp_python.log", dest=temp_collection_dir+"/STANDBY-XR-LXC.audit.log")
-        if result["status"] == "success":
-            self.logger.info("Successfully copied audit logs from Standby XR LXC to Active XR LXC at "+temp_collection_dir+"/STANDBY-XR-LXC.audit.log")
         else:
-            self.logger.info("Failed to copy audit logs from Standby XR LXC to Active XR LXC at "+temp_collection_dir+"/STANDBY-XR.audit.log")
-            return False
-
-        # Standby Admin LXC logs
-        result = self.standby_admin_to_xr_scp(src="/tmp/ztp_python.log", dest=temp_collection_dir+"/STANDBY-ADMIN-LXC.audit.log")
-        if result["status"] == "success":
-            self.logger.info("Successfully copied audit logs from Standby ADMIN LXC to Active XR LXC at "+temp_collection_dir+"/STANDBY-ADMIN-LXC.audit.log")
-        else:
-            self.logger.info("Failed to copy audit logs from Standby ADMIN LXC to Active XR LXC at "+temp_collection_dir+"/STANDBY-ADMIN-LXC.audit.log")
-            return False
-
+            return True
 
-        # Standby HOST logs
-        result = self.standby_host_to_xr_scp(src="/tmp/ztp_python.log", dest=temp_collection_dir+"/STANDBY-HOST.audit.log")
-        if result["status"] == "success":
-            self.logger.info("Successfully copied audit logs from Standby HOST to Active XR LXC at "+temp_collection_dir+"/STANDBY-HOST.audit.log")
-        else:
-            self.logger.info("Failed to copy audit logs from Standby HOST to Active XR LXC at "+temp_collection_dir+"/STANDBY-HOST.audit.log")
-            return False
 
-        # Create tarfile out of the collected logs 
-        with tarfile.open(tarfile_output_dir+"/auditor_collated_logs.tar.gz", "w:gz") as tar:
-            tar.add(temp_collection_dir, arcname="")
-         
+    @staticmethod
+    def add_to_tar(tar, name, data):
+        tarinfo = tarfile.TarInfo(name=name)
+        tarinfo.size = len(data)
+        tarinfo.mtime = time.time()
+        tarinfo.mode = 0644
+        tar.addfile(tarinfo, io.BytesIO(data))
 
-        # Remove temp_collection_dir
-        result = self.run_bash(cmd="rm -rf "+temp_collection_dir)
-        if result["status"]:
-            self.logger.info("Failed to remove temporary collection directory for audit logs: "+temp_collection_dir)
-            return False
-        else:
-            return True
-         
 
 
 
@@ -2081,6 +2213,9 @@ if __name__ == "__main__":
                                domain="INSTALLER",
                                request_version=results.version)
 
+    # Tear down the ssh master connections on every exit path
+    atexit.register(audit_obj.close_ssh_masters)
+
     if results.version:
         if audit_obj.version:
             print audit_obj.version["version"]
@@ -2103,8 +2238,7 @@ if __name__ == "__main__":
 
     if results.tarfile_output_dir:
         if os.path.isdir(results.tarfile_output_dir):
-            if not audit_obj.collect_logs(temp_collection_dir="/misc/scratch/auditor_collected_logs",
-                                      tarfile_output_dir=results.tarfile_output_dir):
+            if not audit_obj.collect_logs(tarfile_output_dir=results.tarfile_output_dir):
                 audit_obj.logger.info("Failed to create audit logs tarfile")
                 sys.exit(1)
             else:
@@ -2138,46 +2272,42 @@ if __name__ == "__main__":
                 audit_obj.logger.debug(os.path.join(root,filename))
 
 
-    if not skip_app_cron_op:
-        if not audit_obj.setup_xr_audit(uninstall=results.uninstall):
-            if not results.uninstall:
-                audit_obj.syslogger.info("Failed to setup XR LXC audit artifacts")
-                audit_obj.logger.info("Failed to setup XR LXC audit artifacts")
-            else:
-                audit_obj.syslogger.info("Failed to remove XR LXC audit artifacts")
-                audit_obj.logger.info("Failed to remove XR LXC audit artifacts")
-            sys.exit(1)
-
+    step_descriptions = {"XR" : "XR LXC audit artifacts",
+                         "ADMIN" : "ADMIN LXC audit artifacts",
+                         "HOST" : "HOST audit artifacts",
+                         "COLLECTOR" : "COLLECTOR artifacts",
+                         "STANDBY_AUDITOR" : "auditor app on standby XR LXC",
+                         "STANDBY_XR" : "Standby XR LXC audit artifacts",
+                         "STANDBY_ADMIN" : "Standby Admin LXC audit artifacts",
+                         "STANDBY_HOST" : "Standby HOST audit artifacts",
+                         "STANDBY_COLLECTOR" : "Standby RP COLLECTOR artifacts"}
 
-        if not audit_obj.setup_admin_audit(uninstall=results.uninstall):
-            if not results.uninstall:
-                audit_obj.syslogger.info("Failed to setup ADMIN LXC audit artifacts")
-                audit_obj.logger.info("Failed to setup ADMIN LXC audit artifacts")
-            else:
-                audit_obj.syslogger.info("Failed to remove ADMIN LXC audit artifacts")
-                audit_obj.logger.info("Failed to remove ADMIN LXC audit artifacts")
-            sys.exit(1)
+    def run_steps_or_exit(steps):
+        step_results = audit_obj.run_setup_steps(steps, uninstall=results.uninstall)
 
+        failed_steps = [name for name, method, depends_on in steps
+                        if step_results[name]["status"] != "success"]
 
-        if not audit_obj.setup_host_audit(uninstall=results.uninstall):
+        for name in failed_steps:
             if not results.uninstall:
-                audit_obj.syslogger.info("Failed to setup HOST audit artifacts")
-                audit_obj.logger.info("Failed to setup HOST audit artifacts")
+                audit_obj.syslogger.info("Failed to setup "+step_descriptions[name])
+                audit_obj.logger.info("Failed to setup "+step_descriptions[name])
             else:
-                audit_obj.syslogger.info("Failed to remove HOST audit artifacts")
-                audit_obj.logger.info("Failed to remove XR HOST audit artifacts")
+                audit_obj.syslogger.info("Failed to remove "+step_descriptions[name])
+                audit_obj.logger.info("Failed to remove "+step_descriptions[name])
+
+        if failed_steps:
             sys.exit(1)
 
 
+    if not skip_app_cron_op:
 
-        if not audit_obj.setup_collector(uninstall=results.uninstall):
-            if not results.uninstall:
-                audit_obj.syslogger.info("Failed to setup COLLECTOR artifacts")
-                audit_obj.logger.info("Failed to setup COLLECTOR artifacts")
-            else:
-                audit_obj.syslogger.info("Failed to remove COLLECTOR artifacts")
-                audit_obj.logger.info("Failed to remove COLLECTOR artifacts")
-            sys.exit(1)
+        # The steps of the active RP domains run in parallel
+
+        run_steps_or_exit([("XR", audit_obj.setup_xr_audit, []),
+                           ("ADMIN", audit_obj.setup_admin_audit, []),
+                           ("HOST", audit_obj.setup_host_audit, []),
+                           ("COLLECTOR", audit_obj.setup_collector, [])])
 
 
     # This sleep is added to take care of a condition where cleanup of cronjobs has
@@ -2212,59 +2342,17 @@ if __name__ == "__main__":
 
 
     if audit_obj.ha_setup:
- 
+
         # Replicate itself to standby xr to make sure installer/uninstaller is available
-        # post switchover on an HA(active/standby) setup
+        # post switchover on an HA(active/standby) setup, the steps of the standby RP
+        # domains then run in parallel
 
         if not skip_app_cron_op:
-            if not audit_obj.setup_standby_auditor(uninstall=results.uninstall):
-                if not results.uninstall:
-                    audit_obj.syslogger.info("Failed to setup auditor app on standby XR LXC")
-                    audit_obj.logger.info("Failed to setup auditor app on standby XR LXC")
-                else:
-                    audit_obj.syslogger.info("Failed to remove auditor app on standby XR LXC")
-                    audit_obj.logger.info("Failed to remove auditor app on standby XR LXC")
-                sys.exit(1)
-
-
-            if not audit_obj.setup_standby_xr_audit(uninstall=results.uninstall):
-                if not results.uninstall:
-                    audit_obj.syslogger.info("Failed to setup Standby XR LXC audit artifacts")
-                    audit_obj.logger.info("Failed to setup Standby XR LXC audit artifacts")
-                else:
-                   audit_obj.syslogger.info("Failed to remove Standby XR LXC audit artifacts")
-                   audit_obj.logger.info("Failed to remove Standby XR LXC audit artifacts")
-                sys.exit(1)
-
-
-            if not audit_obj.setup_standby_admin_audit(uninstall=results.uninstall):
-                if not results.uninstall:
-                    audit_obj.syslogger.info("Failed to setup Standby Admin LXC audit artifacts")
-                    audit_obj.logger.info("Failed to setup Standby Admin LXC audit artifacts")
-                else:
-                    audit_obj.syslogger.info("Failed to remove Standby Admin LXC audit artifacts")
-                    audit_obj.logger.info("Failed to remove Standby Admin LXC audit artifacts")
-                sys.exit(1)
-
-
-            if not audit_obj.setup_standby_host_audit(uninstall=results.uninstall):
-                if not results.uninstall:
-                    audit_obj.syslogger.info("Failed to setup Standby HOST audit artifacts")
-                    audit_obj.logger.info("Failed to setup Standby HOST audit artifacts")
-                else:
-                    audit_obj.syslogger.info("Failed to remove Standby HOST audit artifacts")
-                    audit_obj.logger.info("Failed to remove Standby HOST audit artifacts")
-                sys.exit(1)
-
-
-            if not audit_obj.setup_standby_collector(uninstall=results.uninstall):
-                if not results.uninstall:
-                    audit_obj.syslogger.info("Failed to setup Standby RP COLLECTOR artifacts")
-                    audit_obj.logger.info("Failed to setup Standby RP COLLECTOR artifacts")
-                else:
-                    audit_obj.syslogger.info("Failed to remove Standby RP COLLECTOR artifacts")
-                    audit_obj.logger.info("Failed to remove Standby RP COLLECTOR artifacts")
-                sys.exit(1)
+            run_steps_or_exit([("STANDBY_AUDITOR", audit_obj.setup_standby_auditor, []),
+                               ("STANDBY_XR", audit_obj.setup_standby_xr_audit, ["STANDBY_AUDITOR"]),
+                               ("STANDBY_ADMIN", audit_obj.setup_standby_admin_audit, ["STANDBY_AUDITOR"]),
+                               ("STANDBY_HOST", audit_obj.setup_standby_host_audit, ["STANDBY_AUDITOR"]),
+                               ("STANDBY_COLLECTOR", audit_obj.setup_standby_collector, ["STANDBY_AUDITOR"])])
 
 
         # if results.uninstall:
@@ -4,6 +4,9 @@
 from lib.audit_helper import AuditHelpers
 from lib.audit_helper import VALID_DOMAINS
 from lib.audit_helper import COMPLIANCE_PREFIX
+from lib.audit_helper import XML_TEMP_SUFFIX
+from lib.audit_helper import imap_ordered
+from lib.audit_helper import netns_executor
 from pprint import pprint
 import pdb
 import subprocess
@@ -11,16 +14,427 @@ import sys, os
 import shutil, copy
 import datetime, time
 import xmltodict as xd
+from lxml import etree
 import json
-from ctypes import cdll
+from ctypes import cdll, CDLL, get_errno
 import argparse
+import select
+import struct
+import errno
+import zlib
+import bz2
+import hashlib
+import tarfile
+import socket
+import random
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
 
 libc = cdll.LoadLibrary('libc.so.6')
 _setns = libc.setns
 CLONE_NEWNET = 0x40000000
 
-DOMAIN_XML_CREATION_WAIT_INTERVAL = 5 
-DOMAIN_XML_CREATION_WAIT_COUNT = 5
+# Overall time in seconds the collector waits for all the domain XMLs,
+# unless AUDIT_CONFIG COLLECTOR_WAIT_TIMEOUT specifies otherwise. The
+# domain apps publish their XML with a rename, reported by inotify as
+# IN_MOVED_TO. The directories are polled every DOMAIN_XML_POLL_INTERVAL
+# seconds if inotify is not available.
+DEFAULT_COLLECTOR_WAIT_TIMEOUT = 25
+DOMAIN_XML_POLL_INTERVAL = 1
+
+# Domain XMLs are consumed by the collation: they are renamed with this
+# suffix before being read, so that the next run waits for fresh ones
+# instead of collating the same files again.
+COLLATED_XML_SUFFIX = ".collated"
+
+# Optional compression of the uploads (SERVER_CONFIG COMPRESSION), lzma is
+# only offered if the lzma module is available. The server stores the file
+# with COMPRESSION_SUFFIXES appended, or decompresses it on the fly with
+# REMOTE_DECOMPRESS_CMDS.
+COMPRESSION_LEVEL = 6
+COMPRESSION_CHUNK_SIZE = 64*1024
+COMPRESSION_SUFFIXES = {"gzip" : ".gz",
+                        "zlib" : ".zz",
+                        "bz2" : ".bz2",
+                        "lzma" : ".xz"}
+REMOTE_DECOMPRESS_CMDS = {"gzip" : "gzip -dc",
+                          "bz2" : "bzip2 -dc",
+                          "lzma" : "xz -dc"}
+
+# Delta uploads (SERVER_CONFIG DELTA): the last compliance XML sent to the
+# server successfully is kept as the baseline in DIRECTORY and the
+# following runs only upload the DIRECTORY/FILE/CMD entries that changed
+# since, as a COMPLIANCE-DELTA document. A full XML is sent every
+# FULL_EVERY runs, if there is no baseline yet or on request (--full).
+DEFAULT_DELTA_FULL_EVERY = 60
+DEFAULT_DELTA_DIR = "/misc/scratch"
+DELTA_BASELINE_SUFFIX = ".baseline"
+DELTA_STATE_SUFFIX = ".delta_state.json"
+COMPLIANCE_DELTA_VERSION = "1.0.0"
+
+# Compliance XMLs that could not be sent are queued in the spool directory
+# (SERVER_CONFIG SPOOL) and sent as a single tar.gz stream, extracted in
+# REMOTE_DIRECTORY, once the server is reachable again. The oldest files
+# are evicted first when the spool exceeds one of its caps.
+DEFAULT_SPOOL_DIR = "/misc/scratch/compliance_spool"
+DEFAULT_SPOOL_MAX_SIZE_MB = 20
+DEFAULT_SPOOL_MAX_AGE = 86400
+DEFAULT_SPOOL_MAX_FILES = 1440
+DEFAULT_SPOOL_DRAIN_TIMEOUT = 120
+
+# Health of the remote server (SERVER_CONFIG HEALTH), persisted across runs.
+# After FAILURE_THRESHOLD consecutive failed transfers the circuit opens
+# and no transfer is attempted for BACKOFF_BASE seconds, doubling with
+# every further failure up to BACKOFF_MAX. HEALTH_BACKOFF_JITTER spreads
+# the retries of the routers that lost the server at the same time. Every
+# transfer is preceded by a TCP connection check of PROBE_TIMEOUT seconds.
+DEFAULT_HEALTH_DIR = "/misc/scratch"
+DEFAULT_HEALTH_FAILURE_THRESHOLD = 3
+DEFAULT_HEALTH_BACKOFF_BASE = 60
+DEFAULT_HEALTH_BACKOFF_MAX = 3600
+DEFAULT_HEALTH_PROBE_TIMEOUT = 3
+HEALTH_BACKOFF_JITTER = 0.1
+HEALTH_FILE_PREFIX = "server_health"
+
+# Remote servers (SERVER_CONFIG SERVER_HOSTS): with the "all" policy the
+# audit result is sent to every server in parallel, with "first-success"
+# to the servers in order until one of them receives it. Each transfer is
+# killed after the TIMEOUT of its server, DEFAULT_SERVER_TIMEOUT seconds
+# unless specified.
+SERVER_POLICIES = ["all", "first-success"]
+DEFAULT_SERVER_POLICY = "all"
+DEFAULT_SERVER_TIMEOUT = 10
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CLOEXEC = 0x00080000
+INOTIFY_EVENT_HEADER = struct.Struct("iIII")
+
+
+def available_compression_algorithms():
+    algorithms = ["gzip", "zlib", "bz2"]
+    if lzma is not None:
+        algorithms.append("lzma")
+    return algorithms
+
+
+def compressed_chunks(filename, algorithm):
+    """Read filename and yield it compressed with algorithm, one chunk at
+       a time, the file is never held in memory as a whole
+    """
+
+    if algorithm == "gzip":
+        compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif algorithm == "zlib":
+        compressor = zlib.compressobj(COMPRESSION_LEVEL)
+    elif algorithm == "bz2":
+        compressor = bz2.BZ2Compressor(COMPRESSION_LEVEL)
+    elif algorithm == "lzma":
+        compressor = lzma.LZMACompressor()
+    else:
+        raise ValueError("Unsupported compression algorithm: "+str(algorithm))
+
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(COMPRESSION_CHUNK_SIZE), b""):
+            compressed = compressor.compress(chunk)
+            if compressed:
+                yield compressed
+
+    yield compressor.flush()
+
+
+class ChunkWriter(object):
+    """Write-only file object that buffers what is written to it until it
+       is drained, used to stream a tarfile chunk by chunk
+    """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def tar_chunks(filenames):
+    """Yield a tar.gz archive of filenames one chunk at a time, only one
+       file is buffered at any point
+    """
+
+    writer = ChunkWriter()
+    tar = tarfile.open(fileobj=writer, mode="w|gz")
+    try:
+        for filename in filenames:
+            tar.add(filename, arcname=os.path.basename(filename))
+            yield writer.drain()
+    finally:
+        tar.close()
+
+    yield writer.drain()
+
+
+def tcp_socket(host, port):
+    """Resolve host and create a TCP socket to connect to it
+       :return: (socket, address to connect to)
+       :rtype: tuple
+    """
+
+    family, socktype, proto, canonname, address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0]
+    return socket.socket(family, socktype, proto), address
+
+
+def wait_for_files(filenames, timeout):
+    """Wait until all the files exist, or until timeout seconds elapsed.
+       Files are considered complete once they are renamed into place or
+       closed after writing, so half-written files are not picked up.
+       :param filenames: Absolute paths of the files to wait for
+       :param timeout: Overall deadline in seconds
+       :return: List of the files still missing at the deadline
+       :rtype: list
+    """
+
+    deadline = time.time() + timeout
+    missing = set(filename for filename in filenames if not os.path.isfile(filename))
+    if not missing:
+        return []
+
+    try:
+        libc_inotify = CDLL('libc.so.6', use_errno=True)
+        inotify_fd = libc_inotify.inotify_init1(IN_CLOEXEC)
+    except Exception as e:
+        inotify_fd = -1
+
+    if inotify_fd < 0:
+        while missing and time.time() < deadline:
+            time.sleep(min(DOMAIN_XML_POLL_INTERVAL, max(deadline - time.time(), 0)))
+            missing = set(filename for filename in missing if not os.path.isfile(filename))
+        return sorted(missing)
+
+    try:
+        watches = {}
+        for directory in set(os.path.dirname(filename) for filename in missing):
+            wd = libc_inotify.inotify_add_watch(inotify_fd, directory, IN_MOVED_TO | IN_CLOSE_WRITE)
+            if wd < 0:
+                raise OSError(get_errno(), os.strerror(get_errno()))
+            watches[wd] = directory
+
+        # Files may have landed before the watches were in place
+        missing = set(filename for filename in missing if not os.path.isfile(filename))
+
+        while missing:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            try:
+                readable, _, _ = select.select([inotify_fd], [], [], remaining)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not readable:
+                break
+
+            events = os.read(inotify_fd, 64*1024)
+            offset = 0
+            while offset < len(events):
+                wd, mask, cookie, name_len = INOTIFY_EVENT_HEADER.unpack_from(events, offset)
+                offset += INOTIFY_EVENT_HEADER.size
+                name = events[offset:offset+name_len].rstrip("\0")
+                offset += name_len
+                if wd in watches:
+                    missing.discard(os.path.join(watches[wd], name))
+    except Exception as e:
+        # Fall back to checking the files once the watches are unusable
+        while missing and time.time() < deadline:
+            time.sleep(min(DOMAIN_XML_POLL_INTERVAL, max(deadline - time.time(), 0)))
+            missing = set(filename for filename in missing if not os.path.isfile(filename))
+    finally:
+        os.close(inotify_fd)
+
+    return sorted(missing)
+
+
+def detached_copy(elem):
+    """Copy of elem without the namespace declarations inherited from the
+       document it was parsed from, leaf text is stripped like xmltodict does.
+    """
+
+    copy_elem = etree.Element(elem.tag, dict(elem.attrib))
+    copy_elem.tail = elem.tail
+
+    if len(elem) == 0:
+        copy_elem.text = (elem.text or "").strip()
+    else:
+        copy_elem.text = elem.text
+        for child in elem:
+            copy_elem.append(detached_copy(child))
+
+    return copy_elem
+
+
+def copy_xml_element(xf, events, elem, levels=0):
+    """Copy elem to an lxml xmlfile while it is being parsed with iterparse.
+       Called on the "start" event of elem, consumes the events up to its
+       "end". The first levels of nesting are streamed, deeper elements
+       are written out whole and then dropped from the parsed tree.
+    """
+
+    if levels > 0:
+        with xf.element(elem.tag, dict(elem.attrib)):
+            xf.write("\n")
+            for event, node in events:
+                if event == "start":
+                    copy_xml_element(xf, events, node, levels - 1)
+                elif node is elem:
+                    break
+        xf.write("\n")
+    else:
+        for event, node in events:
+            if event == "end" and node is elem:
+                break
+
+        xf.write(detached_copy(elem), pretty_print=True)
+
+    # The parser may still append to elem (its tail), only the elements
+    # preceding it are dropped
+    elem.clear()
+    while elem.getprevious() is not None:
+        del elem.getparent()[0]
+
+
+def copy_integrity_set(xf, events):
+    """Copy the INTEGRITY elements found in the INTEGRITY-SET of a domain
+       dump being parsed with iterparse, one DIRECTORY/FILE at a time.
+       Stops right after the end of the INTEGRITY-SET.
+    """
+
+    for event, node in events:
+        if event == "start" and node.tag == "INTEGRITY-SET":
+            integrity_set = node
+            break
+    else:
+        return
+
+    for event, node in events:
+        if event == "start":
+            # INTEGRITY > DIRECTORIES/FILES > DIRECTORY/FILE
+            copy_xml_element(xf, events, node, levels=2)
+        elif node is integrity_set:
+            break
+
+
+def iter_compliance_entries(xml_file):
+    """Parse a compliance XML with iterparse and yield (domain, element)
+       for every DIRECTORY/FILE element and (None, element) for GENERAL.
+       The elements are dropped from the parsed tree once the caller is
+       done with them.
+    """
+
+    domain = None
+    for event, elem in etree.iterparse(xml_file, events=("start", "end")):
+        if event == "start":
+            if elem.tag == "INTEGRITY":
+                domain = elem.get("domain")
+            continue
+
+        if elem.tag in ["DIRECTORY", "FILE"]:
+            yield domain, elem
+        elif elem.tag == "GENERAL":
+            yield None, elem
+        else:
+            continue
+
+        elem.clear()
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+def entry_fields(elem):
+    """Split a DIRECTORY/FILE element into the fields compared by the delta
+       uploads: CHECKSUM, CONTENT and one ("CMD", request, occurrence) per
+       command. Returns a dictionary of field -> element.
+    """
+
+    fields = {}
+    for child in elem:
+        if child.tag in ["CHECKSUM", "CONTENT"]:
+            fields[(child.tag,)] = child
+        elif child.tag == "CMD-LIST":
+            occurrences = {}
+            for cmd in child:
+                request = (cmd.findtext("REQUEST") or "").strip()
+                occurrences[request] = occurrences.get(request, 0) + 1
+                fields[("CMD", request, occurrences[request])] = cmd
+
+    return fields
+
+
+def field_digest(value):
+    """md5 digest of a field returned by entry_fields, the baseline is
+       indexed with digests so that its content is never kept in memory
+    """
+
+    return hashlib.md5(etree.tostring(detached_copy(value), encoding="utf-8")).hexdigest()
+
+
+def delta_element(domain, elem, change, changed_fields=None, baseline_digests=None):
+    """Build the COMPLIANCE-DELTA element of a DIRECTORY/FILE entry.
+       Added entries are copied whole, modified entries only carry their
+       NAME and the fields that were added, changed or removed compared to
+       baseline_digests, removed entries only their NAME.
+    """
+
+    if change == "added":
+        delta = detached_copy(elem)
+        delta.tail = None
+    else:
+        delta = etree.Element(elem.tag)
+        name = etree.SubElement(delta, "NAME")
+        name.text = (elem.findtext("NAME") or "").strip()
+
+    delta.set("domain", domain or "")
+    delta.set("change", change)
+
+    if change != "modified":
+        return delta
+
+    removed_fields = [field for field in baseline_digests if field not in entry_fields(elem)]
+
+    cmd_list = None
+    for field in sorted(changed_fields) + sorted(removed_fields):
+        if field in changed_fields:
+            value = detached_copy(changed_fields[field])
+            value.tail = None
+            if field in baseline_digests:
+                value.set("change", "modified")
+            else:
+                value.set("change", "added")
+        else:
+            value = etree.Element(field[0])
+            value.set("change", "removed")
+            if field[0] == "CMD":
+                request = etree.SubElement(value, "REQUEST")
+                request.text = field[1]
+
+        if field[0] == "CMD":
+            if cmd_list is None:
+                cmd_list = etree.SubElement(delta, "CMD-LIST")
+            cmd_list.append(value)
+        else:
+            delta.append(value)
+
+    return delta
 
 
 class IosxrAuditMain(AuditHelpers):
@@ -38,6 +452,9 @@ class IosxrAuditMain(AuditHelpers):
         #    if not self.server_cfg_dict:
         #        self.exit = True
 
+        # Set by collector --full, cleared once a full XML reaches the server
+        self.force_full_upload = False
+
         self.compliance_xmlname_parameters = { "router_hostname" : self.get_hostname_string,
                                                "router_ip" : self.get_ip_dashed}
 
@@ -60,40 +477,39 @@ class IosxrAuditMain(AuditHelpers):
             else:
                 self.id_rsa_file = "/misc/scratch/id_rsa_server" 
 
-            # Extract the Remote user for Server connection over SSH
-            self.remote_user = self.server_cfg_dict["USER"]
-
-            # Extract the directory on the remote server where the final compliance
-            # file should be placed.
-            self.remote_directory = self.server_cfg_dict["REMOTE_DIRECTORY"]
-             
-
-            # Extract the remote Server's domain name or IP address
+            # Extract the remote servers: SERVER_HOSTS lists several destinations
+            # used according to SERVER_POLICY, SERVER_HOST a single one. The
+            # USER, REMOTE_DIRECTORY and SERVER_SSH_PORT settings are the
+            # defaults of every destination.
 
-            self.server_connection = self.server_cfg_dict["SERVER_HOST"]["CONNECTION"]
-            
-            if "CONNECTION_TYPE" in self.server_cfg_dict["SERVER_HOST"]:
-                self.server_connection_type = self.server_cfg_dict["SERVER_HOST"]["CONNECTION_TYPE"]
+            if "SERVER_HOSTS" in self.server_cfg_dict:
+                server_hosts = self.server_cfg_dict["SERVER_HOSTS"]
             else:
-                self.server_connection_type = "IP"
+                server_hosts = [self.server_cfg_dict["SERVER_HOST"]]
 
+            self.destinations = []
+            for server_host in server_hosts:
+                destination = self.parse_destination(server_host)
+                if destination is None:
+                    self.exit = True
+                else:
+                    self.destinations.append(destination)
 
-            # Extract the remote server's SSH port
-            if "SERVER_SSH_PORT" in self.server_cfg_dict:
-                self.server_ssh_port = self.server_cfg_dict["SERVER_SSH_PORT"]
-            else:
-                self.server_ssh_port ="22"
+            if not self.destinations:
+                raise ValueError("No remote server specified")
 
+            self.server_policy = self.server_cfg_dict.get("SERVER_POLICY", DEFAULT_SERVER_POLICY)
+            if self.server_policy not in SERVER_POLICIES:
+                self.syslogger.info("Invalid SERVER_POLICY: "+str(self.server_policy)+", aborting")
+                self.exit = True
 
-            # Extract the Domain Name Server to configure if CONNECTION_TYPE = "DOMAIN_NAME"
-            if self.server_connection_type == "DOMAIN_NAME":
-                if "DOMAIN_NAME_SERVER" in self.server_cfg_dict["SERVER_HOST"]:
-                    self.dns = self.server_cfg_dict["SERVER_HOST"]["DOMAIN_NAME_SERVER"]
-                else:
-                    self.syslogger.info("No DNS server specified when server connection type is DOMAIN_NAME, aborting")
-                    self.exit = True
-            else:
-                self.dns = ""
+            # The first destination is the default one of send_to_server
+            self.remote_user = self.destinations[0]["user"]
+            self.remote_directory = self.destinations[0]["remote_directory"]
+            self.server_connection = self.destinations[0]["connection"]
+            self.server_connection_type = self.destinations[0]["connection_type"]
+            self.server_ssh_port = self.destinations[0]["port"]
+            self.dns = self.destinations[0]["dns"]
 
 
 
@@ -120,6 +536,55 @@ class IosxrAuditMain(AuditHelpers):
             self.exit = True
 
 
+    def parse_destination(self, server_host):
+        """Build a destination from a SERVER_HOST/SERVER_HOSTS entry
+           :return: dictionary with the connection parameters of the
+                    destination, None if the entry is not valid
+           :rtype: dict
+        """
+
+        destination = {}
+
+        # Extract the Remote user for Server connection over SSH
+        destination["user"] = server_host.get("USER", self.server_cfg_dict.get("USER"))
+
+        # Extract the directory on the remote server where the final compliance
+        # file should be placed.
+        destination["remote_directory"] = server_host.get("REMOTE_DIRECTORY",
+                                                          self.server_cfg_dict.get("REMOTE_DIRECTORY"))
+
+        # Extract the remote Server's domain name or IP address
+        destination["connection"] = server_host.get("CONNECTION")
+
+        for key in ["user", "remote_directory", "connection"]:
+            if destination[key] is None:
+                self.syslogger.info("No "+key+" specified for remote server "+str(server_host))
+                return None
+
+        destination["connection_type"] = server_host.get("CONNECTION_TYPE", "IP")
+
+        # Extract the remote server's SSH port
+        destination["port"] = server_host.get("SSH_PORT", self.server_cfg_dict.get("SERVER_SSH_PORT", "22"))
+
+        try:
+            destination["timeout"] = max(int(server_host["TIMEOUT"]), 1)
+        except Exception as e:
+            destination["timeout"] = DEFAULT_SERVER_TIMEOUT
+
+        # Extract the Domain Name Server to configure if CONNECTION_TYPE = "DOMAIN_NAME"
+        if destination["connection_type"] == "DOMAIN_NAME":
+            if "DOMAIN_NAME_SERVER" in server_host:
+                destination["dns"] = server_host["DOMAIN_NAME_SERVER"]
+            else:
+                self.syslogger.info("No DNS server specified when server connection type is DOMAIN_NAME, aborting")
+                return None
+        else:
+            destination["dns"] = ""
+
+        destination["name"] = str(destination["connection"])+"_"+str(destination["port"])
+        return destination
+
+
     def _copy_file(self, src=None, dest=None):
 
         try:
@@ -134,6 +599,597 @@ class IosxrAuditMain(AuditHelpers):
             self.syslogger.info('Failed to copy file, Error: %s' % e.strerror)
             return False
 
+    def get_collector_wait_timeout(self):
+        try:
+            timeout = int(self.audit_cfg_dict["COLLECTOR_WAIT_TIMEOUT"])
+        except Exception as e:
+            timeout = DEFAULT_COLLECTOR_WAIT_TIMEOUT
+
+        return max(timeout, 0)
+
+
+    def get_compression_cfg(self):
+        """SERVER_CONFIG COMPRESSION settings
+           :return: (algorithm or None if uploads are not compressed,
+                     True if the server decompresses the upload)
+           :rtype: tuple
+        """
+
+        try:
+            compression_cfg = self.server_cfg_dict["COMPRESSION"]
+        except Exception as e:
+            compression_cfg = {}
+
+        if not compression_cfg.get("ENABLE", False):
+            return None, False
+
+        algorithm = str(compression_cfg.get("ALGORITHM", "none")).lower()
+        if algorithm == "none":
+            return None, False
+
+        if algorithm not in available_compression_algorithms():
+            self.syslogger.info("Compression algorithm "+algorithm+" not available, sending uncompressed")
+            return None, False
+
+        remote_decompress = bool(compression_cfg.get("REMOTE_DECOMPRESS", False))
+        if remote_decompress and algorithm not in REMOTE_DECOMPRESS_CMDS:
+            self.syslogger.info("No decompressor for "+algorithm+" on the server, storing it compressed")
+            remote_decompress = False
+
+        return algorithm, remote_decompress
+
+
+    def get_delta_cfg(self):
+        try:
+            delta_cfg = self.server_cfg_dict["DELTA"]
+        except Exception as e:
+            delta_cfg = {}
+
+        try:
+            full_every = int(delta_cfg["FULL_EVERY"])
+        except Exception as e:
+            full_every = DEFAULT_DELTA_FULL_EVERY
+
+        try:
+            delta_dir = delta_cfg["DIRECTORY"]
+        except Exception as e:
+            delta_dir = DEFAULT_DELTA_DIR
+
+        file_prefix = os.path.join(delta_dir, self.compliance_xmlname)
+
+        return {"enable" : bool(delta_cfg.get("ENABLE", False)),
+                "full_every" : max(full_every, 0),
+                "baseline" : file_prefix + DELTA_BASELINE_SUFFIX,
+                "state" : file_prefix + DELTA_STATE_SUFFIX}
+
+
+    def load_delta_state(self, delta_cfg):
+        try:
+            with open(delta_cfg["state"], 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            return {"deltas_since_full" : 0}
+
+
+    def save_delta_state(self, delta_cfg, state):
+        try:
+            tmp_file = delta_cfg["state"] + ".tmp"
+            with open(tmp_file, 'w') as f:
+                json.dump(state, f)
+            os.rename(tmp_file, delta_cfg["state"])
+        except Exception as e:
+            self.syslogger.info("Failed to save the delta upload state, Error: "+str(e))
+
+
+    def create_delta_xml(self, xml_file, baseline_file, output_file):
+        """Write the COMPLIANCE-DELTA document of xml_file against
+           baseline_file to output_file. Both documents are streamed, the
+           baseline is indexed by (domain, tag, NAME) with field digests.
+           :return: True if the delta document was written
+           :rtype: bool
+        """
+
+        temp_file = output_file + XML_TEMP_SUFFIX
+
+        try:
+            baseline = {}
+            baseline_date = ""
+            for domain, elem in iter_compliance_entries(baseline_file):
+                if domain is None:
+                    baseline_date = (elem.findtext("DATE") or "").strip()
+                else:
+                    key = (domain, elem.tag, (elem.findtext("NAME") or "").strip())
+                    baseline[key] = dict((field, field_digest(value))
+                                         for field, value in entry_fields(elem).iteritems())
+
+            with open(temp_file, 'wb') as f:
+                with etree.xmlfile(f, encoding='utf-8') as xf:
+                    xf.write_declaration()
+                    with xf.element("COMPLIANCE-DELTA", {"version" : COMPLIANCE_DELTA_VERSION,
+                                                         "baseline-date" : baseline_date}):
+                        xf.write("\n")
+                        for domain, elem in iter_compliance_entries(xml_file):
+                            if domain is None:
+                                general = detached_copy(elem)
+                                general.tail = None
+                                xf.write(general, pretty_print=True)
+                                continue
+
+                            key = (domain, elem.tag, (elem.findtext("NAME") or "").strip())
+                            if key not in baseline:
+                                xf.write(delta_element(domain, elem, "added"), pretty_print=True)
+                                continue
+
+                            baseline_digests = baseline.pop(key)
+                            fields = entry_fields(elem)
+                            changed_fields = dict((field, value) for field, value in fields.iteritems()
+                                                  if baseline_digests.get(field) != field_digest(value))
+                            if changed_fields or set(baseline_digests) - set(fields):
+                                xf.write(delta_element(domain, elem, "modified",
+                                                       changed_fields, baseline_digests),
+                                         pretty_print=True)
+
+                        for domain, tag, name in sorted(baseline):
+                            removed = etree.Element(tag)
+                            etree.SubElement(removed, "NAME").text = name
+                            xf.write(delta_element(domain, removed, "removed"), pretty_print=True)
+
+            os.rename(temp_file, output_file)
+        except Exception as e:
+            self.syslogger.info("Failed to create the delta XML, Error: %s" % e)
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            return False
+
+        return True
+
+
+    def prepare_upload(self, xml_file):
+        """Pick the document to send to the server for this run: the full
+           compliance XML or its delta against the last acknowledged one.
+           :return: {"file" : path to send, "remote_name" : name on the
+                     server, "full" : True if xml_file itself is sent}
+           :rtype: dict
+        """
+
+        full_upload = {"file" : xml_file,
+                       "remote_name" : os.path.basename(self.compliance_xmlname),
+                       "full" : True}
+
+        delta_cfg = self.get_delta_cfg()
+        if not delta_cfg["enable"]:
+            return full_upload
+
+        state = self.load_delta_state(delta_cfg)
+        deltas_since_full = state.get("deltas_since_full", 0)
+
+        if self.force_full_upload:
+            self.syslogger.info("Full compliance XML requested, skipping the delta")
+            return full_upload
+
+        if not os.path.isfile(delta_cfg["baseline"]):
+            self.syslogger.info("No delta baseline yet, sending the full compliance XML")
+            return full_upload
+
+        if delta_cfg["full_every"] and deltas_since_full + 1 >= delta_cfg["full_every"]:
+            self.syslogger.info("Sending the periodic full compliance XML")
+            return full_upload
+
+        # Deltas are numbered from the last full XML, the server applies
+        # them in order on top of it
+        remote_name = (os.path.splitext(self.compliance_xmlname)[0]+
+                       "_delta_"+str(deltas_since_full + 1)+".xml")
+        delta_file = os.path.join(os.path.dirname(xml_file), remote_name)
+
+        if not self.create_delta_xml(xml_file, delta_cfg["baseline"], delta_file):
+            return full_upload
+
+        return {"file" : delta_file,
+                "remote_name" : remote_name,
+                "full" : False}
+
+
+    def reset_delta_baseline(self):
+        """Drop the delta baseline, e.g. when only some of the servers
+           received the last upload, so that the next run sends a full XML
+        """
+
+        delta_cfg = self.get_delta_cfg()
+
+        try:
+            if os.path.exists(delta_cfg["baseline"]):
+                os.remove(delta_cfg["baseline"])
+        except OSError as e:
+            self.syslogger.info("Failed to remove the delta baseline, Error: "+str(e))
+
+
+    def update_delta_baseline(self, xml_file, full):
+        """Called once the server acknowledged an upload, xml_file becomes
+           the baseline of the next delta
+        """
+
+        if full:
+            self.force_full_upload = False
+
+        delta_cfg = self.get_delta_cfg()
+        if not delta_cfg["enable"]:
+            return
+
+        try:
+            tmp_file = delta_cfg["baseline"] + ".tmp"
+            shutil.copyfile(xml_file, tmp_file)
+            os.rename(tmp_file, delta_cfg["baseline"])
+        except Exception as e:
+            self.syslogger.info("Failed to update the delta baseline, Error: "+str(e))
+            # Without a baseline the next run sends the full XML
+            if os.path.exists(delta_cfg["baseline"]):
+                os.remove(delta_cfg["baseline"])
+            return
+
+        state = self.load_delta_state(delta_cfg)
+        if full:
+            state["deltas_since_full"] = 0
+        else:
+            state["deltas_since_full"] = state.get("deltas_since_full", 0) + 1
+        self.save_delta_state(delta_cfg, state)
+
+
+    def get_spool_cfg(self, spool_name=None):
+        """SPOOL settings, spool_name selects a subdirectory of the spool
+           directory (one per server with the "all" policy)
+        """
+
+        try:
+            spool_cfg = self.server_cfg_dict["SPOOL"]
+        except Exception as e:
+            spool_cfg = {}
+
+        limits = {}
+        for key, default in [("MAX_SIZE_MB", DEFAULT_SPOOL_MAX_SIZE_MB),
+                             ("MAX_AGE", DEFAULT_SPOOL_MAX_AGE),
+                             ("MAX_FILES", DEFAULT_SPOOL_MAX_FILES),
+                             ("DRAIN_TIMEOUT", DEFAULT_SPOOL_DRAIN_TIMEOUT)]:
+            try:
+                limits[key] = max(int(spool_cfg[key]), 0)
+            except Exception as e:
+                limits[key] = default
+
+        spool_dir = spool_cfg.get("DIRECTORY", DEFAULT_SPOOL_DIR)
+        if spool_name is not None:
+            spool_dir = os.path.join(spool_dir, spool_name)
+
+        return {"enable" : bool(spool_cfg.get("ENABLE", True)),
+                "directory" : spool_dir,
+                "max_size" : limits["MAX_SIZE_MB"]*1024*1024,
+                "max_age" : limits["MAX_AGE"],
+                "max_files" : limits["MAX_FILES"],
+                "drain_timeout" : limits["DRAIN_TIMEOUT"]}
+
+
+    def spooled_files(self, spool_cfg):
+        """Files queued in the spool directory, oldest first"""
+
+        try:
+            filenames = [os.path.join(spool_cfg["directory"], filename)
+                         for filename in os.listdir(spool_cfg["directory"])
+                         if not filename.endswith(XML_TEMP_SUFFIX)]
+        except OSError as e:
+            return []
+
+        files = []
+        for filename in filenames:
+            try:
+                stat = os.stat(filename)
+            except OSError as e:
+                continue
+            if not os.path.isfile(filename):
+                continue
+            files.append((stat.st_mtime, filename, stat.st_size))
+
+        return [(filename, size) for mtime, filename, size in sorted(files)]
+
+
+    def evict_spool(self, spool_cfg):
+        """Drop the spooled files older than the age cap, then the oldest
+           ones until the spool is within its size and count caps. A cap
+           set to 0 is not enforced.
+        """
+
+        files = self.spooled_files(spool_cfg)
+        total_size = sum(size for filename, size in files)
+        now = time.time()
+
+        evicted = []
+        for filename, size in files:
+            try:
+                too_old = spool_cfg["max_age"] and os.path.getmtime(filename) + spool_cfg["max_age"] < now
+            except OSError as e:
+                continue
+
+            too_big = spool_cfg["max_size"] and total_size > spool_cfg["max_size"]
+            too_many = spool_cfg["max_files"] and len(files) - len(evicted) > spool_cfg["max_files"]
+
+            if too_old or too_big or too_many:
+                try:
+                    os.remove(filename)
+                except OSError as e:
+                    continue
+                evicted.append(filename)
+                total_size = total_size - size
+
+        if evicted:
+            self.syslogger.info("Evicted "+str(len(evicted))+" file(s) from the spool: "+
+                                ", ".join(os.path.basename(filename) for filename in evicted))
+
+
+    def spool_result(self, filename, remote_name, spool_name=None):
+        """Queue a compliance XML that could not be sent, under its remote
+           name suffixed with the time it was spooled
+        """
+
+        spool_cfg = self.get_spool_cfg(spool_name)
+        if not spool_cfg["enable"]:
+            return False
+
+        name, ext = os.path.splitext(remote_name)
+        spool_file = os.path.join(spool_cfg["directory"],
+                                  name+"_"+datetime.datetime.now().strftime("%Y%m%d%H%M%S")+ext)
+
+        try:
+            if not os.path.isdir(spool_cfg["directory"]):
+                os.makedirs(spool_cfg["directory"])
+            shutil.copyfile(filename, spool_file + XML_TEMP_SUFFIX)
+            os.rename(spool_file + XML_TEMP_SUFFIX, spool_file)
+        except Exception as e:
+            self.syslogger.info("Failed to spool "+str(filename)+", Error: "+str(e))
+            return False
+
+        self.syslogger.info("Spooled undelivered audit result as "+spool_file)
+        self.evict_spool(spool_cfg)
+        return True
+
+
+    def drain_spool(self, vrf="global-vrf", destination=None, spool_name=None):
+        """Send all the spooled files to the server in one ssh session, as
+           a tar.gz stream extracted in the remote directory. The files are
+           removed from the spool once the transfer succeeded.
+           :return: True if the spool is empty
+           :rtype: bool
+        """
+
+        if destination is None:
+            destination = self.destinations[0]
+
+        spool_cfg = self.get_spool_cfg(spool_name)
+        if not spool_cfg["enable"]:
+            return True
+
+        self.evict_spool(spool_cfg)
+        filenames = [filename for filename, size in self.spooled_files(spool_cfg)]
+        if not filenames:
+            return True
+
+        self.syslogger.info("Sending "+str(len(filenames))+" spooled audit result(s) to Remote Server "+destination["name"])
+
+        cmd = self.server_ssh_cmd(destination) + " \"tar -xzf - -C "+destination["remote_directory"]+"\""
+
+        try:
+            result = self.run_bash_timed(cmd, spool_cfg["drain_timeout"], vrf=vrf,
+                                         stdin_chunks=tar_chunks(filenames))
+        except Exception as e:
+            self.syslogger.info("Failed to send the spooled audit results, Error: "+str(e))
+            return False
+
+        if result["status"]:
+            self.syslogger.info("Failed to send the spooled audit results, Error: "+result["error"])
+            return False
+
+        for filename in filenames:
+            try:
+                os.remove(filename)
+            except OSError as e:
+                pass
+
+        self.syslogger.info("Successfully sent "+str(len(filenames))+" spooled audit result(s) to Remote Server "+destination["name"])
+        return True
+
+
+    def get_health_cfg(self):
+        try:
+            health_cfg = self.server_cfg_dict["HEALTH"]
+        except Exception as e:
+            health_cfg = {}
+
+        limits = {}
+        for key, default in [("FAILURE_THRESHOLD", DEFAULT_HEALTH_FAILURE_THRESHOLD),
+                             ("BACKOFF_BASE", DEFAULT_HEALTH_BACKOFF_BASE),
+                             ("BACKOFF_MAX", DEFAULT_HEALTH_BACKOFF_MAX),
+                             ("PROBE_TIMEOUT", DEFAULT_HEALTH_PROBE_TIMEOUT)]:
+            try:
+                limits[key] = max(int(health_cfg[key]), 0)
+            except Exception as e:
+                limits[key] = default
+
+        return {"enable" : bool(health_cfg.get("ENABLE", True)),
+                "directory" : health_cfg.get("DIRECTORY", DEFAULT_HEALTH_DIR),
+                "failure_threshold" : max(limits["FAILURE_THRESHOLD"], 1),
+                "backoff_base" : limits["BACKOFF_BASE"],
+                "backoff_max" : limits["BACKOFF_MAX"],
+                "probe_timeout" : limits["PROBE_TIMEOUT"]}
+
+
+    def server_health_file(self, health_cfg, server, port):
+        return os.path.join(health_cfg["directory"],
+                            HEALTH_FILE_PREFIX+"_"+str(server)+"_"+str(port)+".json")
+
+
+    def load_server_health(self, health_cfg, server, port):
+        try:
+            with open(self.server_health_file(health_cfg, server, port), 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            return {"failures" : 0, "open_until" : 0}
+
+
+    def save_server_health(self, health_cfg, server, port, health):
+        health_file = self.server_health_file(health_cfg, server, port)
+
+        try:
+            tmp_file = health_file + ".tmp"
+            with open(tmp_file, 'w') as f:
+                json.dump(health, f)
+            os.rename(tmp_file, health_file)
+        except Exception as e:
+            self.syslogger.info("Failed to save the server health state, Error: "+str(e))
+
+
+    def probe_server(self, server, port, timeout):
+        """Open and close a TCP connection to the ssh port of the server
+           from the network namespace of the collector's vrf
+           :return: True if the server accepted the connection
+           :rtype: bool
+        """
+
+        try:
+            # The socket is created in the namespace, connecting is left
+            # to this thread so that the namespace worker isn't held up
+            sock, address = netns_executor.call(self.get_netns_path(nsname=self.vrf),
+                                                tcp_socket, server, int(port))
+            try:
+                sock.settimeout(timeout)
+                sock.connect(address)
+            finally:
+                sock.close()
+            return True
+        except Exception as e:
+            self.syslogger.info("Remote Server "+str(server)+":"+str(port)+
+                                " not reachable, Error: "+str(e))
+            return False
+
+
+    def check_server_health(self, server, port):
+        """Decide whether a transfer to server should be attempted: not
+           while its circuit is open, and only if the connection check
+           succeeds. A failed connection check counts as a failed transfer.
+           :return: True if the transfer should go ahead
+           :rtype: bool
+        """
+
+        health_cfg = self.get_health_cfg()
+        if not health_cfg["enable"]:
+            return True
+
+        health = self.load_server_health(health_cfg, server, port)
+
+        if health.get("open_until", 0) > time.time():
+            self.syslogger.info("Remote Server "+str(server)+":"+str(port)+" marked down until "+
+                                time.ctime(health["open_until"])+", skipping transfer")
+            return False
+
+        if not self.probe_server(server, port, health_cfg["probe_timeout"]):
+            self.record_server_health(server, port, False)
+            return False
+
+        return True
+
+
+    def record_server_health(self, server, port, success):
+        """Update the health of server after a transfer, opening its circuit
+           with an exponential backoff once too many transfers failed in a row
+        """
+
+        health_cfg = self.get_health_cfg()
+        if not health_cfg["enable"]:
+            return
+
+        health = self.load_server_health(health_cfg, server, port)
+
+        if success:
+            if health.get("failures", 0):
+                self.syslogger.info("Remote Server "+str(server)+":"+str(port)+" is reachable again")
+            health = {"failures" : 0, "open_until" : 0}
+        else:
+            health["failures"] = health.get("failures", 0) + 1
+            excess_failures = health["failures"] - health_cfg["failure_threshold"]
+
+            if excess_failures >= 0:
+                backoff = min(health_cfg["backoff_base"] * 2 ** min(excess_failures, 32),
+                              health_cfg["backoff_max"])
+                backoff = backoff * (1 + random.uniform(0, HEALTH_BACKOFF_JITTER))
+                health["open_until"] = time.time() + backoff
+                self.syslogger.info("Remote Server "+str(server)+":"+str(port)+" failed "+
+                                    str(health["failures"])+" time(s) in a row, skipping transfers for "+
+                                    str(int(backoff))+" seconds")
+
+        self.save_server_health(health_cfg, server, port, health)
+
+
+    def upload_to_destination(self, upload, destination, vrf="global-vrf", spool_name=None):
+        """Send an upload (see prepare_upload) to one destination, after
+           its spooled backlog, unless the destination is marked down
+           :return: True if the destination received the upload
+           :rtype: bool
+        """
+
+        server = destination["connection"]
+        port = destination["port"]
+
+        if not self.check_server_health(server, port):
+            return False
+
+        transferred = (self.drain_spool(vrf=vrf, destination=destination, spool_name=spool_name) and
+                       not self.send_to_server(upload["file"], vrf=vrf, timeout=destination["timeout"],
+                                               remote_name=upload["remote_name"], destination=destination))
+        self.record_server_health(server, port, transferred)
+
+        if not transferred:
+            self.syslogger.info("Failed to send audit result to Remote Server "+destination["name"])
+
+        return transferred
+
+
+    def upload_result(self, upload, vrf="global-vrf"):
+        """Send an upload to the destinations according to SERVER_POLICY.
+           With "all" the destinations are handled in parallel and each of
+           them spools what it could not receive, with "first-success"
+           they are tried in order and the upload is spooled if none of
+           them received it.
+           :return: {"status" : "success" if the policy is satisfied,
+                     "output" : names of the destinations that received it}
+           :rtype: dict
+        """
+
+        if self.server_policy == "all":
+            def handler(destination):
+                if self.upload_to_destination(upload, destination, vrf=vrf,
+                                              spool_name=destination["name"]):
+                    return True
+                self.spool_result(upload["file"], upload["remote_name"], spool_name=destination["name"])
+                return False
+
+            results = list(imap_ordered(handler, self.destinations, len(self.destinations)))
+            received = [destination["name"] for destination, result in zip(self.destinations, results) if result]
+
+            if len(received) == len(self.destinations):
+                return {"status" : "success", "output" : received}
+        else:
+            for destination in self.destinations:
+                if self.upload_to_destination(upload, destination, vrf=vrf):
+                    return {"status" : "success", "output" : [destination["name"]]}
+
+            self.spool_result(upload["file"], upload["remote_name"])
+            received = []
+
+        return {"status" : "error", "output" : received}
+
+
+    def server_ssh_cmd(self, destination):
+        ssh_cmd =  "ssh -i "+ os.path.abspath(self.id_rsa_file)
+        ssh_cmd =  ssh_cmd + " -p "+str(destination["port"])+" -o StrictHostKeyChecking=no "
+        ssh_cmd =  ssh_cmd + destination["user"]+"@"+destination["connection"]
+        return ssh_cmd
+
+
     def get_hostname_string(self):
         hostname = self.get_host()
         if not hostname:
@@ -159,80 +1215,125 @@ class IosxrAuditMain(AuditHelpers):
             self.syslogger.info("output_xml_dir for collector not provided, bailing out")
             return {}
 
-        collated_xml_dict = {}
-        xml_dict = {}
-        integrity_list = []
-
+        xml_files = {}
+        xr_element = None
         for element in domain_dict:
             if domain_dict[element]["domain"] in VALID_DOMAINS:
-                xml_file = domain_dict[element]["input_xml_dir"]+"/"+domain_dict[element]["domain"]+".xml"
-
-                wait_counter = 0
-                file_found = False
-                while(wait_counter < DOMAIN_XML_CREATION_WAIT_COUNT):
-                    self.syslogger.info("Check to see if xml_file: "+xml_file+" exists before collating")
-                    if self.debug:
-                        self.logger.debug("Check to see if xml_file: "+xml_file+" exists before collating")
-                    if os.path.isfile(xml_file):
-                        file_found = True
-                        self.syslogger.info("File "+xml_file+" found")
-                        if self.debug:
-                            self.logger.debug("File: "+xml_file+" found")
-                        xml_dict = self.xml_to_dict(xml_file)
-                        break
-                    else:
-                        # Wait DOMAIN_XML_CREATION_WAIT_INTERVAL seconds before trying again
-                        self.syslogger.info("File "+xml_file+" not found, retrying")
-                        if self.debug:
-                            self.logger.debug("File: "+xml_file+" not found, retrying")
-                        time.sleep(DOMAIN_XML_CREATION_WAIT_INTERVAL)
-                    wait_counter = wait_counter + 1
-
-                integrity_list.append(xml_dict["COMPLIANCE-DUMP"]["INTEGRITY-SET"]["INTEGRITY"])
+                xml_files[element] = domain_dict[element]["input_xml_dir"]+"/"+domain_dict[element]["domain"]+".xml"
                 if domain_dict[element]["domain"] == "XR-LXC":
-                    collated_xml_dict = copy.deepcopy(xml_dict)
+                    xr_element = element
             else:
-                self.syslogger.info("Invalid domain specified: "+str(domain))
+                self.syslogger.info("Invalid domain specified: "+str(domain_dict[element]["domain"]))
                 return {}
 
-        collated_xml_dict["COMPLIANCE-DUMP"]["INTEGRITY-SET"].pop("INTEGRITY", None)
-        collated_xml_dict["COMPLIANCE-DUMP"]["INTEGRITY-SET"]["INTEGRITY"] = integrity_list
+        if xr_element is None:
+            self.syslogger.info("No XR-LXC domain to collate the other domains into, bailing out")
+            return {}
+
+        # The INTEGRITY elements are collated in the order of VALID_DOMAINS
+        # (XR-LXC, ADMIN-LXC, HOST), whatever the order of domain_dict
+        elements = sorted(domain_dict, key=lambda element: VALID_DOMAINS.index(domain_dict[element]["domain"]))
+
+        # Wait for all the domain XMLs at once, collation starts as soon as
+        # the last one lands
+
+        self.syslogger.info("Waiting for domain XML files: "+", ".join(sorted(xml_files.values())))
+        missing_files = wait_for_files(xml_files.values(), self.get_collector_wait_timeout())
 
-        collated_xml_dump = xd.unparse(collated_xml_dict, pretty=True)
+        if missing_files:
+            self.syslogger.info("Domain XML files not found, bailing out: "+", ".join(missing_files))
+            if self.debug:
+                self.logger.debug("Domain XML files not found: "+", ".join(missing_files))
+            return {}
+
+        # Take the domain XMLs out of the way of the domain apps, whatever
+        # they publish from now on is left for the next run
+
+        try:
+            for element in xml_files:
+                os.rename(xml_files[element], xml_files[element] + COLLATED_XML_SUFFIX)
+                xml_files[element] = xml_files[element] + COLLATED_XML_SUFFIX
+        except OSError as e:
+            self.syslogger.info("Failed to consume domain XML files, Error: %s" % e)
+            return {}
 
-        if self.debug:
-            self.logger.debug(collated_xml_dump)
+        # The collated XML is the XR-LXC dump with the INTEGRITY elements of
+        # all the domains in its INTEGRITY-SET. The domain XMLs are streamed
+        # in one DIRECTORY/FILE element at a time.
 
         output_file = output_xml_dir+"/"+ self.compliance_xmlname
+        temp_file = output_file + XML_TEMP_SUFFIX
 
-        with open(output_file, 'w') as f:
-            f.writelines(collated_xml_dump)
+        try:
+            domain_events = dict((element, iter(etree.iterparse(xml_files[element], events=("start", "end"))))
+                                 for element in elements)
+            xr_events = domain_events[xr_element]
+            event, xr_root = next(xr_events)
+
+            with open(temp_file, 'wb') as f:
+                with etree.xmlfile(f, encoding='utf-8') as xf:
+                    xf.write_declaration()
+                    with xf.element(xr_root.tag, dict(xr_root.attrib), nsmap=xr_root.nsmap):
+                        xf.write("\n")
+                        with xf.element("INTEGRITY-SET"):
+                            xf.write("\n")
+                            for element in elements:
+                                copy_integrity_set(xf, domain_events[element])
+                        xf.write("\n")
+
+                        # Anything following the INTEGRITY-SET in the XR-LXC dump (GENERAL)
+                        for event, node in xr_events:
+                            if event == "start":
+                                copy_xml_element(xf, xr_events, node)
+
+            os.rename(temp_file, output_file)
+        except Exception as e:
+            self.syslogger.info("Failed to collate domain XML files, Error: %s" % e)
+            if os.path.exists(temp_file):
+                os.remove(temp_file)
+            return {}
 
         return output_file
 
 
-    def send_to_server(self, filename, vrf="global-vrf", timeout=5):
-        with open(self.get_netns_path(nsname=self.vrf)) as fd:
-            self.setns(fd, CLONE_NEWNET)
-            if filename is None:
-                self.syslogger.info("No filename specified, bailing out")
-                return False
+    def send_to_server(self, filename, vrf="global-vrf", timeout=5, remote_name=None, destination=None):
+        if filename is None:
+            self.syslogger.info("No filename specified, bailing out")
+            return 1
 
+        if remote_name is None:
             fname = os.path.basename(self.compliance_xmlname)
+        else:
+            fname = remote_name
+        if destination is None:
+            destination = self.destinations[0]
+        remote_directory = destination["remote_directory"]
 
-            cmd =  "cat "+filename+" | ssh -i "+ os.path.abspath(self.id_rsa_file)
-            cmd =  cmd + " -p "+str(self.server_ssh_port)+" -o StrictHostKeyChecking=no "
-            cmd =  cmd + self.remote_user+"@"+self.server_connection
-            cmd =  cmd + " \"cat > "+self.remote_directory+"/"+fname+"\""
+        algorithm, remote_decompress = self.get_compression_cfg()
 
-            try:
-                #result = self.run_bash(cmd, vrf=vrf)
-                result = self.run_bash_timed(cmd, timeout, vrf=vrf)
-                return result["status"]
-            except Exception as e:
-                self.syslogger.info("Failed to transfer file to remote host")
-                self.syslogger.info("Error is: "+str(e))
-                return False
+        ssh_cmd = self.server_ssh_cmd(destination)
+
+        if algorithm is None:
+            cmd = "cat "+filename+" | "+ssh_cmd
+            cmd = cmd + " \"cat > "+remote_directory+"/"+fname+"\""
+            stdin_chunks = None
+        else:
+            # Compress while streaming into ssh, the server either stores
+            # the compressed file or decompresses it on the fly
+            if remote_decompress:
+                cmd = ssh_cmd + " \""+REMOTE_DECOMPRESS_CMDS[algorithm]+" > "+remote_directory+"/"+fname+"\""
+            else:
+                cmd = ssh_cmd + " \"cat > "+remote_directory+"/"+fname+COMPRESSION_SUFFIXES[algorithm]+"\""
+            stdin_chunks = compressed_chunks(filename, algorithm)
+
+        try:
+            #result = self.run_bash(cmd, vrf=vrf)
+            result = self.run_bash_timed(cmd, timeout, vrf=vrf, stdin_chunks=stdin_chunks)
+            return result["status"]
+        except Exception as e:
+            self.syslogger.info("Failed to transfer file to remote host")
+            self.syslogger.info("Error is: "+str(e))
+            return 1
     
 
     @classmethod
@@ -248,11 +1349,71 @@ class IosxrAuditMain(AuditHelpers):
 
 
 
+def run_audit(audit_obj, domain_dict, output_xml_dir):
+
+    xml_file = audit_obj.collate_xml(domain_dict, output_xml_dir)
+
+
+    if audit_obj.validate_xml_dump(xml_file):
+        audit_obj.syslogger.info('Valid XML! :)')
+        audit_obj.syslogger.info('Successfully created output XML: '+str(xml_file))
+
+        if audit_obj.debug:
+            audit_obj.logger.debug('Valid XML! :)')
+            audit_obj.logger.debug('Successfully created output XML: '+str(xml_file))
+
+        # Attempt to send to remote server only on the active RP
+
+        # Am I the active RP?
+        check_active_rp = audit_obj.is_active_rp()
+
+        if check_active_rp["status"] == "success":
+            if check_active_rp["output"]:
+                upload = audit_obj.prepare_upload(xml_file)
+                result = audit_obj.upload_result(upload, vrf="global-vrf")
+
+                if result["status"] == "success":
+                    audit_obj.update_delta_baseline(xml_file, upload["full"])
+                    audit_obj.syslogger.info("Successfully transferred audit result to Remote Server, over SSH")
+                    if audit_obj.debug:
+                        audit_obj.logger.debug("Successfully transferred audit result to Remote Server, over SSH")
+                    return 0
+                else:
+                    if result["output"]:
+                        # The servers that received this upload are ahead of
+                        # the others, a single delta baseline can't serve both
+                        audit_obj.reset_delta_baseline()
+                    audit_obj.syslogger.info("Failed to send audit result to Remote Server")
+                    if audit_obj.debug:
+                        audit_obj.logger.debug("Failed to send audit result to Remote Server")
+                    return 1
+            else:
+                audit_obj.syslogger.info("Not running on active RP, bailing out")
+                if audit_obj.debug:
+                    audit_obj.logger.debug("Not running on active RP, bailing out")
+                return 0
+        else:
+            audit_obj.syslogger.info("Failed to check current RP node's state")
+            if audit_obj.debug:
+                audit_obj.logger.debug("Failed to check current RP node's state")
+            return 1
+    else:
+        audit_obj.syslogger.info('Output XML Not valid! :(')
+        if audit_obj.debug:
+            audit_obj.logger.debug("Output XML Not valid! :(")
+        return 1
+
+
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', '--debug', action='store_true',
                     help='Enable verbose logging')
+    parser.add_argument('--daemon', action='store_true',
+                    help='Stay resident and collect the audit results periodically')
+    parser.add_argument('--full', action='store_true',
+                    help='Send the full compliance XML instead of a delta (first run only with --daemon)')
 
 
     results = parser.parse_args()
@@ -322,47 +1483,12 @@ if __name__ == "__main__":
                              "input_xml_dir": input_xml_dir_host}
                   }
 
-    xml_file = audit_obj.collate_xml(domain_dict, output_xml_dir)
-
 
-    if audit_obj.validate_xml_dump(xml_file):
-        audit_obj.syslogger.info('Valid XML! :)')
-        audit_obj.syslogger.info('Successfully created output XML: '+str(xml_file))
-
-        if audit_obj.debug:
-            audit_obj.logger.debug('Valid XML! :)')
-            audit_obj.logger.debug('Successfully created output XML: '+str(xml_file))
-
-        # Attempt to send to remote server only on the active RP
-
-        # Am I the active RP?
-        check_active_rp = audit_obj.is_active_rp()
+    # With --daemon, --full only applies until a full XML reaches the server
+    audit_obj.force_full_upload = results.full
 
-        if check_active_rp["status"] == "success":
-            if check_active_rp["output"]:
-                if not audit_obj.send_to_server(xml_file, vrf="global-vrf", timeout=10):
-                    audit_obj.syslogger.info("Successfully transferred audit result to Remote Server, over SSH")
-                    if audit_obj.debug:
-                        audit_obj.logger.debug("Successfully transferred audit result to Remote Server, over SSH")
-                    sys.exit(0)
-                else:
-                    audit_obj.syslogger.info("Failed to send audit result to Remote Server")
-                    if audit_obj.debug:
-                        audit_obj.logger.debug("Failed to send audit result to Remote Server")
-                    sys.exit(1)
-            else:
-                audit_obj.syslogger.info("Not running on active RP, bailing out")
-                if audit_obj.debug:
-                    audit_obj.logger.debug("Not running on active RP, bailing out")
-                sys.exit(0)
-        else:
-            audit_obj.syslogger.info("Failed to check current RP node's state")
-            if audit_obj.debug:
-                audit_obj.logger.debug("Failed to check current RP node's state")
-            sys.exit(1)
+    if results.daemon:
+        sys.exit(audit_obj.run_as_daemon(lambda: run_audit(audit_obj, domain_dict, output_xml_dir)))
     else:
-        audit_obj.syslogger.info('Output XML Not valid! :(')
-        if audit_obj.debug:
-            audit_obj.logger.debug("Output XML Not valid! :(")
-        sys.exit(1)
-
+        audit_obj.start_run_budget()
+        sys.exit(run_audit(audit_obj, domain_dict, output_xml_dir))
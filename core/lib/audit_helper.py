@@ -11,14 +11,13 @@
 
 """
 
-from ztp_helper import ZtpHelpers
+from ztp_helper import ZtpHelpers, process_reaper
 import subprocess, posixpath
 import datetime, os, re
 import glob
 import yaml
 from lxml import etree
 import pdb
-import xmltodict as xd
 import json
 from pprint import pprint
 import logging, logging.handlers
@@ -26,6 +25,19 @@ from ctypes import cdll
 import copy
 import threading
 import signal
+import sys
+import itertools
+import collections
+import Queue
+import hashlib
+import mmap
+import time
+import stat
+import pwd, grp
+import math
+import marshal
+import pipes
+import atexit
 
 libc = cdll.LoadLibrary('libc.so.6')
 _setns = libc.setns
@@ -43,25 +55,684 @@ XML_PREFIX_DOMAINS = ["XR-LXC",
 
 COMPLIANCE_PREFIX = "compliance_audit"
 
+# Number of COMPLIANCE_CONFIG entries audited in parallel when
+# AUDIT_CONFIG does not specify a CONCURRENCY
+DEFAULT_AUDIT_CONCURRENCY = 8
+
+# Checksums are computed in-process, md5 matches the output of md5sum
+CHECKSUM_ALGORITHMS = ["md5", "sha1", "sha256", "sha512"]
+DEFAULT_CHECKSUM_ALGORITHM = "md5"
+CHECKSUM_CHUNK_SIZE = 1024*1024
+CHECKSUM_MMAP_THRESHOLD = 32*1024*1024
+
+# Checksums are cached on disk and reused as long as the stat signature
+# of the file is unchanged. Files modified within the last
+# CHECKSUM_CACHE_RACY_WINDOW seconds are not cached, since the filesystem
+# timestamp granularity may hide a subsequent write.
+DEFAULT_CHECKSUM_CACHE_DIR = "/misc/scratch"
+CHECKSUM_CACHE_PREFIX = "audit_checksum_cache"
+DEFAULT_CHECKSUM_PARANOID_RUNS = 0
+CHECKSUM_CACHE_RACY_WINDOW = 2
+
+# Daemon mode (--daemon): the audit runs every DAEMON_INTERVAL seconds in a
+# resident process. The process exits on SIGTERM/SIGINT or as soon as its
+# pidfile (<app path>.pid) is removed, which is how the installer stops it.
+DEFAULT_DAEMON_INTERVAL = 60
+DAEMON_PIDFILE_SUFFIX = ".pid"
+DAEMON_PIDFILE_CHECK_INTERVAL = 2
+
+# Results of successful "show" commands run through xrcmd/admincmd are
+# reused for DEFAULT_CMD_CACHE_TTL seconds unless AUDIT_CONFIG CMD_CACHE
+# specifies otherwise. Time-sensitive commands (UNCACHEABLE_CMD_PREFIXES)
+# are never cached, whatever the configuration.
+DEFAULT_CMD_CACHE_TTL = 10
+CACHEABLE_CMD_PREFIX = "show "
+UNCACHEABLE_CMD_PREFIXES = ["show clock"]
+
+# Platform topology (node names, peer RP and xrnns IPs) is resolved once and
+# reused for TOPOLOGY_CACHE TTL seconds, or until show redundancy summary
+# reports a change in the RP roles.
+DEFAULT_TOPOLOGY_CACHE_TTL = 300
+DEFAULT_TOPOLOGY_CACHE_DIR = "/misc/scratch"
+TOPOLOGY_CACHE_PREFIX = "audit_topology_cache"
+
+# ssh/scp hops to the standby RP, the admin LXCs and the host reuse one
+# ControlMaster connection per target, kept alive for SSH_MULTIPLEX PERSIST
+# seconds after its last use.
+DEFAULT_SSH_PERSIST = 120
+SSH_CONTROL_PATH_PREFIX = "/tmp/.audit_ssh_"
+
+# Every command run through run_bash/run_bash_timed, xrcmd and admincmd is
+# killed (with its process group) by the process_reaper of ztp_helper once
+# its deadline expires: COMMAND_TIMEOUT seconds for run_bash, xrcmd and
+# admincmd unless AUDIT_CONFIG specifies otherwise, and never later than the
+# end of the RUN_BUDGET of the current audit run (0 disables the budget).
+# The RESPONSE of a command that was killed is TIMED_OUT_RESPONSE.
+DEFAULT_COMMAND_TIMEOUT = 120
+DEFAULT_RUN_BUDGET = 300
+TIMED_OUT_RESPONSE = "timed out"
+
+# ls options that can be served natively by native_ls(), any other
+# command is handed over to the shell. The long format (-l) is required.
+NATIVE_LS_OPTIONS = "ladrthA"
+SIX_MONTHS = 365.2425*24*60*60/2
+
+# Lines of an "ls -l" listing: the total of a directory block or an entry
+# starting with its mode, see list_directories()
+LS_LONG_LINE = re.compile(r"^(total \d|[-bcdlpsD][-rwxsStT]{9})")
+
+XSI_NAMESPACE = "http://www.w3.org/2001/XMLSchema-instance"
+XS_NAMESPACE = "http://www.w3.org/2001/XMLSchema"
+COMPLIANCE_DUMP_VERSION = "1.0.0"
+
+# The parts of compliance.xsd used at runtime are precomputed at build time
+# by precompile_xsd.py and shipped next to the xsd with this suffix.
+XSD_ARTIFACT_SUFFIX = ".marshal"
+
+# Suffix of the temporary file a domain XML is written to before being
+# renamed in place
+XML_TEMP_SUFFIX = ".tmp"
+
+# Pattern used for the DATE field if the xsd doesn't specify one: CCYYMMDD-HH:MI TZ
+DEFAULT_DATE_PATTERN = "[0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]-[0-9][0-9]:[0-9][0-9] [A-Z].*"
+
+# Compiled XML schemas, keyed by xsd path: (mtime, etree.XMLSchema)
+SCHEMA_CACHE = {}
+SCHEMA_CACHE_LOCK = threading.Lock()
+
+# Characters that are not allowed in XML 1.0 documents
+XML_INVALID_CHARS = re.compile(u'[^\u0009\u000A\u000D\u0020-\uD7FF\uE000-\uFFFD]')
+
+
+
+class NetnsWorker(threading.Thread):
+    """Long-lived thread joined to one network namespace. The namespace fd
+       is opened once and held for the lifetime of the thread, calls are
+       queued to it and run in that namespace. Processes and sockets keep
+       the namespace of the thread that created them, so the worker only
+       needs to create them: waiting on them is left to the caller.
+    """
+
+    def __init__(self, nspath):
+        threading.Thread.__init__(self)
+        self.nspath = nspath
+        self.ns_fd = None
+        self.tasks = Queue.Queue()
+        self.setDaemon(True)
+
+    def enter_netns(self):
+        # Retried on every call until it succeeds, the namespace (e.g. a
+        # vrf) may not exist yet when the worker is started
+        if self.ns_fd is None:
+            ns_fd = os.open(self.nspath, os.O_RDONLY)
+            if _setns(ns_fd, CLONE_NEWNET) != 0:
+                os.close(ns_fd)
+                raise OSError("Failed to enter network namespace "+self.nspath)
+            self.ns_fd = ns_fd
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            if task is None:
+                break
+
+            func, args, kwargs, reply = task
+            try:
+                self.enter_netns()
+                reply["result"] = func(*args, **kwargs)
+            except Exception as e:
+                reply["error"] = sys.exc_info()
+            reply["done"].set()
+
+        if self.ns_fd is not None:
+            os.close(self.ns_fd)
+
+    def stop(self):
+        self.tasks.put(None)
+
+    def call(self, func, *args, **kwargs):
+        reply = {"done" : threading.Event()}
+        self.tasks.put((func, args, kwargs, reply))
+        reply["done"].wait()
+
+        if "error" in reply:
+            exc_type, exc_value, exc_traceback = reply["error"]
+            raise exc_type, exc_value, exc_traceback
+        return reply["result"]
+
+
+class NetnsExecutor(object):
+    """Routes calls to the NetnsWorker of their network namespace, workers
+       are started on first use. Calls in different namespaces run
+       concurrently and the calling threads never change namespace.
+    """
+
+    def __init__(self):
+        self.workers = {}
+        self.lock = threading.Lock()
+
+    def call(self, nspath, func, *args, **kwargs):
+        with self.lock:
+            worker = self.workers.get(nspath)
+            if worker is None:
+                worker = NetnsWorker(nspath)
+                worker.start()
+                self.workers[nspath] = worker
+
+        return worker.call(func, *args, **kwargs)
+
+    def shutdown(self):
+        with self.lock:
+            workers = self.workers.values()
+            self.workers = {}
+
+        for worker in workers:
+            worker.stop()
+        for worker in workers:
+            worker.join()
+
+
+# Shared by all the helpers of the process, one worker per namespace. The
+# workers are stopped at exit, before the interpreter is torn down.
+netns_executor = NetnsExecutor()
+atexit.register(netns_executor.shutdown)
+
+
+def file_digest(filename, algorithm=DEFAULT_CHECKSUM_ALGORITHM):
+    """Compute the hex digest of a file without forking a subprocess.
+       Regular files larger than CHECKSUM_MMAP_THRESHOLD are hashed
+       through mmap, everything else is streamed in CHECKSUM_CHUNK_SIZE
+       chunks so memory usage stays bounded.
+       :param filename: absolute path of the file to hash
+       :param algorithm: one of CHECKSUM_ALGORITHMS
+       :type filename: str
+       :type algorithm: str
+       :return: hex digest of the file content
+       :rtype: str
+    """
+
+    hasher = hashlib.new(algorithm)
+
+    with open(filename, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size >= CHECKSUM_MMAP_THRESHOLD:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                hasher.update(mapped)
+            finally:
+                mapped.close()
+        else:
+            for chunk in iter(lambda: f.read(CHECKSUM_CHUNK_SIZE), b''):
+                hasher.update(chunk)
+
+    return hasher.hexdigest()
+
+
+def file_signature(filename):
+    """Return the stat signature used to key the checksum cache:
+       [device, inode, size, mtime_ns, ctime_ns]
+    """
+
+    st = os.stat(filename)
+    mtime_ns = getattr(st, "st_mtime_ns", int(st.st_mtime*1e9))
+    ctime_ns = getattr(st, "st_ctime_ns", int(st.st_ctime*1e9))
+
+    return [st.st_dev, st.st_ino, st.st_size, mtime_ns, ctime_ns]
+
+
+class ChecksumCache(object):
+    """On-disk cache of file checksums keyed on the stat signature of
+       each file. A file is only re-read if its signature changed since
+       the checksum was cached. Every paranoid_runs runs (0 disables it)
+       all the cached checksums are ignored and the files are rehashed.
+       Only the entries looked up during the last run are saved, so files
+       dropped from COMPLIANCE_CONFIG age out of the cache.
+    """
+
+    def __init__(self, cache_file, paranoid_runs=DEFAULT_CHECKSUM_PARANOID_RUNS, syslogger=None):
+        self.cache_file = cache_file
+        self.paranoid_runs = paranoid_runs
+        self.syslogger = syslogger
+        self.entries = {}
+        self.seen = set()
+        self.runs = 0
+        self.loaded = False
+        self.lock = threading.Lock()
+
+
+    def load(self):
+        try:
+            with open(self.cache_file, 'r') as f:
+                cache = json.load(f)
+            self.entries = cache["entries"]
+            self.runs = int(cache["runs"])
+        except Exception as e:
+            # Missing or corrupt cache, start afresh
+            self.entries = {}
+            self.runs = 0
+        self.loaded = True
+
+
+    def start_run(self):
+        with self.lock:
+            if not self.loaded:
+                self.load()
+            self.runs += 1
+            self.seen = set()
+
+
+    def is_paranoid_run(self):
+        return (self.paranoid_runs > 0 and
+                self.runs % self.paranoid_runs == 0)
+
+
+    def lookup(self, filename, signature, algorithm):
+        with self.lock:
+            self.seen.add(filename)
+            if self.is_paranoid_run():
+                return None
+            entry = self.entries.get(filename)
+
+        if (entry and entry["signature"] == signature and
+                entry["algorithm"] == algorithm):
+            return entry["checksum"]
+
+        return None
+
+
+    def store(self, filename, signature, algorithm, checksum):
+        # Don't trust timestamps of files that were just modified
+        if signature[3] > (time.time() - CHECKSUM_CACHE_RACY_WINDOW)*1e9:
+            return
+
+        with self.lock:
+            self.seen.add(filename)
+            entry = self.entries.get(filename)
+            if (entry and entry["signature"] == signature and
+                    entry["algorithm"] == algorithm and
+                    entry["checksum"] != checksum and
+                    self.syslogger is not None):
+                self.syslogger.info("Checksum of file "+filename+" changed "
+                                    "without a change in its stat signature")
+            self.entries[filename] = {"signature" : signature,
+                                      "algorithm" : algorithm,
+                                      "checksum" : checksum}
+
+
+    def save(self):
+        with self.lock:
+            cache = {"runs" : self.runs,
+                     "entries" : dict((filename, entry)
+                                      for filename, entry in self.entries.iteritems()
+                                      if filename in self.seen)}
+
+        # Write to a temporary file first so that a crash never leaves
+        # a truncated cache behind
+        tmp_file = self.cache_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(cache, f)
+        os.rename(tmp_file, self.cache_file)
+
+
+def ls_command_options(cmd):
+    """Return the set of options of an ls command that can be served
+       natively, or None if the command must be run in the shell.
+    """
+
+    tokens = cmd.split()
+    if not tokens or tokens[0] != "ls":
+        return None
+
+    options = set()
+    for token in tokens[1:]:
+        if not token.startswith("-") or token == "-":
+            return None
+        for option in token[1:]:
+            if option not in NATIVE_LS_OPTIONS:
+                return None
+            options.add(option)
+
+    if "l" not in options:
+        return None
+
+    return options
+
+
+def ls_mode(mode):
+    mode_str = list("-rwxrwxrwx")
+
+    for ftype, char in [(stat.S_ISDIR, "d"), (stat.S_ISLNK, "l"),
+                        (stat.S_ISCHR, "c"), (stat.S_ISBLK, "b"),
+                        (stat.S_ISFIFO, "p"), (stat.S_ISSOCK, "s")]:
+        if ftype(mode):
+            mode_str[0] = char
+
+    for index, bit in enumerate([stat.S_IRUSR, stat.S_IWUSR, stat.S_IXUSR,
+                                 stat.S_IRGRP, stat.S_IWGRP, stat.S_IXGRP,
+                                 stat.S_IROTH, stat.S_IWOTH, stat.S_IXOTH]):
+        if not mode & bit:
+            mode_str[index+1] = "-"
+
+    for index, bit, char in [(3, stat.S_ISUID, "s"),
+                             (6, stat.S_ISGID, "s"),
+                             (9, stat.S_ISVTX, "t")]:
+        if mode & bit:
+            mode_str[index] = char if mode_str[index] == "x" else char.upper()
+
+    return "".join(mode_str)
+
+
+def ls_human_size(size):
+    """Format a size the way ls -h does: powers of 1024 rounded up,
+       one decimal below 10.
+    """
+
+    if size < 1024:
+        return str(size)
+
+    value = float(size)
+    for unit in "KMGTPEZY":
+        value = value/1024
+        if value < 10:
+            rounded = math.ceil(value*10)/10
+            if rounded < 10:
+                return "%.1f%s" % (rounded, unit)
+        rounded = math.ceil(value)
+        if rounded < 1024:
+            return "%d%s" % (rounded, unit)
+        value = rounded
+
+    return "%d%s" % (value, unit)
+
+
+def ls_time(mtime, now):
+    if now - SIX_MONTHS < mtime <= now:
+        fmt = "%b %e %H:%M"
+    else:
+        fmt = "%b %e  %Y"
+    return time.strftime(fmt, time.localtime(mtime))
+
+
+def native_ls(cmd, path, user_cache=None, group_cache=None):
+    """Produce the output of "cmd path" for an ls command in long format
+       from os.lstat() instead of forking ls. ls_command_options(cmd) must
+       not be None. Entries are sorted in the C locale.
+       An OSError is raised if path or one of its entries cannot be read.
+    """
+
+    options = ls_command_options(cmd)
+    now = time.time()
+
+    if user_cache is None:
+        user_cache = {}
+    if group_cache is None:
+        group_cache = {}
+
+    def user_name(uid):
+        if uid not in user_cache:
+            try:
+                user_cache[uid] = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                user_cache[uid] = str(uid)
+        return user_cache[uid]
+
+    def group_name(gid):
+        if gid not in group_cache:
+            try:
+                group_cache[gid] = grp.getgrgid(gid).gr_name
+            except KeyError:
+                group_cache[gid] = str(gid)
+        return group_cache[gid]
+
+    path_stat = os.lstat(path)
+
+    if stat.S_ISDIR(path_stat.st_mode) and "d" not in options:
+        names = os.listdir(path)
+        if "a" in options:
+            names.extend([".", ".."])
+        elif "A" not in options:
+            names = [name for name in names if not name.startswith(".")]
+        entries = [(name, os.path.join(path, name)) for name in names]
+        entries = [(name, full_path, os.lstat(full_path))
+                   for name, full_path in entries]
+        show_total = True
+    else:
+        entries = [(path, path, path_stat)]
+        show_total = False
+
+    if "t" in options:
+        entries.sort(key=lambda entry: (-entry[2].st_mtime, entry[0]))
+    else:
+        entries.sort(key=lambda entry: entry[0])
+    if "r" in options:
+        entries.reverse()
+
+    rows = []
+    for name, full_path, st in entries:
+        if stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+            size = (str(os.major(st.st_rdev)), str(os.minor(st.st_rdev)))
+        elif "h" in options:
+            size = ls_human_size(st.st_size)
+        else:
+            size = str(st.st_size)
+
+        if stat.S_ISLNK(st.st_mode):
+            name = name + " -> " + os.readlink(full_path)
+
+        rows.append([ls_mode(st.st_mode),
+                     str(st.st_nlink),
+                     user_name(st.st_uid),
+                     group_name(st.st_gid),
+                     size,
+                     ls_time(st.st_mtime, now),
+                     name])
+
+    lines = []
+    if show_total:
+        blocks = sum(st.st_blocks for name, full_path, st in entries)*512
+        if "h" in options:
+            lines.append("total "+ls_human_size(blocks))
+        else:
+            lines.append("total "+str(int(math.ceil(blocks/1024.0))))
+
+    if rows:
+        nlink_width = max(len(row[1]) for row in rows)
+        user_width = max(len(row[2]) for row in rows)
+        group_width = max(len(row[3]) for row in rows)
+
+        devices = [row[4] for row in rows if isinstance(row[4], tuple)]
+        major_width = max([len(major) for major, minor in devices] or [0])
+        minor_width = max([len(minor) for major, minor in devices] or [0])
+        size_width = max([len(row[4]) for row in rows if not isinstance(row[4], tuple)] +
+                         [major_width + minor_width + (2 if devices else 0)])
+
+        for row in rows:
+            if isinstance(row[4], tuple):
+                major, minor = row[4]
+                row[4] = (major.rjust(size_width - minor_width - 2) + ", " +
+                          minor.rjust(minor_width))
+            lines.append(" ".join([row[0],
+                                   row[1].rjust(nlink_width),
+                                   row[2].ljust(user_width),
+                                   row[3].ljust(group_width),
+                                   row[4].rjust(size_width),
+                                   row[5],
+                                   row[6]]))
+
+    return "\n".join(lines) + "\n"
+
+
+def xml_text(value):
+    """Convert a value to text that can be stored in an XML document"""
+
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    elif not isinstance(value, unicode):
+        value = unicode(value)
+
+    return XML_INVALID_CHARS.sub(u'', value)
+
+
+def dict_to_element(tag, value):
+    """Build a list of lxml elements from a dictionary laid out the way
+       xmltodict.unparse expects it: keys starting with '@' are attributes
+       and lists are turned into repeated elements.
+    """
+
+    if isinstance(value, list):
+        elements = []
+        for entry in value:
+            elements.extend(dict_to_element(tag, entry))
+        return elements
+
+    element = etree.Element(tag)
+
+    if isinstance(value, dict):
+        for key, entry in value.iteritems():
+            if key.startswith('@'):
+                element.set(key[1:], xml_text(entry))
+            else:
+                element.extend(dict_to_element(key, entry))
+    elif value is not None:
+        element.text = xml_text(value)
+
+    return [element]
+
+
+def compiled_schema(xsd_path):
+    """Return the compiled etree.XMLSchema of xsd_path. The xsd is only
+       parsed again if the file changed since it was last compiled.
+    """
+
+    mtime = os.stat(xsd_path).st_mtime
+
+    with SCHEMA_CACHE_LOCK:
+        cached = SCHEMA_CACHE.get(xsd_path)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, etree.XMLSchema(etree.parse(xsd_path)))
+            SCHEMA_CACHE[xsd_path] = cached
+
+    return cached[1]
+
+
+def parse_xsd_summary(xsd_path):
+    """Parse compliance.xsd and extract the structures consumed at runtime:
+       the schema version, the GENERAL field refs and the DATE pattern,
+       along with the md5 digest of the xsd they were extracted from.
+    """
+
+    with open(xsd_path, 'rb') as f:
+        xsd_content = f.read()
+
+    schema = etree.fromstring(xsd_content)
+    namespaces = {"xs" : XS_NAMESPACE}
+
+    general_fields = schema.xpath('xs:element[@name="GENERAL"]/xs:complexType'
+                                  '/xs:all/xs:element/@ref', namespaces=namespaces)
+    date_pattern = schema.xpath('xs:attribute[@name="DATE"]/xs:simpleType'
+                                '/xs:restriction/xs:pattern/@value', namespaces=namespaces)
+
+    return {"version" : str(schema.get("version")),
+            "general_fields" : [str(field) for field in general_fields],
+            "date_pattern" : str(date_pattern[0]) if date_pattern else DEFAULT_DATE_PATTERN,
+            "xsd_digest" : hashlib.md5(xsd_content).hexdigest()}
 
 
-class KillerThread(threading.Thread):
-  def __init__(self, pid, timeout, event ):
-    threading.Thread.__init__(self)
-    self.pid = pid
-    self.timeout = timeout
-    self.event = event
-    self.setDaemon(True)
+def load_xsd_summary(xsd_path):
+    """Load the xsd summary precomputed at build time, falling back to
+       parsing the xsd if the artifact is missing or was built from a
+       different xsd.
+    """
 
-  def run(self):
-    self.event.wait(self.timeout)
-    if not self.event.is_set():
-      try:
-          os.killpg(os.getpgid(self.pid), signal.SIGTERM)
-      except OSError, e:
-        #This is raised if the process has already completed
+    with open(xsd_path, 'rb') as f:
+        xsd_digest = hashlib.md5(f.read()).hexdigest()
+
+    try:
+        with open(xsd_path + XSD_ARTIFACT_SUFFIX, 'rb') as f:
+            summary = marshal.load(f)
+        if summary["xsd_digest"] == xsd_digest:
+            return summary
+    except Exception as e:
         pass
 
+    return parse_xsd_summary(xsd_path)
+
+
+class PoolTask(object):
+    def __init__(self, item):
+        self.item = item
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+def imap_ordered(handler, items, concurrency=1):
+    """Run handler on every item using a bounded pool of worker threads
+       and yield the results in the same order as the items.
+       At most 2*concurrency items are in flight at any time, so
+       results are not accumulated if the consumer handles them
+       one at a time.
+       :param handler: callable invoked as handler(item)
+       :param items: iterable of items to process
+       :param concurrency: number of worker threads, 1 runs serially
+       :type concurrency: int
+       :return: generator of handler results, in the order of items
+    """
+
+    if concurrency <= 1:
+        for item in items:
+            yield handler(item)
+        return
+
+    task_queue = Queue.Queue()
+
+    def worker():
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            try:
+                task.result = handler(task.item)
+            except Exception:
+                task.error = sys.exc_info()
+            task.done.set()
+
+    workers = []
+    for i in range(concurrency):
+        thread = threading.Thread(target=worker)
+        thread.setDaemon(True)
+        thread.start()
+        workers.append(thread)
+
+    items = iter(items)
+    pending = collections.deque()
+
+    try:
+        for item in itertools.islice(items, 2*concurrency):
+            task = PoolTask(item)
+            pending.append(task)
+            task_queue.put(task)
+
+        while pending:
+            task = pending.popleft()
+            task.done.wait()
+
+            for item in itertools.islice(items, 1):
+                next_task = PoolTask(item)
+                pending.append(next_task)
+                task_queue.put(next_task)
+
+            if task.error is not None:
+                raise task.error[0], task.error[1], task.error[2]
+            yield task.result
+    finally:
+        for thread in workers:
+            task_queue.put(None)
+
+    # All the tasks are done at this point, let the idle workers exit
+    for thread in workers:
+        thread.join()
+
 
 class AuditHelpers(ZtpHelpers):
 
@@ -77,13 +748,24 @@ class AuditHelpers(ZtpHelpers):
         self.exit = False
         self.version = {}
         self.request_version = request_version
+        self.cmd_cache = {}
+        self.cmd_cache_lock = threading.Lock()
+        self.topology = None
+        self.topology_lock = threading.Lock()
+        self.ssh_masters = {}
+        self.ssh_masters_lock = threading.Lock()
+        # Deadline of the current audit run, see start_run_budget()
+        self.run_deadline = None
 
         if self.request_version:
             if compliance_xsd is None:
                 self.exit = True
             else:
                 self.compliance_xsd = compliance_xsd
-            self.version = self.xsd_to_dict(version=True)
+            try:
+                self.version = {"version" : "v"+load_xsd_summary(self.compliance_xsd)["version"]}
+            except Exception as e:
+                self.version = {}
             return None
 
         if domain is None:
@@ -162,15 +844,22 @@ class AuditHelpers(ZtpHelpers):
             self.auditor_cfg = auditor_cfg
 
 
-        self.compliance_xsd_dict = {}
+        self.compliance_xsd_summary = {}
         self.auditor_cfg_dict = {}
         self.router_cfg_dict = {}
         self.compliance_cfg_dict = {}
         self.server_cfg_dict = {}
         self.install_cfg_dict = {} 
+        self.audit_cfg_dict = {}
+        self.checksum_cache = None
+        self.user_name_cache = {}
+        self.group_name_cache = {}
        
-        self.compliance_xsd_dict = self.xsd_to_dict()
-        if not self.compliance_xsd_dict:
+        try:
+            self.compliance_xsd_summary = load_xsd_summary(self.compliance_xsd)
+        except Exception as e:
+            self.syslogger.info("Failed to parse compliance xsd file")
+            self.syslogger.info("Error is %s" % e)
             self.exit = True
 
         self.auditor_cfg_dict = self.yaml_to_dict(self.auditor_cfg)
@@ -200,6 +889,13 @@ class AuditHelpers(ZtpHelpers):
         except Exception as e:
             self.syslogger.info("Failed to extact install config from auditor.cfg.yml, Error: %s" % e)
             self.exit = True
+
+        try:
+            # AUDIT_CONFIG is optional, defaults are used for any missing setting
+            if self.auditor_cfg_dict.get("AUDIT_CONFIG"):
+                self.audit_cfg_dict = self.auditor_cfg_dict["AUDIT_CONFIG"]
+        except Exception as e:
+            self.syslogger.info("Failed to extact audit config from auditor.cfg.yml, using defaults. Error: %s" % e)
         self.calendar_months = {'Jan':'01', 'Feb':'02', 'Mar':'03', 'Apr':'04',
                                 'May':'05', 'Jun':'06', 'Jul':'07', 'Aug':'08',
                                 'Sep':'09', 'Oct':'10', 'Nov':'11', 'Dec':'12'}
@@ -282,11 +978,11 @@ class AuditHelpers(ZtpHelpers):
     def get_date(self):
 
         try:
-            if self.compliance_xsd_dict["xs:schema"]["xs:attribute"]['@name'] == 'DATE':
-                pattern = self.compliance_xsd_dict["xs:schema"]["xs:attribute"]['xs:simpleType']['xs:restriction']['xs:pattern']['@value']
+            pattern = self.compliance_xsd_summary["date_pattern"]
         except Exception as e:
-            sys.syslogger.info("Failed to fetch pattern for DATE from compliance xsd, Error:"+str(e))
-            sys.syslogger.info("Using default pattern: CCYYMMDD-HH:MI TZ")
+            self.syslogger.info("Failed to fetch pattern for DATE from compliance xsd, Error:"+str(e))
+            self.syslogger.info("Using default pattern: CCYYMMDD-HH:MI TZ")
+            pattern = DEFAULT_DATE_PATTERN
 
         try:
             result = self.xrcmd({"exec_cmd" : "show clock"})
@@ -300,13 +996,15 @@ class AuditHelpers(ZtpHelpers):
                 DD = str("%02d" % int(DD))
                 TZ = result["output"][0].split(' ')[1]
   
+                # Built in the default pattern: CCYYMMDD-HH:MI TZ
                 date = CCYY+MM+DD+"-"+HH+":"+MI+' '+TZ
  
                 if re.match(pattern, date):
                     return date
                 else:
-                    sys.syslogger.info("Failed to match requested pattern, please change format as needed")
-                    sys.syslogger.info("Using default pattern: CCYYMMDD-HH:MI TZ")
+                    self.syslogger.info("Failed to match requested pattern, please change format as needed")
+                    self.syslogger.info("Using default pattern: CCYYMMDD-HH:MI TZ")
+                    return date
             else:
                 return ""
         except Exception as e:
@@ -345,14 +1043,11 @@ class AuditHelpers(ZtpHelpers):
     def get_mgmt_ip(self):
         try:
             # Get the name of the current node
-            cmd = "/sbin/ip netns exec xrnns /pkg/bin/node_list_generation -f MY"
+            result = self.get_my_node_name()
 
-            result = self.run_bash(cmd)
-
-            if not result["status"]:
+            if result["status"] == "success":
                 my_node_name = result["output"]
             else:
-                self.syslogger.info("Failed to get current node name, output: "+result["output"]+", error: "+result["error"])
                 return ""
 
             return self.get_interface_ip("MgmtEth"+my_node_name+"/0")
@@ -404,20 +1099,18 @@ class AuditHelpers(ZtpHelpers):
             else:
                 try:
                     current_active_rp = show_red_summary["output"][2].split()[0]
+                    self.check_redundancy_state(show_red_summary["output"][2])
                 except Exception as e:
                     self.syslogger.info("Failed to get Active RP from show redundancy summary output")
                     return {"status" : "error", "output" : "", "warning" : "Failed to get Active RP, error: " + str(e)}
 
 
             # get the name of the current node
-            cmd = "/sbin/ip netns exec xrnns /pkg/bin/node_list_generation -f MY"
+            result = self.get_my_node_name()
 
-            result = self.run_bash(cmd)
-
-            if not result["status"]:
+            if result["status"] == "success":
                 my_node_name = result["output"]
             else:
-                self.syslogger.info("Failed to get current node name, output: "+result["output"]+", error: "+result["error"])
                 return {"status" : "error", "output" : "", "warning" : "Failed to get current node name"}
 
             if current_active_rp == my_node_name:
@@ -430,7 +1123,249 @@ class AuditHelpers(ZtpHelpers):
 
 
 
+    def get_topology_cache_cfg(self):
+        try:
+            cache_cfg = self.audit_cfg_dict["TOPOLOGY_CACHE"]
+        except Exception as e:
+            cache_cfg = {}
+
+        try:
+            ttl = int(cache_cfg["TTL"])
+        except Exception as e:
+            ttl = DEFAULT_TOPOLOGY_CACHE_TTL
+
+        try:
+            cache_dir = cache_cfg["DIRECTORY"]
+        except Exception as e:
+            cache_dir = DEFAULT_TOPOLOGY_CACHE_DIR
+
+        return {"enable" : bool(cache_cfg.get("ENABLE", True)),
+                "persist" : bool(cache_cfg.get("PERSIST", True)),
+                "ttl" : ttl,
+                "file" : os.path.join(cache_dir, TOPOLOGY_CACHE_PREFIX+"_"+self.domain+".json")}
+
+
+    def load_topology(self, cache_cfg):
+        """Return the cached topology, loading the persisted copy on first
+           use. Must be called with topology_lock held.
+        """
+
+        now = time.time()
+
+        if self.topology is None and cache_cfg["persist"]:
+            try:
+                with open(cache_cfg["file"], 'r') as f:
+                    self.topology = json.load(f)
+            except Exception as e:
+                self.topology = None
+
+        if (self.topology is None or
+                self.topology.get("timestamp", 0) + cache_cfg["ttl"] <= now):
+            self.topology = {"timestamp" : now}
+
+        return self.topology
+
+
+    def save_topology(self, cache_cfg):
+        if not cache_cfg["persist"]:
+            return
+
+        try:
+            tmp_file = cache_cfg["file"] + ".tmp"
+            with open(tmp_file, 'w') as f:
+                json.dump(self.topology, f)
+            os.rename(tmp_file, cache_cfg["file"])
+        except Exception as e:
+            self.syslogger.info("Failed to save the topology cache, Error: "+str(e))
+
+
+    def topology_lookup(self, name, resolver):
+        """Return the topology entry name, resolving it with resolver() if
+           it isn't cached yet. Only successful results are cached.
+        """
+
+        cache_cfg = self.get_topology_cache_cfg()
+        if not cache_cfg["enable"]:
+            return resolver()
+
+        with self.topology_lock:
+            topology = self.load_topology(cache_cfg)
+            if name in topology:
+                return copy.deepcopy(topology[name])
+
+        result = resolver()
+
+        if result["status"] == "success":
+            with self.topology_lock:
+                topology = self.load_topology(cache_cfg)
+                topology[name] = copy.deepcopy(result)
+                self.save_topology(cache_cfg)
+
+        return result
+
+
+    def invalidate_topology(self):
+        with self.topology_lock:
+            self.topology = {"timestamp" : time.time()}
+            cache_cfg = self.get_topology_cache_cfg()
+            if cache_cfg["persist"]:
+                try:
+                    os.remove(cache_cfg["file"])
+                except OSError as e:
+                    pass
+
+
+    def check_redundancy_state(self, redundancy_line):
+        """Invalidate the topology cache if the RP roles reported by
+           show redundancy summary changed since the topology was cached.
+           :param redundancy_line: active/standby line of show redundancy summary
+        """
+
+        cache_cfg = self.get_topology_cache_cfg()
+        if not cache_cfg["enable"]:
+            return
+
+        state = " ".join(redundancy_line.split()[:2])
+
+        with self.topology_lock:
+            topology = self.load_topology(cache_cfg)
+            previous_state = topology.get("redundancy")
+
+            if previous_state == state:
+                return
+
+            if previous_state is not None:
+                self.syslogger.info("RP roles changed from \""+previous_state+"\" to \""+state+"\", "
+                                    "invalidating the topology cache")
+                self.topology = topology = {"timestamp" : time.time()}
+
+            topology["redundancy"] = state
+            self.save_topology(cache_cfg)
+
+
+    def get_my_node_name(self):
+        return self.topology_lookup("my_node_name", self.resolve_my_node_name)
+
+
+    def resolve_my_node_name(self):
+        cmd = "/sbin/ip netns exec xrnns /pkg/bin/node_list_generation -f MY"
+
+        result = self.run_bash(cmd)
+
+        if not result["status"]:
+            return {"status" : "success", "output" : result["output"]}
+        else:
+            self.syslogger.info("Failed to get current node name, output: "+result["output"]+", error: "+result["error"])
+            return {"status" : "error", "output" : ""}
+
+
+    def get_cmd_cache_ttl(self, cmd):
+        """TTL in seconds of the cached result of an XR/admin exec command.
+           AUDIT_CONFIG CMD_CACHE TTL maps commands (or command prefixes,
+           the longest match wins) to a TTL, 0 disables caching.
+        """
+
+        if not cmd.startswith(CACHEABLE_CMD_PREFIX):
+            return 0
+
+        if any(cmd.startswith(prefix) for prefix in UNCACHEABLE_CMD_PREFIXES):
+            return 0
+
+        try:
+            cache_cfg = self.audit_cfg_dict["CMD_CACHE"]
+        except Exception as e:
+            cache_cfg = {}
+
+        if not cache_cfg.get("ENABLE", True):
+            return 0
+
+        try:
+            ttl = int(cache_cfg["DEFAULT_TTL"])
+        except Exception as e:
+            ttl = DEFAULT_CMD_CACHE_TTL
+
+        try:
+            matches = [prefix for prefix in cache_cfg["TTL"] if cmd.startswith(prefix)]
+            if matches:
+                ttl = int(cache_cfg["TTL"][max(matches, key=len)])
+        except Exception as e:
+            pass
+
+        return ttl
+
+
+    def cached_cmd(self, key, cmd, run):
+        """Return the result of run() for cmd, reusing a successful result
+           stored under key until its TTL expires.
+        """
+
+        ttl = self.get_cmd_cache_ttl(cmd)
+        if ttl <= 0:
+            return run()
+
+        now = time.time()
+        with self.cmd_cache_lock:
+            entry = self.cmd_cache.get(key)
+        if entry is not None and entry[0] > now:
+            if self.debug:
+                self.logger.debug("Using cached output of command: \"%s\"" % cmd)
+            return copy.deepcopy(entry[1])
+
+        result = run()
+        if result["status"] == "success":
+            with self.cmd_cache_lock:
+                self.cmd_cache[key] = (now + ttl, copy.deepcopy(result))
+
+        return result
+
+
+    def invalidate_cmd_cache(self, cmd=None):
+        """Drop the cached results of cmd (XR and admin), or of every
+           command if cmd is None.
+        """
+
+        with self.cmd_cache_lock:
+            if cmd is None:
+                self.cmd_cache.clear()
+            else:
+                for key in self.cmd_cache.keys():
+                    if key[1] == cmd:
+                        del self.cmd_cache[key]
+
+
+    def xrcmd(self, cmd=None):
+        """Issue an IOS-XR exec command and obtain the output, results of
+           show commands are cached, see get_cmd_cache_ttl()
+           :param cmd: Dictionary representing the XR exec cmd
+                       and response to potential prompts
+                       { 'exec_cmd': '', 'prompt_response': '' }
+           :type cmd: dict
+           :return: Return a dictionary with status and output
+                    { 'status': 'error/success', 'output': '' }
+           :rtype: dict
+        """
+
+        if not isinstance(cmd, dict) or "exec_cmd" not in cmd:
+            return super(AuditHelpers, self).xrcmd(cmd)
+
+        key = ("xr", cmd["exec_cmd"], cmd.get("prompt_response", ""))
+        return self.cached_cmd(key, cmd["exec_cmd"],
+                               lambda: super(AuditHelpers, self).xrcmd(cmd))
+
+
     def admincmd(self, cmd=None):
+        """Issue an admin exec cmd and obtain the output, results of
+           show commands are cached, see get_cmd_cache_ttl()
+        """
+
+        if cmd is None:
+            return {"status" : "error", "output" : "No command specified"}
+
+        return self.cached_cmd(("admin", cmd), cmd,
+                               lambda: self.run_admincmd(cmd))
+
+
+    def run_admincmd(self, cmd=None):
         """Issue an admin exec cmd and obtain the output
            :param cmd: Dictionary representing the XR exec cmd
                        and response to potential prompts
@@ -450,13 +1385,12 @@ class AuditHelpers(ZtpHelpers):
         if self.debug:
             self.logger.debug("Received admin exec command request: \"%s\"" % cmd)
 
-        cmd = "export AAA_USER="+self.root_lr_user+" && source /pkg/bin/ztp_helper.sh && echo -ne \""+cmd+"\\n \" | xrcmd \"admin\""
+        cmd = "export AAA_USER="+self.root_lr_user+" && echo -ne \""+cmd+"\\n \" | xrcmd \"admin\""
 
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True)
-        out, err = process.communicate()
+        returncode, out = self.run_ztp_shell(cmd)
 
 
-        if process.returncode:
+        if returncode:
             status = "error"
             output = "Failed to get command output"
         else:
@@ -476,6 +1410,166 @@ class AuditHelpers(ZtpHelpers):
         return {"status" : status, "output" : output}
 
 
+    def get_ssh_multiplex_cfg(self):
+        """AUDIT_CONFIG SSH_MULTIPLEX settings, multiplexing is on by default"""
+
+        try:
+            mux_cfg = self.audit_cfg_dict["SSH_MULTIPLEX"]
+        except Exception as e:
+            mux_cfg = {}
+
+        try:
+            persist = int(mux_cfg["PERSIST"])
+        except Exception as e:
+            persist = DEFAULT_SSH_PERSIST
+
+        return {"enable" : bool(mux_cfg.get("ENABLE", True)) and persist > 0,
+                "persist" : persist}
+
+
+    def run_at_ssh_origin(self, origin, cmd):
+        """Run a linux cmd on the node that opens the ssh/scp connection of a hop
+           :param origin: "xr" (XR LXC, xrnns), "local" (global netns of the
+                          admin LXC running the app), "admin" (active admin
+                          LXC through admincmd), "active_admin" or
+                          "standby_admin" (admin LXC shells reached over ssh)
+           :type origin: str
+           :return: Return a dictionary with status and output
+                    { 'status': 'error/success', 'output': '' }
+           :rtype: dict
+        """
+
+        if origin == "xr":
+            result = self.run_bash(cmd)
+        elif origin == "local":
+            result = self.run_bash(cmd, vrf="", pid=1)
+        elif origin == "admin":
+            return self.admincmd(cmd="run "+cmd)
+        elif origin == "active_admin":
+            return self.active_adminruncmd(cmd=pipes.quote(cmd))
+        elif origin == "standby_admin":
+            return self.standby_adminruncmd(cmd=pipes.quote(cmd))
+        else:
+            return {"status" : "error", "output" : "Invalid ssh origin: "+str(origin)}
+
+        if not result["status"]:
+            return {"status" : "success", "output" : result["output"]}
+        else:
+            return {"status" : "error", "output" : result["error"]}
+
+
+    def ssh_opts(self, origin, ip):
+        """ssh/scp options that carry a hop from origin to root@ip over a
+           shared ControlMaster connection. The master is started on first
+           use and checked again every PERSIST/2 seconds, so key exchange and
+           authentication happen once per target. Without a live master, ssh
+           falls back to a regular connection.
+           :return: String to be placed right after ssh/scp
+           :rtype: str
+        """
+
+        mux_cfg = self.get_ssh_multiplex_cfg()
+        if not mux_cfg["enable"] or not ip:
+            return " "
+
+        opts = " -o ControlPath="+SSH_CONTROL_PATH_PREFIX+ip+" "
+
+        now = time.time()
+        with self.ssh_masters_lock:
+            if self.ssh_masters.get((origin, ip), 0) > now:
+                return opts
+            self.ssh_masters[(origin, ip)] = now + mux_cfg["persist"]/2.0
+
+        # The master is forked off explicitly with its stdio detached, a master
+        # spawned by ControlMaster=auto would hold the pipes of the first
+        # command open until ControlPersist expires.
+
+        master_cmd = ("ssh -O check"+opts+"root@"+ip+" >/dev/null 2>&1 || "
+                      "ssh -f -N -o ControlMaster=yes -o ControlPersist="+str(mux_cfg["persist"])+
+                      opts+"root@"+ip+" </dev/null >/dev/null 2>&1")
+
+        if self.debug:
+            self.logger.debug("Setting up ssh master connection from %s to %s" % (origin, ip))
+
+        self.run_at_ssh_origin(origin, master_cmd)
+        return opts
+
+
+    def close_ssh_masters(self):
+        """Tear down the ssh master connections set up by ssh_opts()"""
+
+        with self.ssh_masters_lock:
+            masters = self.ssh_masters.keys()
+
+        # Masters reached through an admin LXC hop go first, while the
+        # connections to the admin LXCs are still up.
+
+        for origin, ip in sorted(masters, key=lambda master: master[0] in ["xr", "local", "admin"]):
+            self.run_at_ssh_origin(origin, "ssh -O exit -o ControlPath="+SSH_CONTROL_PATH_PREFIX+ip+
+                                           " root@"+ip+" >/dev/null 2>&1")
+
+        with self.ssh_masters_lock:
+            self.ssh_masters.clear()
+
+
+    def list_directories(self, runcmd, dirs):
+        """List several directories on a target with a single "ls -lrtq", i.e.
+           one admin/ssh hop, and split the output back per directory using
+           the "<dir>:" headers ls prints when given more than one directory.
+           The hops run the command through a shell each, so it can't be
+           framed with markers echoed in between, instead:
+             - a header is a line that is exactly "<dir>:" for one of dirs,
+               with -q a file name can't spill into a line of its own and
+               every other line of the listing starts with "total" or a mode
+             - only those "ls -l" lines are kept, which drops the echoed
+               command, banner and prompt of an admin exec session as well
+               as the error lines of missing directories
+           :param runcmd: Method running a linux cmd on the target and
+                          returning { 'status': '', 'output': '' }, e.g.
+                          self.run_bash or self.standby_hostcmd. Output
+                          may be a string or a list of lines
+           :param dirs: Directories to list
+           :type dirs: list
+           :return: Dictionary with the ls output of every directory found
+                    { '<dir>': 'ls output' }
+           :rtype: dict
+        """
+
+        dirs = list(collections.OrderedDict.fromkeys(dirs))
+        if not dirs:
+            return {}
+
+        cmd_out = runcmd(cmd="ls -lrtq "+" ".join(dirs))
+
+        if isinstance(cmd_out["output"], list):
+            lines = cmd_out["output"]
+        else:
+            lines = cmd_out["output"].splitlines()
+
+        if len(dirs) == 1:
+            if cmd_out["status"] in [0, "success"]:
+                return {dirs[0] : "\n".join(line for line in lines if LS_LONG_LINE.match(line))}
+            else:
+                return {}
+
+        # ls exits non-zero if any of the directories is missing, the
+        # listings of the others are still valid
+
+        headers = dict((directory+":", directory) for directory in dirs)
+        listing = {}
+        current_dir = None
+
+        for line in lines:
+            if line in headers:
+                current_dir = headers[line]
+                listing[current_dir] = []
+            elif current_dir is not None and LS_LONG_LINE.match(line):
+                listing[current_dir].append(line)
+
+        return dict((directory, "\n".join(dir_lines))
+                    for directory, dir_lines in listing.iteritems())
+
+
     def adminscp(self, src=None, dest=None):
         """Transfer a file from XR LXC to admin LXC
            :param src: Path of src file in XR to be 
@@ -501,7 +1595,7 @@ class AuditHelpers(ZtpHelpers):
             self.logger.debug("Received scp request to transfer file from XR LXC to admin LXC")
 
 
-        result = self.admincmd(cmd="run scp root@"+self.active_xr_ip+":"+src+" "+dest)
+        result = self.admincmd(cmd="run scp"+self.ssh_opts("admin", self.active_xr_ip)+"root@"+self.active_xr_ip+":"+src+" "+dest)
 
         return {"status" : result["status"], "output" : result["output"]}
 
@@ -531,7 +1625,7 @@ class AuditHelpers(ZtpHelpers):
             self.logger.debug("Received scp request to transfer file from Admin LXC to XR LXC")
 
 
-        result = self.admincmd(cmd="run scp "+src+" root@"+self.active_xr_ip+":"+dest)
+        result = self.admincmd(cmd="run scp"+self.ssh_opts("admin", self.active_xr_ip)+src+" root@"+self.active_xr_ip+":"+dest)
 
         return {"status" : result["status"], "output" : result["output"]}
 
@@ -573,7 +1667,7 @@ class AuditHelpers(ZtpHelpers):
         if result["status"] == "error":
             return {"status" : result["status"], "output" : result["output"]}
         else:
-            result = self.admincmd(cmd="run scp /misc/scratch/"+tempfile+" root@"+active_admin_ip+":"+dest)
+            result = self.admincmd(cmd="run scp"+self.ssh_opts("admin", active_admin_ip)+"/misc/scratch/"+tempfile+" root@"+active_admin_ip+":"+dest)
 
             # Remove tempfile from Admin shell
 
@@ -612,7 +1706,7 @@ class AuditHelpers(ZtpHelpers):
         #tempfile = "audit_aadscp_"+filename+"_"+timestamp
         tempfile = "audit_aadxscp_"+filename
 
-        result = self.admincmd(cmd="run scp root@"+active_admin_ip+":"+src+" /misc/scratch/"+tempfile)
+        result = self.admincmd(cmd="run scp"+self.ssh_opts("admin", active_admin_ip)+"root@"+active_admin_ip+":"+src+" /misc/scratch/"+tempfile)
 
         if result["status"] == "error":
             return {"status" : result["status"], "output" : result["output"]}
@@ -649,7 +1743,7 @@ class AuditHelpers(ZtpHelpers):
 
         # Now run this command via the admin shell of the active RP
 
-        result = self.admincmd(cmd="run ssh root@"+active_admin_ip+" "+cmd)
+        result = self.admincmd(cmd="run ssh"+self.ssh_opts("admin", active_admin_ip)+"root@"+active_admin_ip+" "+cmd)
 
         return {"status" : result["status"], "output" : result["output"]}
 
@@ -674,7 +1768,7 @@ class AuditHelpers(ZtpHelpers):
             self.logger.debug("Received host command request: \"%s\"" % cmd)
 
 
-        result = self.admincmd(cmd="run ssh root@10.0.2.16 "+cmd)
+        result = self.admincmd(cmd="run ssh"+self.ssh_opts("admin", "10.0.2.16")+"root@10.0.2.16 "+cmd)
 
         return {"status" : result["status"], "output" : result["output"]}
 
@@ -718,7 +1812,7 @@ class AuditHelpers(ZtpHelpers):
         if result["status"] == "error":
             return {"status" : result["status"], "output" : result["output"]}
         else:
-            result = self.admincmd(cmd="run scp /misc/scratch/"+tempfile+" root@10.0.2.16:"+dest)
+            result = self.admincmd(cmd="run scp"+self.ssh_opts("admin", "10.0.2.16")+"/misc/scratch/"+tempfile+" root@10.0.2.16:"+dest)
 
             # Remove tempfile from Admin shell
 
@@ -727,6 +1821,10 @@ class AuditHelpers(ZtpHelpers):
 
 
     def get_xr_ip(self):
+        return self.topology_lookup("xr_ip", self.resolve_xr_ip)
+
+
+    def resolve_xr_ip(self):
 
         try:
             # First determine the currently allocated ip address for IOS-XR lxc in xrnns namespace
@@ -808,7 +1906,7 @@ class AuditHelpers(ZtpHelpers):
 
         # Now try to run this command via the admin LXC of the active RP
 
-        result = self.admincmd(cmd="run ssh root@"+standby_admin_ip+" "+cmd)
+        result = self.admincmd(cmd="run ssh"+self.ssh_opts("admin", standby_admin_ip)+"root@"+standby_admin_ip+" "+cmd)
 
         return {"status" : result["status"], "output" : result["output"]}
 
@@ -858,7 +1956,7 @@ class AuditHelpers(ZtpHelpers):
         if result["status"] == "error":
             return {"status" : result["status"], "output" : result["output"]}
         else:
-            result = self.admincmd(cmd="run scp /misc/scratch/"+tempfile+" root@"+standby_admin_ip+":"+dest)
+            result = self.admincmd(cmd="run scp"+self.ssh_opts("admin", standby_admin_ip)+"/misc/scratch/"+tempfile+" root@"+standby_admin_ip+":"+dest)
 
             # Remove tempfile from Admin shell
 
@@ -898,7 +1996,7 @@ class AuditHelpers(ZtpHelpers):
         #tempfile = "audit_aadscp_"+filename+"_"+timestamp
         tempfile = "audit_sadxscp_"+filename
 
-        result = self.admincmd(cmd="run scp root@"+standby_admin_ip+":"+src+" /misc/scratch/"+tempfile)
+        result = self.admincmd(cmd="run scp"+self.ssh_opts("admin", standby_admin_ip)+"root@"+standby_admin_ip+":"+src+" /misc/scratch/"+tempfile)
 
         if result["status"] == "error":
             return {"status" : result["status"], "output" : result["output"]}
@@ -933,7 +2031,7 @@ class AuditHelpers(ZtpHelpers):
 
         if self.ha_setup:
             if self.standby_xr_ip is not "":
-                cmd_run = self.run_bash("ssh root@"+self.standby_xr_ip+" "+cmd)
+                cmd_run = self.run_bash("ssh"+self.ssh_opts("xr", self.standby_xr_ip)+"root@"+self.standby_xr_ip+" "+cmd)
                 if not cmd_run["status"]:
                     return {"status" : "success", "output" : cmd_run["output"]}
                 else:
@@ -974,7 +2072,7 @@ class AuditHelpers(ZtpHelpers):
 
         if self.ha_setup:
             if self.standby_xr_ip is not "":
-                cmd_run = self.run_bash("scp "+src+" root@"+self.standby_xr_ip+":"+dest)
+                cmd_run = self.run_bash("scp"+self.ssh_opts("xr", self.standby_xr_ip)+src+" root@"+self.standby_xr_ip+":"+dest)
                 if not cmd_run["status"]:
                     return {"status" : "success", "output" : cmd_run["output"]}
                 else:
@@ -1014,7 +2112,7 @@ class AuditHelpers(ZtpHelpers):
 
         if self.ha_setup:
             if self.standby_xr_ip is not "":
-                cmd_run = self.run_bash("scp root@"+self.standby_xr_ip+":"+src+" "+dest)
+                cmd_run = self.run_bash("scp"+self.ssh_opts("xr", self.standby_xr_ip)+"root@"+self.standby_xr_ip+":"+src+" "+dest)
                 if not cmd_run["status"]:
                     return {"status" : "success", "output" : cmd_run["output"]}
                 else:
@@ -1048,7 +2146,7 @@ class AuditHelpers(ZtpHelpers):
             self.logger.debug("Received host command request: \"%s\"" % cmd)
 
 
-        result = self.active_adminruncmd(cmd="ssh root@10.0.2.16 "+cmd)
+        result = self.active_adminruncmd(cmd="ssh"+self.ssh_opts("active_admin", "10.0.2.16")+"root@10.0.2.16 "+cmd)
 
         return {"status" : result["status"], "output" : result["output"]}
 
@@ -1092,7 +2190,7 @@ class AuditHelpers(ZtpHelpers):
         if result["status"] == "error":
             return {"status" : result["status"], "output" : result["output"]}
         else:
-            result = self.active_adminruncmd(cmd="scp /misc/scratch/"+tempfile+" root@10.0.2.16:"+dest)
+            result = self.active_adminruncmd(cmd="scp"+self.ssh_opts("active_admin", "10.0.2.16")+"/misc/scratch/"+tempfile+" root@10.0.2.16:"+dest)
 
             # Remove tempfile from activey Admin shell
 
@@ -1123,7 +2221,7 @@ class AuditHelpers(ZtpHelpers):
         tempfile = "audit_ahxscp_"+filename
 
 
-        result = self.active_adminruncmd(cmd="scp root@10.0.2.16:"+src+" /misc/scratch/"+tempfile)
+        result = self.active_adminruncmd(cmd="scp"+self.ssh_opts("active_admin", "10.0.2.16")+"root@10.0.2.16:"+src+" /misc/scratch/"+tempfile)
 
         if result["status"] == "error":
             return {"status" : result["status"], "output" : result["output"]}
@@ -1154,7 +2252,7 @@ class AuditHelpers(ZtpHelpers):
             self.logger.debug("Received host command request: \"%s\"" % cmd)
 
 
-        result = self.standby_adminruncmd(cmd="ssh root@10.0.2.16 "+cmd)
+        result = self.standby_adminruncmd(cmd="ssh"+self.ssh_opts("standby_admin", "10.0.2.16")+"root@10.0.2.16 "+cmd)
 
         return {"status" : result["status"], "output" : result["output"]}
 
@@ -1198,7 +2296,7 @@ class AuditHelpers(ZtpHelpers):
         if result["status"] == "error":
             return {"status" : result["status"], "output" : result["output"]}
         else:
-            result = self.standby_adminruncmd(cmd="scp /misc/scratch/"+tempfile+" root@10.0.2.16:"+dest)
+            result = self.standby_adminruncmd(cmd="scp"+self.ssh_opts("standby_admin", "10.0.2.16")+"/misc/scratch/"+tempfile+" root@10.0.2.16:"+dest)
 
             # Remove tempfile from Standby Admin shell
 
@@ -1230,7 +2328,7 @@ class AuditHelpers(ZtpHelpers):
         tempfile = "audit_shxscp_"+filename
 
 
-        result = self.standby_adminruncmd(cmd="scp root@10.0.2.16:"+src+" /misc/scratch/"+tempfile)
+        result = self.standby_adminruncmd(cmd="scp"+self.ssh_opts("standby_admin", "10.0.2.16")+"root@10.0.2.16:"+src+" /misc/scratch/"+tempfile)
 
         if result["status"] == "error":
             return {"status" : result["status"], "output" : result["output"]}
@@ -1243,39 +2341,85 @@ class AuditHelpers(ZtpHelpers):
 
 
 
-    def run_bash_timed(self, cmd=None, timeout=5, vrf="xrnns", pid=1):
-        event = threading.Event()
+    def run_bash_timed(self, cmd=None, timeout=5, vrf="xrnns", pid=1, stdin_chunks=None):
+        """Run a bash cmd, killing it if it runs longer than timeout seconds
+           or past the end of the run budget (see start_run_budget).
+           :param stdin_chunks: Optional iterable of strings streamed to the
+                                stdin of cmd, one chunk at a time
+           :return: Same dictionary as run_bash, with "timed_out" set to
+                    True if cmd was killed or not run for lack of time
+           :rtype: dict
+        """
 
-        with open(self.get_netns_path(nsname=vrf,nspid=pid)) as fd:
-            self.setns(fd, CLONE_NEWNET)
+        if cmd is None:
+            self.syslogger.info("No bash command provided")
+            return {"status" : 1, "output" : "", "error" : "No bash command provided"}
 
-            if self.debug:
-                self.logger.debug("bash cmd being run: "+cmd)
+        if self.debug:
+            self.logger.debug("bash cmd being run: "+cmd)
 
-            if cmd is not None:
-                process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, preexec_fn=os.setsid)
-                killer = KillerThread(process.pid, timeout, event)
-                killer.start()
-                out, err = process.communicate()
-                event.set()
-                killer.join()
+        start_time = time.time()
+        deadline = self.command_deadline(timeout)
+        if deadline <= start_time:
+            self.syslogger.info("Run budget exhausted, skipping cmd: "+cmd)
+            return {"status" : 1, "output" : "", "error" : TIMED_OUT_RESPONSE, "timed_out" : True}
 
-                if self.debug:
-                    self.logger.debug("output: "+out)
-                    self.logger.debug("error: "+err)
-            else:
-                self.syslogger.info("No bash command provided")
-                return {"status" : 1, "output" : "", "error" : "No bash command provided"}
+        if stdin_chunks is None:
+            stdin = None
+        else:
+            stdin = subprocess.PIPE
+
+        # The process is spawned by the worker of the namespace and
+        # inherits it, the output is collected in this thread. It leads its
+        # own process group so that the reaper can kill the whole pipeline.
+        process = netns_executor.call(self.get_netns_path(nsname=vrf,nspid=pid),
+                                      subprocess.Popen, cmd, stdin=stdin,
+                                      stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                      shell=True, preexec_fn=os.setsid)
+        reaper_entry = process_reaper.watch(process.pid, deadline)
+
+        try:
+            if stdin_chunks is not None:
+                try:
+                    for chunk in stdin_chunks:
+                        process.stdin.write(chunk)
+                except IOError as e:
+                    # cmd exited (or was killed) before reading all the input
+                    if self.debug:
+                        self.logger.debug("Failed to write input of bash cmd, error: "+str(e))
+                finally:
+                    try:
+                        process.stdin.close()
+                    except IOError as e:
+                        pass
+                    process.stdin = None
+            out, err = process.communicate()
+        finally:
+            process_reaper.cancel(reaper_entry)
+
+        # The deadline is also reached when cmd completed but a child it
+        # backgrounded kept the output pipes open. Only a cmd that was
+        # itself killed by the reaper timed out.
+        timed_out = reaper_entry["timed_out"] and process.returncode < 0
+        if timed_out:
+            self.syslogger.info("Killed cmd after %.1fs: %s" % (time.time() - start_time, cmd))
+
+        if self.debug:
+            self.logger.debug("output: "+out)
+            self.logger.debug("error: "+err)
 
-            status = process.returncode
-            return {"status" : status, "output" : out, "error" : err}
+        status = process.returncode
+        return {"status" : status, "output" : out, "error" : err,
+                "timed_out" : timed_out}
 
 
-    def run_bash(self, cmd=None, vrf="xrnns", pid=1):
+    def run_bash(self, cmd=None, vrf="xrnns", pid=1, timeout=None):
         """User defined method in Child Class
            Wrapper method for basic subprocess.Popen to execute 
            bash commands on IOS-XR.
            :param cmd: bash command to be executed in XR linux shell. 
+           :param timeout: seconds after which cmd is killed, AUDIT_CONFIG
+                           COMMAND_TIMEOUT by default
            :type cmd: str 
            
            :return: Return a dictionary with status and output
@@ -1284,25 +2428,11 @@ class AuditHelpers(ZtpHelpers):
            :rtype: dict
         """
 
-        with open(self.get_netns_path(nsname=vrf,nspid=pid)) as fd:
-            self.setns(fd, CLONE_NEWNET)
-
-            if self.debug:
-                self.logger.debug("bash cmd being run: "+cmd)
-            ## In XR the default shell is bash, hence the name
-            if cmd is not None:
-                process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-                out, err = process.communicate()
-                if self.debug:
-                    self.logger.debug("output: "+out)
-                    self.logger.debug("error: "+err)
-            else:
-                self.syslogger.info("No bash command provided")
-                return {"status" : 1, "output" : "", "error" : "No bash command provided"}
+        if timeout is None:
+            timeout = self.get_command_timeout()
 
-            status = process.returncode
-
-            return {"status" : status, "output" : out, "error" : err}
+        ## In XR the default shell is bash, hence the name
+        return self.run_bash_timed(cmd=cmd, timeout=timeout, vrf=vrf, pid=pid)
 
 
 
@@ -1324,9 +2454,12 @@ class AuditHelpers(ZtpHelpers):
                       'peer_rp_ip': 'IP address of Peer RP' }
            :rtype: dict
         """
-        cmd = "ip netns exec xrnns /pkg/bin/node_list_generation -f MY"
-        bash_out = self.run_bash(cmd)
-        if not bash_out["status"]:
+        return self.topology_lookup("peer_rp_ip", self.resolve_peer_rp_ip)
+
+
+    def resolve_peer_rp_ip(self):
+        bash_out = self.get_my_node_name()
+        if bash_out["status"] == "success":
             my_name = bash_out["output"]
         else:
             self.syslogger.info("Failed to get My Node Name")
@@ -1394,7 +2527,7 @@ class AuditHelpers(ZtpHelpers):
             return {"status" : "error"}
         else:
             self.syslogger.info("Transferring file "+str(src_file_path)+" from Active RP to standby location: " +str(dest_file_path))
-            cmd = "ip netns exec xrnns scp "+str(src_file_path)+ " root@" + str(standby_ip["peer_rp_ip"]) + ":" + str(dest_file_path)
+            cmd = "ip netns exec xrnns scp"+self.ssh_opts("xr", str(standby_ip["peer_rp_ip"]))+str(src_file_path)+ " root@" + str(standby_ip["peer_rp_ip"]) + ":" + str(dest_file_path)
             bash_out = self.run_bash(cmd)
 
             if bash_out["status"]:
@@ -1429,7 +2562,7 @@ class AuditHelpers(ZtpHelpers):
                 standby_ip = self.get_peer_rp_ip()
                 if standby_ip["status"] == "error":
                     return {"status" : "error", "output" : ""}
-                standby_cmd = "ip netns exec xrnns ssh root@"+str(standby_ip["peer_rp_ip"])+ " " + "\"$(< "+str(f.name)+")\"" 
+                standby_cmd = "ip netns exec xrnns ssh"+self.ssh_opts("xr", str(standby_ip["peer_rp_ip"]))+"root@"+str(standby_ip["peer_rp_ip"])+ " " + "\"$(< "+str(f.name)+")\"" 
                
                 bash_out = self.run_bash(standby_cmd)
 
@@ -1453,6 +2586,7 @@ class AuditHelpers(ZtpHelpers):
                 return {"status" : "error", "output" : "", "warning" : "Failed to get show redundancy summary output"}
             else:
                 try:
+                    self.check_redundancy_state(show_red_summary["output"][2])
                     if "N/A" in show_red_summary["output"][2].split()[1]:
                         return {"status" : "success", "output": False} 
                     else:
@@ -1598,108 +2732,253 @@ class AuditHelpers(ZtpHelpers):
         return {"status" : "success"}                        
 
 
-    def validate_xml(xml_path, xsd_path):
+    def yaml_to_dict(self, yaml_file):
+        yaml_dict = {}
+        try:
+            with open(yaml_file, 'r') as stream:
+                try:
+                    yaml_dict = yaml.load(stream)
+                except yaml.YAMLError as e:
+                    self.syslogger.info("Failed to parse YAML file, Error: %s" % e)
+        except Exception as e:
+            self.syslogger.info("Failed to open YAML file")
+            self.syslogger.info("Error is %s" % e)
+            
+        if self.debug:
+            self.logger.debug(yaml_dict)
+
+        return yaml_dict
+
+
+
+    def gather_general_data(self):
+        general_fields = []
 
         try:
-            xmlschema_doc = etree.parse(xsd_path)
-            xmlschema = etree.XMLSchema(xmlschema_doc)
-            xml_doc = etree.parse(xml_path)
-            result = xmlschema.validate(xml_doc)
+            general_fields = self.compliance_xsd_summary["general_fields"]
         except Exception as e:
-            self.syslogger.info("Failed to parse generated XML against compliance xml schema")
-            self.syslogger.info("Error is %s" % e) 
-        return result
+            self.syslogger.info("Failed to gather General fields from the compliance file")
+            self.syslogger.info("Error is: "+str(e))
 
+        general_data_dict = {}
+
+        for field in general_fields:
+            value = self.get_general_field(field)
+            general_data_dict[field] = str(value)
+       
+        return general_data_dict 
 
-    def xsd_to_dict(self, version=False):
-        xsd_dict = {}
+
+    def get_command_timeout(self):
         try:
-            with open(self.compliance_xsd,'r') as f:
-                xsd_dict_raw = xd.parse(f)
-                xsd_dict = json.loads(json.dumps(xsd_dict_raw))
-            if version:
-                version = "v"+ str(xsd_dict["xs:schema"]["@version"])
-                return {"version" : version} 
+            timeout = int(self.audit_cfg_dict["COMMAND_TIMEOUT"])
         except Exception as e:
-            if version:
-                return {}
-            self.syslogger.info("Failed to parse compliance xsd file")
-            self.syslogger.info("Error is %s" % e)
-            return {}
+            timeout = DEFAULT_COMMAND_TIMEOUT
 
-        if self.debug:
-            self.logger.debug(xsd_dict)
+        return max(timeout, 1)
+
+
+    def command_deadline(self, timeout=None):
+        """Deadline (epoch seconds) of a command started now: timeout
+           seconds (COMMAND_TIMEOUT by default) from now, and never later
+           than the end of the run budget. Used by run_bash_timed and,
+           through run_ztp_shell, by xrcmd and admincmd.
+        """
+
+        if timeout is None:
+            timeout = self.get_command_timeout()
 
-        return xsd_dict
+        deadline = time.time() + timeout
+        if self.run_deadline is not None:
+            deadline = min(deadline, self.run_deadline)
 
+        return deadline
 
 
-    def xml_to_dict(self, xml_file):
-        xml_dict = {}
+    def start_run_budget(self):
+        """Start the time budget of an audit run, AUDIT_CONFIG RUN_BUDGET
+           seconds from now. Commands still running at the end of the
+           budget are killed and no command is started after it.
+        """
+
         try:
-            with open(xml_file,'r') as f:
-                xml_dict_raw = xd.parse(f)
-                xml_dict = json.loads(json.dumps(xml_dict_raw))
+            budget = int(self.audit_cfg_dict["RUN_BUDGET"])
         except Exception as e:
-            self.syslogger.info("Failed to parse compliance xml file")
-            self.syslogger.info("Error is %s" % e)
-            return {}
+            budget = DEFAULT_RUN_BUDGET
 
-        if self.debug:
-            self.logger.debug(xml_dict)
+        if budget > 0:
+            self.run_deadline = time.time() + budget
+        else:
+            self.run_deadline = None
 
-        return xml_dict
 
+    def get_daemon_interval(self):
+        try:
+            interval = int(self.audit_cfg_dict["DAEMON_INTERVAL"])
+        except Exception as e:
+            interval = DEFAULT_DAEMON_INTERVAL
 
-    def yaml_to_dict(self, yaml_file):
-        yaml_dict = {}
+        return max(interval, 1)
+
+
+    def daemon_pidfile(self):
+        if getattr(sys, 'frozen', False):
+            # Path of the PyInstaller binary, e.g. /misc/scratch/audit_xr.bin
+            app_path = sys.executable
+        else:
+            app_path = os.path.abspath(sys.argv[0])
+
+        return app_path + DAEMON_PIDFILE_SUFFIX
+
+
+    def owns_pidfile(self, pidfile):
         try:
-            with open(yaml_file, 'r') as stream:
+            with open(pidfile, 'r') as f:
+                return int(f.read().strip()) == os.getpid()
+        except Exception as e:
+            return False
+
+
+    def run_as_daemon(self, task, interval=None):
+        """Run task every interval seconds in the current process, keeping
+           the parsed config, compiled schema and caches warm between runs.
+           Returns when SIGTERM/SIGINT is received or when the pidfile of
+           the daemon is removed.
+           :param task: callable that performs one run
+           :param interval: seconds between the start of two runs,
+                            AUDIT_CONFIG DAEMON_INTERVAL by default
+           :return: exit code of the daemon
+           :rtype: int
+        """
+
+        if interval is None:
+            interval = self.get_daemon_interval()
+
+        pidfile = self.daemon_pidfile()
+
+        try:
+            with open(pidfile, 'r') as f:
+                pid = int(f.read().strip())
+            if pid != os.getpid():
+                # Raises OSError if the process is gone
+                os.kill(pid, 0)
+                self.syslogger.info("Daemon already running with pid "+str(pid)+", bailing out")
+                return 1
+        except (IOError, OSError, ValueError) as e:
+            pass
+
+        try:
+            with open(pidfile, 'w') as f:
+                f.write(str(os.getpid()))
+        except Exception as e:
+            self.syslogger.info("Failed to create daemon pidfile "+pidfile+", Error: "+str(e))
+            return 1
+
+        stop = threading.Event()
+
+        def request_stop(signum, frame):
+            stop.set()
+
+        signal.signal(signal.SIGTERM, request_stop)
+        signal.signal(signal.SIGINT, request_stop)
+
+        self.syslogger.info("Started daemon, pid: "+str(os.getpid())+", interval: "+str(interval)+"s")
+
+        next_run = time.time()
+        try:
+            while not stop.is_set():
+                self.start_run_budget()
                 try:
-                    yaml_dict = yaml.load(stream)
-                except yaml.YAMLError as e:
-                    self.syslogger.info("Failed to parse YAML file, Error: %s" % e)
+                    task()
+                except Exception as e:
+                    self.syslogger.info("Daemon run failed, Error: "+str(e))
+
+                # Skip the runs that were missed if a run overran the interval
+                next_run = max(next_run + interval, time.time())
+
+                while not stop.is_set():
+                    if not self.owns_pidfile(pidfile):
+                        self.syslogger.info("Daemon pidfile removed, exiting")
+                        stop.set()
+                        break
+                    remaining = next_run - time.time()
+                    if remaining <= 0:
+                        break
+                    stop.wait(min(remaining, DAEMON_PIDFILE_CHECK_INTERVAL))
+        finally:
+            if self.owns_pidfile(pidfile):
+                os.remove(pidfile)
+
+        self.syslogger.info("Daemon stopped")
+        return 0
+
+
+    def get_checksum_algorithm(self):
+        try:
+            algorithm = str(self.audit_cfg_dict["CHECKSUM_ALGORITHM"]).lower()
         except Exception as e:
-            self.syslogger.info("Failed to open YAML file")
-            self.syslogger.info("Error is %s" % e)
-            
-        if self.debug:
-            self.logger.debug(yaml_dict)
+            return DEFAULT_CHECKSUM_ALGORITHM
 
-        return yaml_dict
+        if algorithm not in CHECKSUM_ALGORITHMS:
+            self.syslogger.info("Unsupported checksum algorithm: "+algorithm+", "
+                                "defaulting to "+DEFAULT_CHECKSUM_ALGORITHM)
+            return DEFAULT_CHECKSUM_ALGORITHM
 
+        return algorithm
 
 
-    def gather_general_data(self):
-        general_fields_dict = {}
+    def get_checksum_cache(self):
+        """Create the checksum cache described by AUDIT_CONFIG
+           CHECKSUM_CACHE on first use. Returns None if the cache is
+           disabled.
+        """
 
-        for element in self.compliance_xsd_dict["xs:schema"]["xs:element"]:
-            try:
-                if "xs:complexType" in element.keys():
-                    if element["@name"] == "GENERAL":
-                        general_fields_dict = element["xs:complexType"]["xs:all"]["xs:element"]
-            except Exception as e:
-                self.syslogger.info("Failed to gather General fields from the compliance file")
-                self.syslogger.info("Error is: "+str(e))
+        if self.checksum_cache is not None:
+            return self.checksum_cache
 
-        general_data_dict = {}
+        try:
+            cache_cfg = self.audit_cfg_dict["CHECKSUM_CACHE"]
+        except Exception as e:
+            cache_cfg = {}
 
-        for field in general_fields_dict:
-            value = self.get_general_field(field["@ref"])
-            general_data_dict[field["@ref"]] = str(value)
-       
-        return general_data_dict 
+        if not cache_cfg.get("ENABLE", True):
+            return None
+
+        try:
+            cache_dir = cache_cfg["DIRECTORY"]
+        except Exception as e:
+            cache_dir = DEFAULT_CHECKSUM_CACHE_DIR
+
+        try:
+            paranoid_runs = int(cache_cfg["PARANOID_RUNS"])
+        except Exception as e:
+            paranoid_runs = DEFAULT_CHECKSUM_PARANOID_RUNS
+
+        cache_file = os.path.join(cache_dir,
+                                  CHECKSUM_CACHE_PREFIX+"_"+self.domain+".json")
+
+        self.checksum_cache = ChecksumCache(cache_file=cache_file,
+                                            paranoid_runs=paranoid_runs,
+                                            syslogger=self.syslogger)
+        return self.checksum_cache
 
 
     def get_checksum(self, filename):
+        algorithm = self.get_checksum_algorithm()
         try:
-            result = self.run_bash(cmd="md5sum "+filename, vrf="", pid=1)
-            if not result["status"]:
-                return result["output"].split(' ')[0]
-            else:
-                return ""
+            if self.checksum_cache is None:
+                return file_digest(filename, algorithm)
+
+            signature = file_signature(filename)
+            checksum = self.checksum_cache.lookup(filename, signature, algorithm)
+            if checksum is None:
+                checksum = file_digest(filename, algorithm)
+                # Only cache the digest if the file didn't change while it was read
+                if file_signature(filename) == signature:
+                    self.checksum_cache.store(filename, signature, algorithm, checksum)
+            return checksum
         except Exception as e:
-            self.syslogger.info("Failed to md5 checksum of file "+filename)
+            self.syslogger.info("Failed to "+algorithm+" checksum of file "+filename)
             self.syslogger.info("Error is: "+str(e)) 
             return "" 
 
@@ -1715,16 +2994,51 @@ class AuditHelpers(ZtpHelpers):
             return []
 
 
+    def native_ls_enabled(self):
+        try:
+            return bool(self.audit_cfg_dict["NATIVE_LS"])
+        except Exception as e:
+            return True
+
+
     def run_cmd_on_element(self, element_type, element_name, cmd=None):
         if cmd is None:
             if element_type == 'file':
                 cmd = "ls -la"
             elif element_type == 'dir':
                 cmd = "ls -ld"
+        if self.native_ls_enabled() and ls_command_options(cmd) is not None:
+            # Held to the same deadline as the shell ls, with the same
+            # response when it is reached
+            start_time = time.time()
+            deadline = self.command_deadline()
+            if deadline <= start_time:
+                self.syslogger.info("Run budget exhausted, skipping cmd: "+cmd+" "+element_name)
+                return TIMED_OUT_RESPONSE
+
+            try:
+                output = native_ls(cmd, element_name,
+                                   user_cache=self.user_name_cache,
+                                   group_cache=self.group_name_cache)
+            except Exception as e:
+                # Same outcome as a failed ls in the shell
+                if self.debug:
+                    self.logger.debug("Failed to list "+element_name+", Error: "+str(e))
+                return ""
+
+            if time.time() > deadline:
+                self.syslogger.info("Cmd ran past its deadline after %.1fs: %s %s" % (time.time() - start_time,
+                                                                                      cmd, element_name))
+                return TIMED_OUT_RESPONSE
+
+            return output
+
         try:
             result = self.run_bash(cmd=cmd+" "+ element_name, vrf="", pid=1)
             if not result["status"]:
                 return result["output"]
+            elif result.get("timed_out"):
+                return TIMED_OUT_RESPONSE
             else:
                 return ""
         except Exception as e:
@@ -1753,9 +3067,19 @@ class AuditHelpers(ZtpHelpers):
             return 1
 
 
+        # Copy to a temporary file and rename it in place on the host, the
+        # collector only ever sees complete files
+
         try:
-            result = self.run_bash(cmd="scp "+src+" root@10.0.2.16:"+dest, vrf="", pid=1)
-            return result["status"]
+            result = self.run_bash(cmd="scp"+self.ssh_opts("local", "10.0.2.16")+src+" root@10.0.2.16:"+dest+XML_TEMP_SUFFIX, vrf="", pid=1)
+            if result["status"]:
+                return result["status"]
+
+            result = self.hostcmd_from_admin(cmd="mv -f "+dest+XML_TEMP_SUFFIX+" "+dest)
+            if result["status"] == "success":
+                return 0
+            else:
+                return 1
         except Exception as e:
             self.syslogger.info("Failed to transfer file to host")
             self.syslogger.info("Error is: "+str(e))
@@ -1789,7 +3113,7 @@ class AuditHelpers(ZtpHelpers):
             self.logger.debug("Received host command request from admin: \"%s\"" % cmd)
 
 
-        cmd_run = self.run_bash(cmd="ssh root@10.0.2.16 "+cmd, vrf="", pid=1)
+        cmd_run = self.run_bash(cmd="ssh"+self.ssh_opts("local", "10.0.2.16")+"root@10.0.2.16 "+cmd, vrf="", pid=1)
         if not cmd_run["status"]:
                 return {"status" : "success", "output" : cmd_run["output"]}
         else:
@@ -1797,159 +3121,233 @@ class AuditHelpers(ZtpHelpers):
            return {"status" : "error", "output" : cmd_run["output"]}
 
 
-    def gather_integrity_data(self):
-        
-        integrity_data = {}
-
-        integrity_data["@domain"] = self.domain
-        integrity_data["DIRECTORIES"] = {} 
-        integrity_data["FILES"] = {}
+    def get_audit_concurrency(self):
+        try:
+            concurrency = int(self.audit_cfg_dict["CONCURRENCY"])
+        except Exception as e:
+            concurrency = DEFAULT_AUDIT_CONCURRENCY
 
+        return max(concurrency, 1)
 
 
-        integrity_data["DIRECTORIES"]["DIRECTORY"] = []
+    def gather_directory_data(self, item):
 
         directories_dict = {}
+        directories_dict['NAME'] = item["NAME"]
         directories_dict["CMD-LIST"] = {}
         directories_dict["CMD-LIST"]["CMD"] = []
 
+        try:
+            cmd_list = item["CMD"]
+        except:
+            cmd_list = ["ls -ld"]
+
+        handler = self.integrity_field_handler("DIR")
+        for cmd in cmd_list:
+            handler_argument= {"element_type" : "dir",
+                               "element_name" : item["NAME"],
+                               "cmd" : cmd}
+            cmd_dict = { "REQUEST" : cmd,
+                         "RESPONSE" : handler(**handler_argument)}
 
+            directories_dict["CMD-LIST"]["CMD"].append(cmd_dict)
 
-        integrity_data["FILES"]["FILE"] = []
+        return directories_dict
+
+
+    def gather_file_data(self, item):
 
         files_dict = {}
+        files_dict['NAME'] = item["NAME"]
         files_dict["CMD-LIST"] = {}
         files_dict["CMD-LIST"]["CMD"] = []
-        
 
-        for key, value in self.compliance_cfg_dict.iteritems():
+        try:
+            cmd_list = item["CMD"]
+        except:
+            cmd_list = ["ls -la"]
 
-            if key == "DIR":
-                for item in value:
-                    directories_dict['NAME'] = item["NAME"]
-                    directories_dict["CMD-LIST"]["CMD"]= []
-                    try:
-                        cmd_list = item["CMD"]
-                    except:
-                        cmd_list = ["ls -ld"]
-
-                    #directories_dict["CMD-LIST"]["CMD"] = list(cmd_list) 
-                    
-                    handler = self.integrity_field_handler("DIR")
-                    for cmd in cmd_list:    
-                        handler_argument= {"element_type" : "dir",
-                                           "element_name" : item["NAME"],
-                                           "cmd" : cmd}
-                        cmd_dict = { "REQUEST" : cmd, 
-                                     "RESPONSE" : handler(**handler_argument)}
-
-                        directories_dict["CMD-LIST"]["CMD"].append(cmd_dict)
-                    
-                    integrity_data["DIRECTORIES"]["DIRECTORY"].append(copy.deepcopy(directories_dict))
-
-
-            if key == "FILE":
-                for item in value:
-                    
-                    files_dict['NAME'] = item["NAME"]
-                    files_dict["CMD-LIST"]["CMD"] = []
-                    files_dict.pop("CONTENT", None)
-                    files_dict.pop("CHECKSUM", None)
+        handler = self.integrity_field_handler("FILE")
+        for cmd in cmd_list:
+            handler_argument= {"element_type" : "file",
+                               "element_name" : item["NAME"],
+                               "cmd" : cmd}
+            cmd_dict = { "REQUEST" : cmd,
+                         "RESPONSE" : handler(**handler_argument)}
 
-                    try:
-                        cmd_list = item["CMD"]
-                    except:
-                        cmd_list = ["ls -la"]
+            files_dict["CMD-LIST"]["CMD"].append(cmd_dict)
 
-                    #files_dict["CMD-LIST"]["CMD"] = list(cmd_list)
+        try:
+            if item["CON"]:
+                handler = self.integrity_field_handler("CON")
+                handler_argument= {"filename" : item["NAME"]}
+                files_dict["CONTENT"] = handler(**handler_argument)
+        except:
+            if self.debug:
+                self.logger.debug("File content for file: "+item["NAME"]+ "not requested")
 
-                    handler = self.integrity_field_handler("FILE")
-                    for cmd in cmd_list:
-                        handler_argument= {"element_type" : "file",
-                                           "element_name" : item["NAME"],
-                                           "cmd" : cmd}
-                        cmd_dict = { "REQUEST" : cmd,
-                                     "RESPONSE" : handler(**handler_argument)}
+        try:
+            if item["CHK"]:
+                handler = self.integrity_field_handler("CHK")
+                handler_argument= {"filename" : item["NAME"]}
+                files_dict["CHECKSUM"] = handler(**handler_argument)
+        except:
+            if self.debug:
+                self.logger.debug("Checksum for file: "+item["NAME"]+ "not requested")
 
-                        files_dict["CMD-LIST"]["CMD"].append(cmd_dict)
+        return files_dict
 
-                    try:
-                        if item["CON"]:
-                            handler = self.integrity_field_handler("CON")
-                            handler_argument= {"filename" : item["NAME"]}
-                            files_dict["CONTENT"] = handler(**handler_argument)
-                    except:
-                        if self.debug:
-                            self.logger.debug("File content for file: "+item["NAME"]+ "not requested")
-
-                    
-                    try:
-                        if item["CHK"]:
-                            handler = self.integrity_field_handler("CHK")
-                            handler_argument= {"filename" : item["NAME"]}
-                            files_dict["CHECKSUM"] = handler(**handler_argument)
-                    except:
-                        if self.debug:
-                            self.logger.debug("Checksum for file: "+item["NAME"]+ "not requested")
 
-                    integrity_data["FILES"]["FILE"].append(copy.deepcopy(files_dict))
+    def gather_integrity_item(self, entry):
+        key, item = entry
 
-        return integrity_data
+        if key == "DIR":
+            return key, self.gather_directory_data(item)
+        elif key == "FILE":
+            return key, self.gather_file_data(item)
 
 
-    def create_xml_dump(self, output_xml_dir=None):
+    def integrity_entries(self):
+        """Flatten the DIR and FILE lists of COMPLIANCE_CONFIG into
+           a single ordered list of (key, item) tuples.
+        """
 
-        if output_xml_dir is None:
-            self.syslogger.info("No output directory specified, bailing out")
-            return ""
+        entries = []
+        for key, value in self.compliance_cfg_dict.iteritems():
+            if key in ["DIR", "FILE"]:
+                for item in value:
+                    entries.append((key, item))
 
-        dict_dump = {}
+        return entries
 
-        dict_dump["INTEGRITY-SET"] = {}
-        dict_dump["INTEGRITY-SET"]["INTEGRITY"] = self.gather_integrity_data()
- 
-        if self.domain == "XR-LXC":
-            dict_dump["GENERAL"] = self.gather_general_data()
 
+    def iter_integrity_data(self):
+        """Gather the data of every DIR/FILE entry of COMPLIANCE_CONFIG and
+           yield (key, data) tuples in the order of COMPLIANCE_CONFIG, with
+           all the entries of a key yielded one after the other.
+        """
+
+        checksum_cache = self.get_checksum_cache()
+        if checksum_cache is not None:
+            checksum_cache.start_run()
+
+        # Each DIR/FILE entry is handled on a bounded pool of worker threads,
+        # results come back in the order of COMPLIANCE_CONFIG.
+
+        for key, item_data in imap_ordered(self.gather_integrity_item,
+                                           self.integrity_entries(),
+                                           self.get_audit_concurrency()):
+            yield key, item_data
 
-        dict_dump['@version'] = '1.0.0'
-        dict_dump['@xmlns:xsi'] = 'http://www.w3.org/2001/XMLSchema-instance'
-        dict_dump['@xsi:noNamespaceSchemaLocation'] = 'compliance.xsd'
+        if checksum_cache is not None:
+            try:
+                checksum_cache.save()
+            except Exception as e:
+                self.syslogger.info("Failed to save the checksum cache to "+checksum_cache.cache_file)
+                self.syslogger.info("Error is: "+str(e))
 
 
-        final_dict = {'COMPLIANCE-DUMP' : dict_dump}
+    def write_integrity_data(self, xf):
+        """Stream the INTEGRITY element of this domain to an lxml xmlfile.
+           Each DIRECTORY/FILE element is written as soon as its data is
+           gathered, so only the entries in flight on the worker pool are
+           held in memory.
+        """
 
-        xml_dump = xd.unparse(final_dict, pretty=True)
+        containers = {"DIR" : "DIRECTORIES", "FILE" : "FILES"}
+        item_tags = {"DIR" : "DIRECTORY", "FILE" : "FILE"}
 
+        with xf.element("INTEGRITY", {"domain" : self.domain}):
+            xf.write("\n")
 
-        output_file = output_xml_dir + "/"+ self.domain+".xml"
-        with open(output_file, 'w') as f:
-            f.writelines(xml_dump)
-          
-        return output_file
+            written = set()
+            for key, entries in itertools.groupby(self.iter_integrity_data(),
+                                                  lambda entry: entry[0]):
+                written.add(key)
+                with xf.element(containers[key]):
+                    xf.write("\n")
+                    for key, item_data in entries:
+                        for element in dict_to_element(item_tags[key], item_data):
+                            xf.write(element, pretty_print=True)
+                xf.write("\n")
 
+            # DIRECTORIES and FILES are mandatory, even if empty
+            for key in ["DIR", "FILE"]:
+                if key not in written:
+                    xf.write(etree.Element(containers[key]), pretty_print=True)
 
 
-    def validate_xml_dump(self, xml_file):
-        
-        xmlschema_doc = etree.parse(self.compliance_xsd)
+    def create_xml_dump(self, output_xml_dir=None):
 
-        #print "\n\n######################################\n\n"
-        #print etree.tostring(xmlschema_doc.getroot(), encoding='utf8',method='xml')
+        if output_xml_dir is None:
+            self.syslogger.info("No output directory specified, bailing out")
+            return ""
 
-        xmlschema = etree.XMLSchema(xmlschema_doc)
+        output_file = output_xml_dir + "/"+ self.domain+".xml"
 
-        # Validate the output XML and return the validation result
-        xml_doc = etree.parse(xml_file)
+        # Publish the XML with a rename so that the collector never
+        # picks up a partially written file
 
-        #print "\n\n######################################\n\n"
+        temp_file = output_file + XML_TEMP_SUFFIX
 
-        #print etree.tostring(xml_doc.getroot(), encoding='utf8',method='xml')
+        # A failed run must not leave its partial XML behind
 
-        #print "\n\n######################################\n\n"
+        try:
+            with open(temp_file, 'wb') as f:
+                with etree.xmlfile(f, encoding='utf-8') as xf:
+                    xf.write_declaration()
+                    attributes = {"version" : COMPLIANCE_DUMP_VERSION,
+                                  "{"+XSI_NAMESPACE+"}noNamespaceSchemaLocation" : "compliance.xsd"}
+
+                    with xf.element("COMPLIANCE-DUMP", attributes, nsmap={"xsi" : XSI_NAMESPACE}):
+                        xf.write("\n")
+                        with xf.element("INTEGRITY-SET"):
+                            xf.write("\n")
+                            self.write_integrity_data(xf)
+                            xf.write("\n")
+                        xf.write("\n")
+
+                        if self.domain == "XR-LXC":
+                            for element in dict_to_element("GENERAL", self.gather_general_data()):
+                                xf.write(element, pretty_print=True)
+
+            os.rename(temp_file, output_file)
+        except Exception as e:
+            self.syslogger.info("Failed to create output XML "+output_file+", Error: "+str(e))
+            try:
+                os.remove(temp_file)
+            except OSError as e:
+                pass
+            return ""
 
-        result = xmlschema.validate(xml_doc)
+        return output_file
 
 
-        return result
- 
+
+    def validate_xml_dump(self, xml_file=None):
+        """Validate a compliance XML file against compliance.xsd. The
+           compiled schema is cached for the lifetime of the process.
+           :param xml_file: path of the XML file to validate
+           :return: True if the XML is valid
+           :rtype: bool
+        """
+
+        if not xml_file:
+            self.syslogger.info("No XML file to validate")
+            return False
+
+        try:
+            xmlschema = compiled_schema(self.compliance_xsd)
+
+            # Validate while parsing, dropping elements once checked so
+            # that large files are never held in memory as a whole
+            for event, elem in etree.iterparse(xml_file, schema=xmlschema):
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        except Exception as e:
+            self.syslogger.info("Failed to validate XML against compliance xml schema")
+            self.syslogger.info("Error is %s" % e)
+            return False
+
+        return True
@@ -16,14 +16,217 @@ import os, sys, subprocess
 import logging, logging.handlers
 from urllib2 import Request, urlopen, URLError, HTTPError
 import urlparse, posixpath, time, json
+import threading, uuid, pipes
+import heapq, itertools, signal, atexit
 from ctypes import cdll
 libc = cdll.LoadLibrary('libc.so.6')
 _setns = libc.setns
 
 CLONE_NEWNET = 0x40000000
 
+ZTP_HELPER_SCRIPT = "/pkg/bin/ztp_helper.sh"
+SHELL_SESSION_LOCK = threading.Lock()
+
+# Commands killed at their deadline get SIGTERM, the ones that survive it
+# for REAPER_KILL_GRACE seconds get SIGKILL
+REAPER_KILL_GRACE = 2
+
+
+class ProcessReaper(threading.Thread):
+    """Single thread enforcing the deadlines of all the running commands.
+       Deadlines are kept in a heap, the thread sleeps until the earliest
+       one and kills the process group of the command if it is still
+       being watched by then. Watched processes must lead their own
+       process group (preexec_fn=os.setsid).
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.deadlines = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.setDaemon(True)
+
+    def watch(self, pid, deadline):
+        """Kill the process group of pid at deadline (epoch seconds)
+           :return: entry to pass to cancel() once the process has been
+                    reaped, entry["timed_out"] tells if its deadline was reached
+           :rtype: dict
+        """
+
+        entry = {"pid" : pid, "active" : True, "timed_out" : False}
+
+        with self.condition:
+            if not self.is_alive() and not self.stopped:
+                self.start()
+            heapq.heappush(self.deadlines, (deadline, next(self.sequence), entry))
+            self.condition.notify()
+
+        return entry
+
+    def cancel(self, entry):
+        # Called once the process has been reaped, its pid (and process
+        # group id) may be reused from then on and must not be signalled.
+        # The entry is dropped from the heap once its deadline is reached.
+        with self.condition:
+            entry["active"] = False
+
+    def kill(self, entry, sig):
+        try:
+            # The group outlives its leader as long as any member runs
+            os.killpg(entry["pid"], sig)
+        except OSError as e:
+            # The whole process group has already completed
+            pass
+
+    def run(self):
+        with self.condition:
+            while not self.stopped:
+                now = time.time()
+                while self.deadlines and (self.deadlines[0][0] <= now or
+                                          not self.deadlines[0][2]["active"]):
+                    deadline, sequence, entry = heapq.heappop(self.deadlines)
+                    if not entry["active"]:
+                        continue
+
+                    if entry["timed_out"]:
+                        entry["active"] = False
+                        self.kill(entry, signal.SIGKILL)
+                    else:
+                        entry["timed_out"] = True
+                        self.kill(entry, signal.SIGTERM)
+                        heapq.heappush(self.deadlines, (now + REAPER_KILL_GRACE,
+                                                        next(self.sequence), entry))
+
+                if self.deadlines:
+                    self.condition.wait(self.deadlines[0][0] - now)
+                else:
+                    self.condition.wait()
+
+    def shutdown(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+
+        if self.is_alive():
+            self.join()
+
+
+# Shared by all the helpers of the process
+process_reaper = ProcessReaper()
+atexit.register(process_reaper.shutdown)
+
+
+class ShellSession(object):
+    """A bash process with ztp_helper.sh sourced once. Commands are written
+       to its stdin and their output is read back up to a line carrying a
+       random delimiter followed by the exit status of the command.
+    """
+
+    def __init__(self, helper_script=ZTP_HELPER_SCRIPT):
+        self.helper_script = helper_script
+        self.delimiter = "__ZTP_SESSION_"+uuid.uuid4().hex+"__"
+        self.lock = threading.Lock()
+        self.process = None
+
+
+    def start(self):
+        # The session leads its own process group, killing a command that
+        # timed out tears the whole session down with it
+        self.process = subprocess.Popen(["/bin/bash"],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        close_fds=True,
+                                        preexec_fn=os.setsid)
+        self.process.stdin.write("source "+self.helper_script+" >/dev/null 2>&1\n")
+        self.process.stdin.flush()
+
+
+    def stop(self):
+        if self.process is None:
+            return
+        try:
+            self.process.stdin.close()
+            if self.process.poll() is None:
+                self.process.terminate()
+            self.process.wait()
+        except (IOError, OSError) as e:
+            pass
+        self.process = None
+
+
+    def close(self):
+        with self.lock:
+            if self.process is not None and self.process.poll() is None:
+                try:
+                    self.process.stdin.write("exit\n")
+                    self.process.stdin.flush()
+                except (IOError, OSError) as e:
+                    pass
+            self.stop()
+
+
+    def run(self, cmd, deadline=None):
+        """Run cmd in the session.
+           :param deadline: epoch seconds at which the session is killed by
+                            process_reaper if cmd hasn't completed, the next
+                            command then starts a fresh session
+           :return: (returncode, output) tuple, or None if the session
+                    is busy with another command or broken. The returncode
+                    is negative (-signal) if cmd was killed at the deadline.
+        """
+
+        # Never wait for the session, concurrent callers use a one-shot shell
+        if not self.lock.acquire(False):
+            return None
+
+        reaper_entry = None
+        try:
+            if self.process is None or self.process.poll() is not None:
+                self.start()
+
+            if deadline is not None:
+                reaper_entry = process_reaper.watch(self.process.pid, deadline)
+
+            # The command runs quoted in a subshell so that its syntax or any
+            # state it changes can't leak into the session
+            self.process.stdin.write("( eval "+pipes.quote(cmd)+" ) </dev/null\n"
+                                     "printf '\\n%s %d\\n' '"+self.delimiter+"' $?\n")
+            self.process.stdin.flush()
+
+            lines = []
+            while True:
+                line = self.process.stdout.readline()
+                if not line:
+                    # The shell exited under us, or was killed at the deadline
+                    returncode = self.process.wait()
+                    self.stop()
+                    if reaper_entry is not None and reaper_entry["timed_out"] and returncode < 0:
+                        return returncode, "".join(lines)
+                    return None
+                if line.startswith(self.delimiter+" "):
+                    returncode = int(line.split()[1])
+                    break
+                lines.append(line)
+
+            # Drop the newline printed ahead of the delimiter
+            output = "".join(lines)[:-1]
+            return returncode, output
+        except (IOError, OSError, ValueError) as e:
+            self.stop()
+            return None
+        finally:
+            if reaper_entry is not None:
+                process_reaper.cancel(reaper_entry)
+            self.lock.release()
+
+
 class ZtpHelpers(object):
 
+    # Persistent shell used by xrcmd, created on first use
+    shell_session = None
+
     def __init__(self, syslog_server=None, syslog_port=None, syslog_file=None):
         """__init__ constructor
            :param syslog_server: IP address of reachable Syslog Server 
@@ -261,13 +464,12 @@ class ZtpHelpers(object):
             self.logger.debug("Response to any expected prompt \"%s\"" % cmd["prompt_response"])
 
 
-        cmd = "source /pkg/bin/ztp_helper.sh && echo -ne \""+cmd["prompt_response"]+" \" | xrcmd " + "\"" + cmd["exec_cmd"] + "\""
+        cmd = "echo -ne \""+cmd["prompt_response"]+" \" | xrcmd " + "\"" + cmd["exec_cmd"] + "\""
 
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, shell=True)
-        out, err = process.communicate()
+        returncode, out = self.run_ztp_shell(cmd)
 
 
-        if process.returncode:
+        if returncode:
             status = "error"
             output = "Failed to get command output"
         else:  
@@ -288,6 +490,70 @@ class ZtpHelpers(object):
 
 
 
+    def run_ztp_shell(self, cmd):
+        """Run a shell command that relies on the functions of ztp_helper.sh.
+           The command is multiplexed over a persistent shell session that
+           has ztp_helper.sh already sourced. If the session is busy with
+           another thread's command or unavailable, a one-shot shell is used.
+           Either way the command is killed at command_deadline().
+           :param cmd: shell command to run
+           :type cmd: str
+           :return: Return a tuple with the exit status and stdout
+           :rtype: tuple
+        """
+
+        start_time = time.time()
+        deadline = self.command_deadline()
+        if deadline is not None and deadline <= start_time:
+            self.syslogger.info("Run budget exhausted, skipping cmd: "+cmd)
+            return 1, ""
+
+        if self.shell_session is None:
+            with SHELL_SESSION_LOCK:
+                if self.shell_session is None:
+                    self.shell_session = ShellSession(helper_script=ZTP_HELPER_SCRIPT)
+
+        # The session only returns a negative status if it was killed at the deadline
+        result = self.shell_session.run(cmd, deadline)
+        timed_out = result is not None and result[0] < 0
+
+        if result is None:
+            process = subprocess.Popen("source "+ZTP_HELPER_SCRIPT+" && "+cmd, stdout=subprocess.PIPE,
+                                       shell=True, preexec_fn=os.setsid)
+            reaper_entry = None
+            if deadline is not None:
+                reaper_entry = process_reaper.watch(process.pid, deadline)
+            try:
+                out, err = process.communicate()
+            finally:
+                if reaper_entry is not None:
+                    process_reaper.cancel(reaper_entry)
+            result = process.returncode, out
+            # A cmd that completed after backgrounding a child has its
+            # deadline reached while the child holds its stdout, that child
+            # is killed but the cmd itself did not time out
+            timed_out = (reaper_entry is not None and reaper_entry["timed_out"]
+                         and process.returncode < 0)
+
+        if timed_out:
+            self.syslogger.info("Killed cmd after %.1fs: %s" % (time.time() - start_time, cmd))
+
+        return result
+
+
+    def command_deadline(self):
+        """Deadline (epoch seconds) of a shell command started now, the
+           command is killed by process_reaper if it runs past it.
+           Commands have no deadline by default.
+        """
+        return None
+
+
+    def close_shell_session(self):
+        if self.shell_session is not None:
+            self.shell_session.close()
+
+
     def xrapply(self, filename=None, reason=None):
         """Apply Configuration to XR using a file 
           
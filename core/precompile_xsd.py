@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+
+# Build time step, run by build_app.sh before pyinstaller.
+# Extracts the parts of compliance.xsd used at runtime (schema version,
+# GENERAL fields, DATE pattern) into compliance.xsd.marshal so that the
+# audit apps don't have to parse the xsd on every run.
+
+from lib.audit_helper import parse_xsd_summary
+from lib.audit_helper import XSD_ARTIFACT_SUFFIX
+import marshal
+import sys
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        xsd_path = sys.argv[1]
+    else:
+        xsd_path = "./userfiles/compliance.xsd"
+
+    summary = parse_xsd_summary(xsd_path)
+
+    with open(xsd_path + XSD_ARTIFACT_SUFFIX, 'wb') as f:
+        marshal.dump(summary, f)
+
+    print "Wrote "+xsd_path+XSD_ARTIFACT_SUFFIX
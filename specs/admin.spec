@@ -5,7 +5,8 @@ block_cipher = None
 added_files = [
          ( '../userfiles/id_rsa_server', './userfiles' ),
          ( '../userfiles/auditor.cfg.yml', './userfiles' ),
-         ( '../userfiles/compliance.xsd', './userfiles' )
+         ( '../userfiles/compliance.xsd', './userfiles' ),
+         ( '../userfiles/compliance.xsd.marshal', './userfiles' )
          ]
 
 a = Analysis(['../core/audit_admin.py'],
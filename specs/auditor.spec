@@ -11,9 +11,14 @@ added_files = [
          ( '../cron/audit_admin.cron', './admin/' ),
          ( '../cron/audit_host.cron', './host/' ),
          ( '../cron/collector.cron', './collector/' ),
+         ( '../cron/audit_xr.daemon.cron', './xr/' ),
+         ( '../cron/audit_admin.daemon.cron', './admin/' ),
+         ( '../cron/audit_host.daemon.cron', './host/' ),
+         ( '../cron/collector.daemon.cron', './collector/' ),
          ( '../userfiles/id_rsa_server', './userfiles' ),
          ( '../userfiles/auditor.cfg.yml', './userfiles' ),
-         ( '../userfiles/compliance.xsd', './userfiles' )
+         ( '../userfiles/compliance.xsd', './userfiles' ),
+         ( '../userfiles/compliance.xsd.marshal', './userfiles' )
          ]
 a = Analysis(['../core/auditor.py'],
              pathex=['/home/cisco/audit_xr_linux/specs'],
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import collections
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "core"))
+
+import collector
+
+
+DOMAIN_XML = """<?xml version="1.0" encoding="utf-8"?>
+<COMPLIANCE-DUMP version="1.0.0">
+<INTEGRITY-SET>
+<INTEGRITY domain="%(domain)s">
+<DIRECTORIES/>
+<FILES>
+<FILE><NAME>/etc/passwd</NAME><CHECKSUM>%(checksum)s</CHECKSUM></FILE>
+</FILES>
+</INTEGRITY>
+</INTEGRITY-SET>
+</COMPLIANCE-DUMP>
+"""
+
+
+class CollateXmlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.input_dir = tempfile.mkdtemp()
+        self.output_dir = tempfile.mkdtemp()
+
+        # Only the attributes used by collate_xml, the constructor needs a
+        # router to talk to
+        self.audit_obj = collector.IosxrAuditMain.__new__(collector.IosxrAuditMain)
+        self.audit_obj.syslogger = logging.getLogger("test_collector")
+        self.audit_obj.debug = False
+        self.audit_obj.audit_cfg_dict = {"COLLECTOR_WAIT_TIMEOUT" : 1}
+        self.audit_obj.compliance_xmlname = "compliance_audit_test.xml"
+
+        self.domain_dict = {"xr" : {"domain" : "XR-LXC", "input_xml_dir" : self.input_dir},
+                            "admin" : {"domain" : "ADMIN-LXC", "input_xml_dir" : self.input_dir},
+                            "host" : {"domain" : "HOST", "input_xml_dir" : self.input_dir}}
+
+    def tearDown(self):
+        shutil.rmtree(self.input_dir)
+        shutil.rmtree(self.output_dir)
+
+    def publish(self, checksum):
+        # Written to a temporary file and renamed, like create_xml_dump
+        for domain in ["XR-LXC", "ADMIN-LXC", "HOST"]:
+            xml_file = os.path.join(self.input_dir, domain+".xml")
+            with open(xml_file+".tmp", "w") as f:
+                f.write(DOMAIN_XML % {"domain" : domain, "checksum" : checksum})
+            os.rename(xml_file+".tmp", xml_file)
+
+    def collate(self):
+        return self.audit_obj.collate_xml(self.domain_dict, self.output_dir)
+
+    def test_domain_xmls_already_present(self):
+        self.publish("first")
+        output_file = self.collate()
+        self.assertTrue(output_file)
+        with open(output_file) as f:
+            self.assertEqual(f.read().count("first"), 3)
+
+        # The files of the previous run must not be collated again
+        self.assertEqual(self.collate(), {})
+
+    def test_domains_collated_in_fixed_order(self):
+        self.domain_dict = collections.OrderedDict([("host", self.domain_dict["host"]),
+                                                    ("admin", self.domain_dict["admin"]),
+                                                    ("xr", self.domain_dict["xr"])])
+        self.publish("first")
+        output_file = self.collate()
+        self.assertTrue(output_file)
+        with open(output_file) as f:
+            content = f.read()
+        positions = [content.index('domain="%s"' % domain) for domain in ["XR-LXC", "ADMIN-LXC", "HOST"]]
+        self.assertEqual(positions, sorted(positions))
+
+    def test_waits_for_fresh_domain_xmls(self):
+        self.publish("first")
+        self.assertTrue(self.collate())
+
+        publisher = threading.Timer(0.3, self.publish, args=("second",))
+        publisher.start()
+        start_time = time.time()
+        output_file = self.collate()
+        publisher.join()
+
+        self.assertTrue(output_file)
+        self.assertGreaterEqual(time.time() - start_time, 0.3)
+        with open(output_file) as f:
+            content = f.read()
+        self.assertEqual(content.count("second"), 3)
+        self.assertNotIn("first", content)
+
+
+if __name__ == "__main__":
+    unittest.main()